@@ -0,0 +1,76 @@
+"""
+File: cassette_replay.py
+Description: Record/replay round trip of a society run through the LLM cassette
+
+A pair of characters of a config is simulated with the local-stub backend while its LLM and
+embedding traffic is recorded, then simulated again from the cassette in strict replay mode.
+Each run is a separate process, and the replay fails on any request missing from the cassette:
+
+    python benchmarks/cassette_replay.py --config qiqiang_anxin.yaml --max_steps 12
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import subprocess
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+
+
+def run_society(config_path, save_dir, max_steps):
+    from digital_life_project.society_runner import load_yaml, get_character_pairs, run_society_pair
+    from digital_life_project.characters.llm_api.cassette import get_llm_cassette
+    config = load_yaml(config_path)
+    config['replay_dir'] = ''
+    config['save_dir'] = save_dir
+    os.makedirs(save_dir, exist_ok=True)
+    start_time = time.perf_counter()
+    scheduler = run_society_pair(config, get_character_pairs(config)[0], max_steps=max_steps)
+    wall_time = time.perf_counter() - start_time
+    # the behaviors of the run, without their wall-clock times
+    behaviors = {character.name: [node.behavior.get_log_description() for node in character.brain.memory.behavior_list]
+                 for character in scheduler.characters}
+    return {'steps': scheduler.steps, 'wall_time': wall_time, 'cassette': get_llm_cassette().get_stats(), 'behaviors': behaviors}
+
+
+def run_child(mode, args, cassette_path, save_dir):
+    env = dict(os.environ, LLM_SERVICE_TYPE='local-stub', LLM_CASSETTE=cassette_path, LLM_CASSETTE_MODE=mode)
+    output = subprocess.run([sys.executable, __file__, '--child', '--config', args.config, '--max_steps', str(args.max_steps),
+                             '--save_dir', save_dir], env=env, capture_output=True, text=True)
+    if output.returncode != 0:
+        print(output.stderr[-2000:])
+        raise RuntimeError(f"The {mode} run failed")
+    return json.loads(output.stdout.strip().splitlines()[-1])
+
+
+if __name__ == '__main__':
+    argparser = argparse.ArgumentParser()
+    argparser.add_argument('--config', type=str, default='qiqiang_anxin.yaml')
+    argparser.add_argument('--max_steps', type=int, default=12)
+    argparser.add_argument('--save_dir', type=str, default='')
+    argparser.add_argument('--child', action='store_true', help=argparse.SUPPRESS)
+    args = argparser.parse_args()
+
+    config_path = args.config
+    if not os.path.exists(config_path):
+        config_path = os.path.join(os.path.dirname(__file__), '..', 'digital_life_project', 'characters', 'configs', args.config)
+    if args.child:
+        print(json.dumps(run_society(config_path, args.save_dir, args.max_steps)))
+        exit()
+
+    work_dir = tempfile.mkdtemp()
+    cassette_path = os.path.join(work_dir, 'cassette.jsonl')
+    try:
+        record = run_child('record', args, cassette_path, os.path.join(work_dir, 'record'))
+        replay = run_child('replay', args, cassette_path, os.path.join(work_dir, 'replay'))
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    for mode, result in [('record', record), ('replay', replay)]:
+        cassette = result['cassette']
+        print(f"{mode}: {result['steps']} steps in {result['wall_time']:.2f} s, cassette hits {cassette['hits']}, misses {cassette['misses']}, records {cassette['records']}")
+    same = replay['steps'] == record['steps'] and replay['behaviors'] == record['behaviors']
+    print(f"replay matches the recorded run: {same}")
+    if not same:
+        exit(1)
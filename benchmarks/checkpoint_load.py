@@ -0,0 +1,97 @@
+"""
+File: checkpoint_load.py
+Description: Benchmark of loading the memory checkpoints against the pickles they replace
+
+A synthetic memory of a character (behaviors, events, thoughts and relationships of every plot) is
+saved as the id_to_nodes.pkl of older runs and as a checkpoint with the embeddings in the embedding
+store, and each is loaded a few times. The embeddings are random, without LLM calls:
+
+    python benchmarks/checkpoint_load.py --plots 200 --repeats 5
+"""
+import os
+import sys
+import io
+import time
+import pickle
+import shutil
+import argparse
+import datetime
+import tempfile
+import numpy as np
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+os.environ["LLM_SERVICE_TYPE"] = 'local-stub'
+from digital_life_project.society_runner import load_yaml
+from digital_life_project.characters.brain_sys.memory import Memory
+from digital_life_project.characters.brain_sys.checkpoint import dumps_checkpoint, load_checkpoint
+from digital_life_project.characters.brain_sys.psycho_state.plot import Plot
+from digital_life_project.characters.brain_sys.psycho_state.behavior import Behavior
+from digital_life_project.characters.brain_sys.memory_modules.episodic_semantic_memory import Event, Thought
+from digital_life_project.characters.brain_sys.memory_modules.social_memory import Relationship
+
+
+def build_memory(config, name, plots, rounds, dim):
+    rng = np.random.default_rng(0)
+    memory = Memory(name, config)
+    partner_name = [key for key in config['characters_info'].keys() if key != name][0]
+    for plot_id in range(plots):
+        time_now = datetime.datetime.now()
+        memory.add_plot(Plot(self_name=name, plot_id=plot_id, time=time_now, plot_background='background'))
+        for round in range(rounds):
+            for self_name in [name, partner_name]:
+                behavior = Behavior(self_name=self_name, speech='speech', expression='expression', motion='motion',
+                                    time=time_now, round=round, plot_id=plot_id, partner_name=partner_name)
+                behavior.embedding = rng.standard_normal(dim)
+                memory.add_behavior(behavior)
+        memory.add_event(Event(self_name=name, description='event', keywords=['keyword'], embedding=rng.standard_normal(dim), time=time_now, plot_id=plot_id))
+        memory.add_thought(Thought(self_name=name, description='thought', keywords=['keyword'], embedding=rng.standard_normal(dim), time=time_now, plot_id=plot_id))
+        relationship = Relationship(self_name=name, description='relationship', attitude='attitude', intimacy=5, trust=5, supportiveness=5,
+                                    time=time_now, partner_name=partner_name, plot_id=plot_id)
+        relationship.embedding = rng.standard_normal(dim)
+        memory.add_relationship(relationship)
+    return memory
+
+
+def get_legacy_nodes(memory):
+    # the nodes of older runs, with their float64 embeddings in the pickle
+    nodes = pickle.loads(pickle.dumps(memory.id_to_node))
+    for node in nodes.values():
+        for name in ['behavior', 'event', 'thought', 'relationship']:
+            item = getattr(node, name, None)
+            if getattr(item, 'embedding', None) is not None:
+                item.embedding = np.array(item.embedding, dtype=np.float64)
+    return nodes
+
+
+def benchmark(name, data, load, repeats):
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        load(io.BytesIO(data))
+        times.append(time.perf_counter() - start)
+    print(f"{name}: {len(data) / 1024 / 1024:.2f} MB, load {min(times) * 1000:.1f} ms (best of {repeats})")
+    return min(times)
+
+
+if __name__ == '__main__':
+    argparser = argparse.ArgumentParser()
+    argparser.add_argument('--config', type=str, default=os.path.join(os.path.dirname(__file__), '..', 'digital_life_project', 'characters', 'configs', 'old_young.yaml'))
+    argparser.add_argument('--plots', type=int, default=200)
+    argparser.add_argument('--rounds', type=int, default=6)
+    argparser.add_argument('--dim', type=int, default=1536, help='dimension of the embeddings')
+    argparser.add_argument('--repeats', type=int, default=5)
+    args = argparser.parse_args()
+
+    save_dir = tempfile.mkdtemp()
+    config = load_yaml(args.config)
+    config['save_dir'] = save_dir
+    name = list(config['characters_info'].keys())[0]
+    memory = build_memory(config, name, args.plots, args.rounds, args.dim)
+    store = memory.embedding_store
+    print(f"plots: {args.plots}, nodes: {len(memory.id_to_node)}, embeddings: {len(store)}")
+
+    legacy = pickle.dumps(get_legacy_nodes(memory))
+    checkpoint = dumps_checkpoint(memory.id_to_node, store=store)
+    legacy_time = benchmark('pickle (id_to_nodes.pkl)', legacy, pickle.load, args.repeats)
+    checkpoint_time = benchmark('checkpoint', checkpoint, lambda file: load_checkpoint(file, load_embedding=lambda row: (row, store.get(row))), args.repeats)
+    print(f"checkpoint speedup: {legacy_time / checkpoint_time:.2f}x over id_to_nodes.pkl")
+    shutil.rmtree(save_dir, ignore_errors=True)
@@ -0,0 +1,95 @@
+"""
+File: llm_client_pool.py
+Description: Benchmark of LLM client constructions and TCP connections per simulated plot
+
+A local HTTP stand-in server answers the chat completion and embedding endpoints,
+so the benchmark runs without network access:
+
+    python benchmarks/llm_client_pool.py --plots 5 --threads 2
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+from digital_life_project.characters.llm_api.gpt_prompt_base import ChatGPT_request_messages, get_llm_client_stats
+from digital_life_project.characters.llm_api.gpt_prompt_brain import get_embedding
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    connections = 0
+    requests = 0
+    lock = threading.Lock()
+
+    def setup(self):
+        super().setup()
+        with StandInHandler.lock:
+            StandInHandler.connections += 1
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        request = json.loads(self.rfile.read(length) or b'{}')
+        with StandInHandler.lock:
+            StandInHandler.requests += 1
+        if self.path.endswith('/embeddings'):
+            body = {"object": "list", "model": request.get('model', ''),
+                    "data": [{"object": "embedding", "index": i, "embedding": [0.0] * 8} for i in range(len(request['input']))],
+                    "usage": {"prompt_tokens": 1, "total_tokens": 1}}
+        else:
+            body = {"id": "stand-in", "object": "chat.completion", "created": int(time.time()), "model": request.get('model', ''),
+                    "choices": [{"index": 0, "finish_reason": "stop", "message": {"role": "assistant", "content": "{}"}}],
+                    "usage": {"prompt_tokens": 1, "completion_tokens": 1, "total_tokens": 2}}
+        data = json.dumps(body).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def simulate_plot(rounds=6):
+    # one plot: decision + refinement + emotion per round, then five reflection stages
+    for _ in range(rounds):
+        ChatGPT_request_messages("decision")
+        ChatGPT_request_messages("refinement")
+        ChatGPT_request_messages("emotion", json_response=True)
+        get_embedding("behavior")
+        get_embedding("emotion")
+    for _ in range(5):
+        ChatGPT_request_messages("reflection", json_response=True)
+        get_embedding("event")
+
+
+if __name__ == '__main__':
+    argparser = argparse.ArgumentParser()
+    argparser.add_argument('--plots', type=int, default=5)
+    argparser.add_argument('--rounds', type=int, default=6)
+    argparser.add_argument('--threads', type=int, default=2, help='characters simulated in parallel')
+    args = argparser.parse_args()
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StandInHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    os.environ["LLM_SERVICE_TYPE"] = 'openai'
+    os.environ["OPENAI_API_KEY"] = 'stand-in'
+    os.environ["OPENAI_BASE_URL"] = f'http://127.0.0.1:{server.server_address[1]}/v1'
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.threads) as executor:
+        for _ in range(args.plots):
+            list(executor.map(lambda _: simulate_plot(args.rounds), range(args.threads)))
+    elapsed = time.perf_counter() - start
+    server.shutdown()
+
+    plots = args.plots * args.threads
+    stats = get_llm_client_stats()
+    print(f"plots: {plots}, requests: {StandInHandler.requests}, wall time: {elapsed:.3f}s")
+    print(f"client constructions: {stats['constructed']} ({stats['constructed'] / plots:.3f} per plot)")
+    print(f"tcp connections: {StandInHandler.connections} ({StandInHandler.connections / plots:.3f} per plot)")
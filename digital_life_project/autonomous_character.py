@@ -10,6 +10,7 @@ from copy import deepcopy
 import gc
 sys.path.append(os.path.join(os.path.dirname(__file__)))
 from digital_life_project.characters.sociomind import SocioMind
+from digital_life_project.characters.span_tracer import traced
 
 
 class AutonomousCharacter():
@@ -46,6 +47,7 @@ class AutonomousCharacter():
         
         self.current_sensing_info = []
         self.current_observed_info = None
+        self.reflection_pending = False
 
 
     def set_behavior(self, **kwargs):
@@ -75,6 +77,7 @@ class AutonomousCharacter():
             return {}
 
 
+    @traced()
     def sensing(self):
         observed_info = self.get_current_observed_info_hook()
         return observed_info
@@ -129,9 +132,27 @@ class AutonomousCharacter():
 
     # Core step for reaction system
     def reaction(self):
+        behavior_dict = self.interaction()
+        self.introspection()
+        return behavior_dict
+
+
+    # the part of the reaction step that observes the partners or changes what they observe
+    @traced()
+    def interaction(self):
         gc.collect()
+        self.reflection_pending = False
         if self.brain.psycho_state.plot_state == 'end':
             return
+        if self.brain.psycho_state.plot_state == 'plot_finished':
+            # if this plot ends, save the logs and generate new plot proposals
+            # the observed info is dropped by end_plot, so the partners are not sensed
+            print('===', self.name, 'plot_finished')
+            self.brain.end_plot()
+            self.brain.save_current_plot_state()
+            self.log(save_dir=self.brain.config['save_dir'], mode='all')
+            self.brain.plan_plot_proposals()
+            return
         # step 1: sensing
         # gather information from the scene and the interaction partner
         sensing_info = self.sensing()
@@ -153,20 +174,12 @@ class AutonomousCharacter():
                 self.brain.perception()
                 self.brain.memory_query()
                 self.current_decision_instruction = self.brain.decision()
-                self.brain.reflection()
+                self.reflection_pending = True
                 return self.execute()
             else:
                 print('===', self.name, 'reaction', 'working')
                 self.brain.psycho_state.plot_state = 'plot_finished'
-                self.brain.reflection()
-        elif self.brain.psycho_state.plot_state == 'plot_finished':
-            # if this plot ends, save the logs and generate new plot proposals
-            print('===', self.name, 'plot_finished')
-            self.brain.end_plot()
-            self.brain.save_current_plot_state()
-            self.log(save_dir=self.brain.config['save_dir'], mode='all')
-            self.brain.plan_plot_proposals()
-            return
+                self.reflection_pending = True
         elif self.brain.psycho_state.plot_state == 'plan_plot_proposals':
             # if the plot has proposes new plot candiates, start a new plot
             print('===', self.name, 'plan_plot_proposals')
@@ -174,7 +187,23 @@ class AutonomousCharacter():
             return
 
 
+    # the part of the reaction step that only changes the memory and psychological state of the character,
+    # it does not need to finish before the partners' next interaction
+    @traced()
+    def introspection(self):
+        if self.reflection_pending:
+            self.reflection_pending = False
+            self.brain.reflection()
+
+
+    # async entry of the reaction system
+    # the LLM requests of the brain stages are awaited on the event loop of the driver, so a driver can gather several characters
+    async def areaction(self):
+        return await self.brain.areaction()
+
+
     # log the brain memories
+    @traced()
     def log(self, save_dir=None, mode='plot'):
         if save_dir is None:
             logs_path = None
@@ -0,0 +1,356 @@
+"""
+File: checkpoint.py
+Description: Schema-versioned msgpack checkpoints of the memory and psychological state
+
+The replay state (memory log, attributes of each plot) is saved as checkpoint frames instead of
+pickles of the classes. A frame is a header (payload length, schema version) and a msgpack payload
+{'batches': [...], 'root': ...}. The objects of the classes of CHECKPOINT_TYPES (memory nodes and
+psycho states) are stored as record batches, one batch per class and set of fields:
+    [type, fields, count, columns], a column being [kind, data] of one field of the records:
+    - 'datetime': ISO strings
+    - 'array': float arrays of the same shape, as one raw buffer of dtype and shape
+    - 'ref': uint32 records of another batch, as a raw buffer
+    - 'value' / 'nested': any other values, msgpack-encoded ('nested' if they hold records)
+With an EmbeddingStore, a record with an embedding saves its embedding_row instead, the row of the
+embedding in the store, and the embedding is read from the store on load. Such a checkpoint is not
+self-contained: its rows are int64 indices into the store of the character in
+<save_dir>/memory_log/<name>/embeddings, which is copied or kept along with the checkpoint.
+The root is the msgpack-encoded object, where a record is the ext type EXT_RECORD (batch, row),
+a datetime EXT_DATETIME (ISO string) and an array EXT_NDARRAY (dtype, shape, buffer). So a checkpoint
+is read with msgpack and numpy alone, e.g. by running this file on it, without the project, and its
+embedding rows are read from the store next to it.
+
+A frame of an older schema version is upgraded by MIGRATIONS before its objects are built: when a
+checkpoint class changes its fields, bump CHECKPOINT_VERSION and add the migration of the batches
+from the previous version, e.g. with add_checkpoint_field. The runs saved with pickles are
+converted with convert_pickle_plot.
+"""
+import os
+import sys
+import glob
+import struct
+import datetime
+import importlib
+import numpy as np
+import msgpack
+
+
+CHECKPOINT_VERSION = 2
+FRAME_HEADER = struct.Struct('<IH')
+EXT_DATETIME = 1
+EXT_EMBEDDING_ROW = 2
+EXT_RECORD = 3
+EXT_NDARRAY = 4
+RECORD = struct.Struct('<II')
+EMBEDDING_ROW = struct.Struct('<q')
+
+# class name -> module of the class
+CHECKPOINT_TYPES = {
+    'BehaviorNode': 'digital_life_project.characters.brain_sys.memory',
+    'EventNode': 'digital_life_project.characters.brain_sys.memory',
+    'RelationshipNode': 'digital_life_project.characters.brain_sys.memory',
+    'EmotionNode': 'digital_life_project.characters.brain_sys.memory',
+    'CoreselfNode': 'digital_life_project.characters.brain_sys.memory',
+    'MotivationNode': 'digital_life_project.characters.brain_sys.memory',
+    'PlotNode': 'digital_life_project.characters.brain_sys.memory',
+    'TopicNode': 'digital_life_project.characters.brain_sys.memory',
+    'ThoughtNode': 'digital_life_project.characters.brain_sys.memory',
+    'Behavior': 'digital_life_project.characters.brain_sys.psycho_state.behavior',
+    'Coreself': 'digital_life_project.characters.brain_sys.psycho_state.core_self',
+    'Emotion': 'digital_life_project.characters.brain_sys.psycho_state.emotion',
+    'Motivation': 'digital_life_project.characters.brain_sys.psycho_state.motivation',
+    'Personality': 'digital_life_project.characters.brain_sys.psycho_state.personality',
+    'Plot': 'digital_life_project.characters.brain_sys.psycho_state.plot',
+    'Topic': 'digital_life_project.characters.brain_sys.psycho_state.plot',
+    'Event': 'digital_life_project.characters.brain_sys.memory_modules.episodic_semantic_memory',
+    'Thought': 'digital_life_project.characters.brain_sys.memory_modules.episodic_semantic_memory',
+    'Relationship': 'digital_life_project.characters.brain_sys.memory_modules.social_memory',
+}
+
+# version -> function upgrading the batches of that version to the next one
+MIGRATIONS = {}
+
+_checkpoint_classes = {}
+
+
+def get_checkpoint_class(name):
+    if name not in _checkpoint_classes:
+        if name not in CHECKPOINT_TYPES:
+            raise ValueError(f"Unknown checkpoint type {name}")
+        _checkpoint_classes[name] = getattr(importlib.import_module(CHECKPOINT_TYPES[name]), name)
+    return _checkpoint_classes[name]
+
+
+def set_embedding_row(obj, store):
+    # the embedding of obj is added to the store on its first save, or when it was replaced after
+    embedding = obj.__dict__.get('embedding')
+    if not store.is_embedding(embedding):
+        return False
+    if not store.is_row_view(obj.__dict__.get('embedding_row'), embedding):
+        obj.embedding_row = store.add(embedding)
+        obj.embedding = store.get(obj.embedding_row)
+    return True
+
+
+def collect_records(root, store=None):
+    """
+    Group the checkpoint objects reachable from root in batches of the same class and fields.
+    With a store, the embedding of an object is saved as its embedding_row.
+    Return the batches [type, fields, objects] and the (batch, row) of each object id.
+    """
+    batches = []
+    batch_indices = {}
+    records = {}
+    stack = [root]
+    while len(stack) > 0:
+        value = stack.pop()
+        value_type = type(value)
+        if value_type in [list, tuple]:
+            stack.extend(value[::-1])
+        elif value_type is dict:
+            stack.extend(list(value.values())[::-1])
+        elif value_type.__name__ in CHECKPOINT_TYPES and id(value) not in records:
+            fields = tuple(value.__dict__.keys())
+            if store is not None and set_embedding_row(value, store):
+                fields = tuple(field for field in fields if field != 'embedding')
+            key = (value_type.__name__, fields)
+            if key not in batch_indices:
+                batch_indices[key] = len(batches)
+                batches.append([value_type.__name__, fields, []])
+            batch = batches[batch_indices[key]]
+            records[id(value)] = (batch_indices[key], len(batch[2]))
+            batch[2].append(value)
+            stack.extend(list(value.__dict__.values())[::-1])
+    return batches, records
+
+
+class CheckpointEncoder:
+    def __init__(self, records):
+        self.records = records
+        self.has_records = False
+
+    def default(self, value):
+        if isinstance(value, datetime.datetime):
+            return msgpack.ExtType(EXT_DATETIME, value.isoformat().encode())
+        if isinstance(value, np.ndarray):
+            return msgpack.ExtType(EXT_NDARRAY, msgpack.packb([value.dtype.str, list(value.shape), np.ascontiguousarray(value).tobytes()]))
+        if isinstance(value, np.generic):
+            return value.item()
+        if id(value) in self.records:
+            self.has_records = True
+            return msgpack.ExtType(EXT_RECORD, RECORD.pack(*self.records[id(value)]))
+        raise TypeError(f"{type(value).__name__} is not a checkpoint type")
+
+    def packb(self, value):
+        self.has_records = False
+        return msgpack.packb(value, default=self.default)
+
+    def encode_column(self, values):
+        if all(type(value) is datetime.datetime for value in values):
+            return ['datetime', [value.isoformat() for value in values]]
+        if all(isinstance(value, np.ndarray) for value in values):
+            if len(set((value.dtype.str, value.shape) for value in values)) == 1:
+                return ['array', values[0].dtype.str, list(values[0].shape), np.stack(values).tobytes()]
+        if all(id(value) in self.records for value in values):
+            batches = set(self.records[id(value)][0] for value in values)
+            if len(batches) == 1:
+                return ['ref', batches.pop(), np.array([self.records[id(value)][1] for value in values], dtype=np.uint32).tobytes()]
+        data = self.packb(values)
+        return ['nested' if self.has_records else 'value', data]
+
+
+def dumps_checkpoint(obj, store=None):
+    """
+    Encode obj as a checkpoint frame, with its embeddings as rows of the store if any.
+    """
+    batches, records = collect_records(obj, store=store)
+    encoder = CheckpointEncoder(records)
+    payload = {
+        'batches': [[name, list(fields), len(objects), [encoder.encode_column([item.__dict__[field] for item in objects]) for field in fields]]
+                    for name, fields, objects in batches],
+        'root': encoder.packb(obj),
+    }
+    payload = msgpack.packb(payload)
+    return FRAME_HEADER.pack(len(payload), CHECKPOINT_VERSION) + payload
+
+
+def get_ext_hook(objects=None, load_embedding=None):
+    # without the objects and load_embedding, records and embeddings stay (batch, row) and row
+    # (the embeddings of version 1 are rows outside the records too)
+    def ext_hook(code, data):
+        if code == EXT_RECORD:
+            batch, row = RECORD.unpack(data)
+            return objects[batch][row] if objects is not None else (batch, row)
+        if code == EXT_DATETIME:
+            return datetime.datetime.fromisoformat(data.decode())
+        if code == EXT_EMBEDDING_ROW:
+            row = EMBEDDING_ROW.unpack(data)[0]
+            return load_embedding(row)[1] if load_embedding is not None else row
+        if code == EXT_NDARRAY:
+            dtype, shape, buffer = msgpack.unpackb(data)
+            return np.frombuffer(buffer, dtype=dtype).reshape(shape).copy()
+        return msgpack.ExtType(code, data)
+    return ext_hook
+
+
+def decode_column(column, count, objects=None, load_embedding=None):
+    kind = column[0]
+    if kind == 'datetime':
+        return list(map(datetime.datetime.fromisoformat, column[1]))
+    if kind == 'array':
+        return list(np.frombuffer(column[3], dtype=column[1]).reshape([count] + column[2]).copy())
+    if kind == 'ref':
+        rows = np.frombuffer(column[2], dtype=np.uint32).tolist()
+        return list(map(objects[column[1]].__getitem__, rows)) if objects is not None else [(column[1], row) for row in rows]
+    return msgpack.unpackb(column[1], ext_hook=get_ext_hook(objects, load_embedding), strict_map_key=False)
+
+
+def add_checkpoint_field(batches, name, field, value):
+    """
+    Migration helper: add a field of the same value to the records of a class.
+    """
+    for batch in batches:
+        if batch[0] == name and field not in batch[1]:
+            batch[1].append(field)
+            batch[3].append(['value', msgpack.packb([value] * batch[2])])
+    return batches
+
+
+def migrate_embedding_rows(batches):
+    # version 1 -> 2: the embedding columns of store rows become the embedding_row of the records
+    for batch in batches:
+        fields, columns = batch[1], batch[3]
+        if 'embedding' in fields and columns[fields.index('embedding')][0] == 'embedding':
+            index = fields.index('embedding')
+            fields[index] = 'embedding_row'
+            columns[index] = ['value', msgpack.packb(np.frombuffer(columns[index][1], dtype=np.int64).tolist())]
+    return batches
+
+
+MIGRATIONS[1] = migrate_embedding_rows
+
+
+def migrate_batches(batches, version):
+    if version > CHECKPOINT_VERSION:
+        raise ValueError(f"Checkpoint version {version} is newer than {CHECKPOINT_VERSION}")
+    while version < CHECKPOINT_VERSION:
+        if version not in MIGRATIONS:
+            raise ValueError(f"No migration of checkpoint version {version}")
+        batches = MIGRATIONS[version](batches)
+        version += 1
+    return batches
+
+
+def read_frame(file):
+    header = file.read(FRAME_HEADER.size)
+    if len(header) == 0:
+        raise EOFError("End of the checkpoint")
+    if len(header) < FRAME_HEADER.size:
+        raise ValueError("Truncated checkpoint frame")
+    length, version = FRAME_HEADER.unpack(header)
+    payload = file.read(length)
+    if len(payload) < length:
+        raise ValueError("Truncated checkpoint frame")
+    return version, msgpack.unpackb(payload)
+
+
+def load_checkpoint(file, load_embedding=None):
+    """
+    Read the next frame of file, load_embedding(row) returns the (row, embedding) of a row of the store,
+    the row in the store of the run the embedding was copied to, if any.
+    """
+    version, payload = read_frame(file)
+    batches = migrate_batches(payload['batches'], version)
+    objects = []
+    for name, fields, count, columns in batches:
+        cls = get_checkpoint_class(name)
+        objects.append([cls.__new__(cls) for _ in range(count)])
+    for (name, fields, count, columns), batch_objects in zip(batches, objects):
+        fields = [sys.intern(field) for field in fields]
+        values = [decode_column(column, count, objects, load_embedding) for column in columns]
+        for obj, record in zip(batch_objects, zip(*values)):
+            obj.__dict__.update(zip(fields, record))
+        if 'embedding_row' in fields and 'embedding' not in fields and load_embedding is not None:
+            for obj in batch_objects:
+                if obj.embedding_row is not None:
+                    obj.embedding_row, obj.embedding = load_embedding(obj.embedding_row)
+    return msgpack.unpackb(payload['root'], ext_hook=get_ext_hook(objects, load_embedding), strict_map_key=False)
+
+
+def find_embedding_store(path):
+    # the store of a file of the memory log (memory_log/<name>/embeddings) or of a plot (<plot>/<name>)
+    checkpoint_dir = os.path.dirname(os.path.abspath(path))
+    for store_dir in [os.path.join(checkpoint_dir, 'embeddings'),
+                      os.path.join(os.path.dirname(os.path.dirname(checkpoint_dir)), 'memory_log', os.path.basename(checkpoint_dir), 'embeddings')]:
+        if os.path.exists(os.path.join(store_dir, 'meta.npy')):
+            return store_dir
+    return None
+
+
+def get_store_embedding_loader(store_dir):
+    """
+    load_embedding(row) of the embedding store in store_dir, read with numpy alone as EmbeddingStore writes it.
+    """
+    count = int(np.load(os.path.join(store_dir, 'meta.npy'))[0])
+    chunks = [np.load(chunk_path, mmap_mode='r') for chunk_path in sorted(glob.glob(os.path.join(store_dir, 'embeddings_*.npy')))]
+
+    def load_embedding(row):
+        if not 0 <= row < count:
+            raise IndexError(f"Embedding row {row} is not in the store {store_dir} of {count} rows")
+        chunk_rows = len(chunks[0])
+        return row, np.array(chunks[row // chunk_rows][row % chunk_rows])
+    return load_embedding
+
+
+def iter_checkpoint_records(path, store_dir=None):
+    """
+    The version, records (type, fields) and root of every frame of a checkpoint file, without the project.
+    The frames are migrated to CHECKPOINT_VERSION, and the embedding_row of the records is read as their
+    embedding from the embedding store in store_dir, by default the store of the character next to path.
+    Without a store, the rows are kept as they are.
+    """
+    store_dir = store_dir or find_embedding_store(path)
+    load_embedding = get_store_embedding_loader(store_dir) if store_dir is not None else None
+    with open(path, 'rb') as f:
+        while True:
+            try:
+                version, payload = read_frame(f)
+            except EOFError:
+                return
+            records = []
+            for name, fields, count, columns in migrate_batches(payload['batches'], version):
+                values = [decode_column(column, count, load_embedding=load_embedding) for column in columns]
+                for record in zip(*values):
+                    record = dict(zip(fields, record))
+                    if load_embedding is not None and record.get('embedding_row') is not None and 'embedding' not in record:
+                        record['embedding'] = load_embedding(record['embedding_row'])[1]
+                    records.append((name, record))
+            yield version, records, msgpack.unpackb(payload['root'], ext_hook=get_ext_hook(load_embedding=load_embedding), strict_map_key=False)
+
+
+def convert_pickle_plot(plot_dir, name):
+    """
+    Convert the pickles of a character in a plot saved before the checkpoints (attributes.pkl and
+    id_to_nodes.pkl in plot_dir) to attributes.ckpt and id_to_nodes.ckpt, with the embeddings in the
+    embedding store of the run.
+    """
+    from digital_life_project.characters.brain_sys.memory_modules.embedding_store import EmbeddingStore, load_with_embeddings
+    store = EmbeddingStore(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(plot_dir))), 'memory_log', name, 'embeddings'))
+    for filename in ['attributes', 'id_to_nodes']:
+        path = os.path.join(plot_dir, filename + '.pkl')
+        if not os.path.exists(path):
+            continue
+        with open(path, 'rb') as f:
+            data = dumps_checkpoint(load_with_embeddings(f, store.get), store=store)
+        store.flush()
+        with open(os.path.join(plot_dir, filename + '.ckpt'), 'wb') as f:
+            f.write(data)
+
+
+if __name__ == '__main__':
+    # python checkpoint.py <file> [<store_dir>]: print the records and root of every frame of a checkpoint
+    for version, records, root in iter_checkpoint_records(sys.argv[1], store_dir=sys.argv[2] if len(sys.argv) > 2 else None):
+        print(f"version {version}, {len(records)} records")
+        for record in records:
+            print(record)
+        print("root:", root)
@@ -8,20 +8,28 @@ import datetime
 from typing import Any
 import numpy as np
 import os
-import pickle
+import threading
 from digital_life_project.characters.brain_sys.psycho_state.behavior import Behavior
 from digital_life_project.characters.brain_sys.memory_modules.social_memory import Relationship
 from digital_life_project.characters.brain_sys.psycho_state.plot import Plot, Topic
 from digital_life_project.characters.brain_sys.memory_modules.episodic_semantic_memory import Event, Thought
 from digital_life_project.characters.brain_sys.memory_modules.cognition_map import CognitionMap
+from digital_life_project.characters.brain_sys.memory_modules.retrieval_index import RetrievalIndex
+from digital_life_project.characters.brain_sys.memory_modules.memory_log import MemoryLog, load_memory_log, get_node_state, get_lazy_retrieval_entry
+from digital_life_project.characters.brain_sys.memory_modules.embedding_store import EmbeddingStore, load_with_embeddings
+from digital_life_project.characters.brain_sys.checkpoint import dumps_checkpoint, load_checkpoint
 from digital_life_project.characters.brain_sys.psycho_state.emotion import Emotion
 from digital_life_project.characters.brain_sys.psycho_state.core_self import Coreself
 from digital_life_project.characters.brain_sys.psycho_state.motivation import Motivation
+from digital_life_project.characters.span_tracer import traced
 from wordcloud import WordCloud
 import matplotlib.pyplot as plt
 from matplotlib.font_manager import FontProperties
 
 
+# pyplot keeps the current figure in a global state, so the characters draw their teasers one at a time
+pyplot_lock = threading.Lock()
+
 
 class BehaviorNode:
   def __init__(self, node_id, node_count, type_count, created, expiration, behavior: Behavior,
@@ -153,6 +161,13 @@ class ThoughtNode:
         self.event_node_ids = []
 
 
+def load_memory_file(file, load_embedding):
+    # the checkpoint files end with .ckpt, the others are pickles of older runs
+    if getattr(file, 'name', '').endswith('.ckpt'):
+        return load_checkpoint(file, load_embedding=load_embedding)
+    return load_with_embeddings(file, lambda row: load_embedding(row)[1])
+
+
 class Memory:
     def __init__(self, name, config):
         self.name = name
@@ -174,16 +189,109 @@ class Memory:
         self.motivation_list = []       
         self.topic_list = []       
         self.current_plot_id = -1
+        self.init_retrieval_indices()
+        # nodes added and changed since the last batch of the memory log
+        self.memory_log = None
+        self.new_node_ids = []
+        self.changed_node_ids = set()
+        # embeddings of the nodes, memory-mapped from the save_dir
+        self.embedding_store = None
+        if config.get('save_dir', '') != '':
+            self.embedding_store = EmbeddingStore(os.path.join(config['save_dir'], 'memory_log', name, 'embeddings'))
+        # embedding stores of the loaded replays, with the rows copied from them
+        self.loaded_embedding_stores = {}
         
         self.init_relationships(config['characters_info'][self.name]['relationships'])
         
         
+    def get_memory_log_dir(self, plot_dir):
+        # <save_dir>/plot_N/<name> -> <save_dir>/memory_log/<name>
+        return os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(plot_dir))), 'memory_log', self.name)
+    
+    
+    def store_embedding(self, item):
+        # keep the embedding of an item as a row of the embedding store
+        if self.embedding_store is not None and self.embedding_store.is_embedding(getattr(item, 'embedding', None)):
+            item.embedding_row = self.embedding_store.add(item.embedding)
+            item.embedding = self.embedding_store.get(item.embedding_row)
+    
+    
+    def dumps(self, obj, flush=True):
+        # a checkpoint frame with the embeddings as rows of the embedding store
+        data = dumps_checkpoint(obj, store=self.embedding_store)
+        if flush:
+            self.flush_embeddings()
+        return data
+    
+    
+    def flush_embeddings(self):
+        if self.embedding_store is not None:
+            self.embedding_store.flush()
+    
+    
+    def get_embedding_row_loader(self, log_dir):
+        """
+        Return a load_embedding(row) of the rows of the memory log in log_dir, the (row, embedding) in this run.
+        The rows are copied once from the store of that log into the embedding store of this run.
+        """
+        store_dir = os.path.abspath(os.path.join(log_dir, 'embeddings'))
+        if self.embedding_store is not None and store_dir == os.path.abspath(self.embedding_store.store_dir):
+            return lambda row: (row, self.embedding_store.get(row))
+        if store_dir not in self.loaded_embedding_stores:
+            self.loaded_embedding_stores[store_dir] = (EmbeddingStore(store_dir, readonly=True), {})
+        source_store, loaded_rows = self.loaded_embedding_stores[store_dir]
+        
+        def load_embedding(row):
+            if row not in loaded_rows:
+                embedding = source_store.get(row)
+                if self.embedding_store is not None:
+                    new_row = self.embedding_store.add(embedding)
+                    loaded_rows[row] = (new_row, self.embedding_store.get(new_row))
+                else:
+                    loaded_rows[row] = (None, np.array(embedding))
+            return loaded_rows[row]
+        return load_embedding
+    
+    
+    def get_embedding_loader(self, log_dir):
+        # a load(file) of the checkpoints of the memory log in log_dir, or of the pickles of older runs
+        load_embedding = self.get_embedding_row_loader(log_dir)
+        return lambda file: load_memory_file(file, load_embedding)
+    
+    
+    def mark_node_changed(self, node_id):
+        self.changed_node_ids.add(node_id)
+    
+    
+    def pop_memory_records(self):
+        new_node_ids = set(self.new_node_ids)
+        for index in [self.event_index, self.thought_index]:
+            for node in index.pop_changed_nodes():
+                self.changed_node_ids.add(node.node_id)
+        records = [('insert', self.id_to_node[node_id]) for node_id in self.new_node_ids]
+        records += [('update', node_id, get_node_state(self.id_to_node[node_id]))
+                    for node_id in sorted(self.changed_node_ids) if node_id not in new_node_ids]
+        self.new_node_ids = []
+        self.changed_node_ids = set()
+        return records
+    
+    
+    @traced('save_memory_state', 'io')
     def save_current_plot_state(self, save_dir=''):
-        node_path = os.path.join(save_dir, 'id_to_nodes.pkl')
-        with open(node_path, 'wb') as file:
-            pickle.dump(self.id_to_node, file)
+        # one batch of the nodes added and changed in this plot, or a snapshot every memory_snapshot_interval plots
+        if self.memory_log is None:
+            log_dir = self.get_memory_log_dir(save_dir)
+            self.memory_log = MemoryLog(log_dir, snapshot_interval=self.config.get('memory_snapshot_interval', 10),
+                                        dumps=lambda obj: self.dumps(obj, flush=False), load=self.get_embedding_loader(log_dir),
+                                        flush=self.flush_embeddings, extension='.ckpt')
+        if self.memory_log.needs_snapshot():
+            self.memory_log.write_snapshot(self.id_to_node)
+            self.pop_memory_records()
+        else:
+            self.memory_log.append(self.pop_memory_records())
         
         saved_attrs = {}
+        saved_attrs['memory_log_lsn'] = self.memory_log.lsn
         for name in ['event_list', 'manual_event_list', 'behavior_list', 'thought_list', 'plot_list', 'emotion_list', 'core_self_list', 'motivation_list', 'topic_list']:
             saved_attrs[name] = []
             for item in getattr(self, name):
@@ -201,9 +309,21 @@ class Memory:
     
     
     def load_current_plot_state(self, saved_attrs, load_dir=''):
-        node_path = os.path.join(load_dir, 'id_to_nodes.pkl')
-        with open(node_path, 'rb') as file:
-            self.id_to_node = pickle.load(file)
+        log_dir = self.get_memory_log_dir(load_dir)
+        if 'memory_log_lsn' in saved_attrs:
+            # a lazy replay reads the nodes of the snapshot on first access
+            cache_nodes = self.config.get('lazy_replay_cache_nodes', 1024) if self.config.get('lazy_replay', False) else 0
+            self.id_to_node = load_memory_log(log_dir, saved_attrs['memory_log_lsn'], load=self.get_embedding_loader(log_dir), cache_nodes=cache_nodes)
+        else:
+            # plots saved before the memory log, or converted by convert_pickle_plot
+            node_path = os.path.join(load_dir, 'id_to_nodes.ckpt')
+            if not os.path.exists(node_path):
+                node_path = os.path.join(load_dir, 'id_to_nodes.pkl')
+            with open(node_path, 'rb') as file:
+                self.id_to_node = self.get_embedding_loader(log_dir)(file)
+        # the log of the new run starts with a snapshot of the loaded memory
+        self.new_node_ids = []
+        self.changed_node_ids = set()
         
         for name in ['event_list', 'manual_event_list', 'behavior_list', 'thought_list', 'plot_list', 'emotion_list', 'core_self_list', 'motivation_list', 'topic_list']:
             setattr(self, name, [])
@@ -220,7 +340,32 @@ class Memory:
         self.plot_id_to_node = {}
         for key in saved_attrs['plot_id_to_node'].keys():
             self.plot_id_to_node[key] = self.id_to_node[saved_attrs['plot_id_to_node'][key]]
+        
+        self.init_retrieval_indices()
+        load_embedding = self.get_embedding_row_loader(log_dir)
+        for event_node in self.event_list[::-1]:
+            self.add_to_retrieval_index(self.event_index, event_node, load_embedding)
+        for event_node in self.manual_event_list[::-1]:
+            self.add_to_retrieval_index(self.event_index, event_node, load_embedding, manual=True)
+        for thought_node in self.thought_list[::-1]:
+            self.add_to_retrieval_index(self.thought_index, thought_node, load_embedding)
         return
+    
+    
+    def add_to_retrieval_index(self, index, node, load_embedding, manual=False):
+        # a lazy node not read yet is indexed from the snapshot index, so the replay reads no event or thought
+        entry = get_lazy_retrieval_entry(node, index.item_name)
+        if entry is None:
+            index.add(node, manual=manual)
+            return
+        plot_id, poignancy, access_times, forgot, embedding_row = entry
+        index.add_fields(node, plot_id, poignancy, access_times, forgot, load_embedding(embedding_row)[1], manual=manual)
+    
+    
+    def init_retrieval_indices(self):
+        # same parameters of forgetting curve as Event.get_score_from_embedding and Thought.get_score_from_embedding
+        self.event_index = RetrievalIndex('event', a=0.1, importance_base=3, k_per_plot=4, threshold=0.3)
+        self.thought_index = RetrievalIndex('thought', a=0.4, importance_base=3, k_per_plot=2, threshold=0.6)
         
     
     def init_relationships(self, dicts):
@@ -243,6 +388,7 @@ class Memory:
         
         self.plot_list[0:0] = [plot_node]
         self.id_to_node[node_id] = plot_node
+        self.new_node_ids.append(node_id)
         self.plot_id_to_node[plot_id] = plot_node
         self.current_plot_id = plot_id
         return plot_node
@@ -255,8 +401,12 @@ class Memory:
         event_node = EventNode(node_id, node_count, type_count, created, None, event, plot_id=event.plot_id)
         self.event_list[0:0] = [event_node]
         self.id_to_node[node_id] = event_node
+        self.store_embedding(event)
+        self.new_node_ids.append(node_id)
+        self.event_index.add(event_node)
         plot = self.plot_id_to_node[event.plot_id]
         plot.event_node_ids[0:0] = [node_id]
+        self.mark_node_changed(plot.node_id)
         if len(behavior_ids) > 0:
             event_node.behavior_node_ids = behavior_ids
         return event_node
@@ -269,6 +419,9 @@ class Memory:
         event_node = EventNode(node_id, node_count, type_count, created, None, event, plot_id=event.plot_id)
         self.manual_event_list[0:0] = [event_node]
         self.id_to_node[node_id] = event_node
+        self.store_embedding(event)
+        self.new_node_ids.append(node_id)
+        self.event_index.add(event_node, manual=True)
         return event_node
     
     
@@ -280,10 +433,14 @@ class Memory:
         thought_node = ThoughtNode(node_id, node_count, type_count, created, None, thought, plot_id=thought.plot_id)
         self.thought_list[0:0] = [thought_node]
         self.id_to_node[node_id] = thought_node
+        self.store_embedding(thought)
+        self.new_node_ids.append(node_id)
+        self.thought_index.add(thought_node)
         thought_node.event_node_ids = event_ids
         
         plot = self.plot_id_to_node[thought.plot_id]
         plot.thought_node_ids[0:0] = [node_id] 
+        self.mark_node_changed(plot.node_id)
         return thought_node
         
     
@@ -301,14 +458,19 @@ class Memory:
             if self.id_to_node[plot.behavior_node_ids[j]].behavior.self_name == behavior.self_name and last_self_node_id == -1: 
                 last_self_node_id = plot.behavior_node_ids[j]
                 self.id_to_node[plot.behavior_node_ids[j]].next_self_node_id = node_id
+                self.mark_node_changed(last_self_node_id)
             if self.id_to_node[plot.behavior_node_ids[j]].behavior.self_name != behavior.self_name and last_partner_node_id == -1:
                 last_partner_node_id = plot.behavior_node_ids[j]
                 self.id_to_node[plot.behavior_node_ids[j]].next_partner_node_id = node_id
+                self.mark_node_changed(last_partner_node_id)
         behavior_node = BehaviorNode(node_id, node_count, type_count, created, None, behavior, 
                                      last_self_node_id=last_self_node_id, last_partner_node_id=last_partner_node_id)
         self.behavior_list[0:0] = [behavior_node]
         self.id_to_node[node_id] = behavior_node        
+        self.store_embedding(behavior)
+        self.new_node_ids.append(node_id)
         plot.behavior_node_ids[0:0] = [node_id]
+        self.mark_node_changed(plot.node_id)
         return behavior_node
     
     
@@ -329,10 +491,13 @@ class Memory:
         self.relationship_dicts[relationship.partner_name][0:0] = [relationship_node]
         
         self.id_to_node[node_id] = relationship_node
+        self.store_embedding(relationship)
+        self.new_node_ids.append(node_id)
         if relationship.plot_id == -1:
             return relationship_node
         plot = self.plot_id_to_node[relationship.plot_id]
         plot.relationship_node_ids[0:0] = [node_id]
+        self.mark_node_changed(plot.node_id)
         return relationship_node
    
 
@@ -343,11 +508,14 @@ class Memory:
         created = emotion.time
         emotion_node = EmotionNode(node_id, node_count, type_count, created, None, emotion, plot_id=emotion.plot_id)
         self.id_to_node[node_id] = emotion_node
+        self.store_embedding(emotion)
+        self.new_node_ids.append(node_id)
         if emotion.plot_id == -1:
             return emotion_node
         self.emotion_list[0:0] = [emotion_node]
         plot = self.plot_id_to_node[emotion.plot_id]
         plot.emotion_node_ids[0:0] = [node_id]
+        self.mark_node_changed(plot.node_id)
         return emotion_node
 
     
@@ -358,10 +526,13 @@ class Memory:
         created = coreself.time
         coreself_node = CoreselfNode(node_id, node_count, type_count, created, None, coreself, plot_id=coreself.plot_id)
         self.id_to_node[node_id] = coreself_node
+        self.store_embedding(coreself)
+        self.new_node_ids.append(node_id)
         if coreself.plot_id == -1:
             return coreself_node
         plot = self.plot_id_to_node[coreself.plot_id]
         plot.core_self_node_ids[0:0] = [node_id]
+        self.mark_node_changed(plot.node_id)
         return coreself_node
 
     
@@ -372,11 +543,14 @@ class Memory:
         created = motivation.time
         motivation_node = MotivationNode(node_id, node_count, type_count, created, None, motivation, plot_id=motivation.plot_id)
         self.id_to_node[node_id] = motivation_node
+        self.store_embedding(motivation)
+        self.new_node_ids.append(node_id)
         if motivation.plot_id == -1:
             return motivation_node
         self.motivation_list[0:0] = [motivation_node]
         plot = self.plot_id_to_node[motivation.plot_id]
         plot.motivation_node_ids[0:0] = [node_id]
+        self.mark_node_changed(plot.node_id)
         return motivation_node
     
     
@@ -388,32 +562,35 @@ class Memory:
         topic_node = TopicNode(node_id, node_count, type_count, created, None, topic, plot_id=topic.used_plot_id)
         self.topic_list[0:0] = [topic_node]
         self.id_to_node[node_id] = topic_node
+        self.new_node_ids.append(node_id)
         plot = self.plot_id_to_node[topic.used_plot_id]
         plot.topic_node_ids[0:0] = [node_id]
+        self.mark_node_changed(plot.node_id)
         return topic_node
 
     
     def retrieve_thoughts_by_embedding(self, embedding, topk=3):
+        thought_lists, _ = self.retrieve_thoughts_by_embeddings([embedding], topk=topk)
+        return thought_lists[0]
+    
+    
+    @traced('thought_retrieval', 'memory')
+    def retrieve_thoughts_by_embeddings(self, embeddings, topk=3):
+        """
+        Retrieve the thoughts of a batch of query embeddings, in the order of the queries.
+        Return the thought list of each query and the union of them without duplicates.
+        """
         # use embedding scores to rank the thoughts
-        scores = []
-        node_ids = []
-        for thought in self.thought_list:
-            if not thought.thought.forgot:
-                scores.append(thought.thought.get_score_from_embedding(embedding, self.current_plot_id))
-                node_ids.append(thought.node_id)
-                
-        scores = np.array(scores)
-        node_ids = np.array(node_ids)
-        thought_list = []
-        if len(scores) > 0:
-            topk_index = np.argsort(scores)[-topk:]
-            for id in topk_index:
-                thought_list.append(self.id_to_node[node_ids[id]])
-                self.id_to_node[node_ids[id]].last_accessed = datetime.datetime.now()
-                self.id_to_node[node_ids[id]].thought.mark_accessed()
-            return thought_list
-        else:
-            return []
+        rows = self.thought_index.get_candidate_rows()
+        if len(embeddings) == 0 or len(rows) == 0:
+            return [[] for _ in embeddings], []
+        thought_lists = []
+        for topk_rows in self.thought_index.get_topk_rows_of_queries(embeddings, rows, self.current_plot_id, topk, mark_accessed=True):
+            thought_list = [self.thought_index.nodes[row] for row in topk_rows]
+            for thought in thought_list:
+                thought.last_accessed = datetime.datetime.now()
+            thought_lists.append(thought_list)
+        return thought_lists, list(dict.fromkeys(thought for thought_list in thought_lists for thought in thought_list))
         
         
     def get_events_from_plot(self, plot_id, manual=True):
@@ -448,28 +625,24 @@ class Memory:
     
         
     def retrieve_events_by_embedding(self, embedding, plot_id, manual=True, topk=3):
-        scores = []
-        node_ids = []
+        event_lists, _ = self.retrieve_events_by_embeddings([embedding], plot_id, manual=manual, topk=topk)
+        return event_lists[0]
+    
+    
+    @traced('event_retrieval', 'memory')
+    def retrieve_events_by_embeddings(self, embeddings, plot_id, manual=True, topk=3):
+        """
+        Retrieve the events of a batch of query embeddings, in the order of the queries.
+        Return the event list of each query and the union of them without duplicates.
+        """
         # use embedding scores to rank the events
-        if manual:
-            all_event_list = self.event_list + self.manual_event_list
-        else:
-            all_event_list = self.event_list
-        for event in all_event_list:
-            if not event.event.forgot and event.plot_id != self.current_plot_id:
-                scores.append(event.event.get_score_from_embedding(embedding, plot_id))
-                node_ids.append(event.node_id)
-            
-        scores = np.array(scores)
-        node_ids = np.array(node_ids)
-        event_list = []
-        if len(scores) > 0:
-            topk_index = np.argsort(scores)[-topk:]
-            for id in topk_index:
-                event_list.append(self.id_to_node[node_ids[id]])
-        else:
-            return []
-        return event_list
+        rows = self.event_index.get_candidate_rows(manual=manual, exclude_plot_id=self.current_plot_id)
+        if len(embeddings) == 0 or len(rows) == 0:
+            return [[] for _ in embeddings], []
+        event_lists = []
+        for topk_rows in self.event_index.get_topk_rows_of_queries(embeddings, rows, plot_id, topk):
+            event_lists.append([self.event_index.nodes[row] for row in topk_rows])
+        return event_lists, list(dict.fromkeys(event for event_list in event_lists for event in event_list))
     
     def get_latest_behaviors(self, retention=6):
         ret_behaviors = []
@@ -704,6 +877,12 @@ class Memory:
             
 
     def save_teaser(self, save_dir=""):
+        with pyplot_lock:
+            self.draw_teaser(save_dir=save_dir)
+    
+    
+    @traced('plotting', 'io')
+    def draw_teaser(self, save_dir=""):
         font = FontProperties(fname=self.config['Arial_path'], size=12)
         large_font = FontProperties(fname=self.config['Arial_path'], size=14)
 
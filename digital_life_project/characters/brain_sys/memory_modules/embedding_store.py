@@ -0,0 +1,105 @@
+"""
+File: embedding_store.py
+Description: Columnar store of the embeddings of a character, memory-mapped from the save_dir
+
+The embeddings of the memory nodes and psycho states are the bulk of every pickled plot. They are
+kept once in a float32 columnar store instead. An item keeps its row in embedding_row, and its
+embedding is a view of that row:
+    - meta.npy: [count, dim], written after the rows it counts
+    - embeddings_<chunk>.npy: float32 matrix of CHUNK_ROWS rows each, so the store grows without copies
+The store of a character is in <save_dir>/memory_log/<name>/embeddings. The checkpoints of the memory
+save the embedding_row of an item instead of its embedding (a persistent id in the pickles of older
+runs), and the rows of a loaded replay are copied into the store of the new run.
+"""
+import os
+import pickle
+import threading
+import numpy as np
+
+
+CHUNK_ROWS = 1024
+
+
+class EmbeddingStore:
+    def __init__(self, store_dir, readonly=False):
+        self.store_dir = store_dir
+        self.readonly = readonly
+        self.lock = threading.Lock()
+        self.chunks = []
+        # plain ndarray views of the memory-mapped chunks, indexed without the overhead of np.memmap
+        self.chunk_arrays = []
+        self.count = 0
+        self.flushed_count = 0
+        self.dim = None
+        if not readonly:
+            os.makedirs(store_dir, exist_ok=True)
+        if os.path.exists(self.get_path('meta')):
+            meta = np.load(self.get_path('meta'))
+            self.count, self.dim = int(meta[0]), int(meta[1])
+            self.flushed_count = self.count
+            chunk_num = (self.count + CHUNK_ROWS - 1) // CHUNK_ROWS
+            self.chunks = [np.load(self.get_path(f'embeddings_{chunk:06d}'), mmap_mode='r' if readonly else 'r+') for chunk in range(chunk_num)]
+            self.chunk_arrays = [chunk.view(np.ndarray) for chunk in self.chunks]
+
+    def get_path(self, name):
+        return os.path.join(self.store_dir, name + '.npy')
+
+    def __len__(self):
+        return self.count
+
+    def get(self, row):
+        return self.chunk_arrays[row // CHUNK_ROWS][row % CHUNK_ROWS]
+
+    def add(self, embedding):
+        """
+        Append an embedding and return its row, get(row) is its float32 view into the store.
+        """
+        embedding = np.asarray(embedding, dtype=np.float32).reshape(-1)
+        with self.lock:
+            if self.dim is None:
+                self.dim = embedding.shape[0]
+            row = self.count
+            if row // CHUNK_ROWS == len(self.chunks):
+                self.chunks.append(np.lib.format.open_memmap(self.get_path(f'embeddings_{len(self.chunks):06d}'), mode='w+',
+                                                             dtype=np.float32, shape=(CHUNK_ROWS, self.dim)))
+                self.chunk_arrays.append(self.chunks[-1].view(np.ndarray))
+            self.get(row)[:] = embedding
+            self.count += 1
+        return row
+
+    def is_embedding(self, obj):
+        # a 1-D float array of the dimension of the store, the first one sets the dimension
+        return isinstance(obj, np.ndarray) and obj.ndim == 1 and obj.dtype.kind == 'f' and self.dim in [None, obj.shape[0]]
+
+    def is_row_view(self, row, array):
+        # array is still the view of row, not a copy or a new embedding set after the row
+        if row is None or not 0 <= row < self.count:
+            return False
+        return array.__array_interface__['data'][0] == self.get(row).__array_interface__['data'][0]
+
+    def flush(self):
+        # the rows are flushed before the count that makes them visible
+        if self.readonly or self.dim is None or self.flushed_count == self.count:
+            return
+        with self.lock:
+            for chunk in self.chunks:
+                chunk.flush()
+            np.save(self.get_path('meta') + '.tmp.npy', np.array([self.count, self.dim], dtype=np.int64))
+            os.replace(self.get_path('meta') + '.tmp.npy', self.get_path('meta'))
+            self.flushed_count = self.count
+
+
+class EmbeddingUnpickler(pickle.Unpickler):
+    def __init__(self, file, persistent_load):
+        super().__init__(file)
+        self.load_embedding = persistent_load
+
+    def persistent_load(self, pid):
+        return self.load_embedding(pid[1])
+
+
+def load_with_embeddings(file, load_embedding):
+    """
+    Unpickle a frame of file written before the checkpoints, load_embedding(row) returns the embedding of a row.
+    """
+    return EmbeddingUnpickler(file, load_embedding).load()
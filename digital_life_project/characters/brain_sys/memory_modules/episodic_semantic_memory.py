@@ -98,6 +98,7 @@ class Thought:
         rate = a + (1-a) * np.exp(- k_per_plot * (plot_id - self.plot_id) / (np.exp2(self.access_times) *(importance_base + self.poignancy)))
         if rate < threshold:
             self.forgot = True
+            return 0.0
         else:
             return rate
     
@@ -0,0 +1,319 @@
+"""
+File: memory_log.py
+Description: Append-only log of the memory nodes, with periodic compacted snapshots
+
+Instead of pickling the whole id_to_node of a character at the end of every plot, the memory
+appends one batch of records per plot to a segmented write-ahead log:
+    - ('insert', node): a node added since the last batch, in its current state
+    - ('update', node_id, state): the mutable fields of an older node that changed since the last batch
+      (next_*_node_id links, the node id lists of plots, last_accessed, access_times and forgot)
+Every snapshot_interval batches, the whole id_to_node is written as a snapshot instead. The log of a
+character is in <save_dir>/memory_log/<name>:
+    - snapshot_<lsn>.ckpt: id_to_node after the batches before lsn, it replaces the batch lsn-1.
+      One frame per node, with the offset, type and plot id of each node in snapshot_<lsn>.idx.ckpt,
+      and the fields of the retrieval index of the events and thoughts
+    - wal_<lsn>.ckpt: the batches from lsn on, one frame (lsn, records) per batch
+The frames are encoded by the dumps and load of the log, the checkpoint frames of the memory.
+The logs of pickle frames (.pkl) of older runs are read the same way.
+Each plot saves the lsn of its memory, so any plot is rebuilt from the latest snapshot before it
+and the batches between them.
+A lazy load keeps the nodes of the snapshot on disk: id_to_node holds a LazyNode of each of them,
+which reads its node on first access, and an LRU of cache_nodes nodes keeps the hot ones. The retrieval
+indices of a lazy load are built from the snapshot index, without reading the events and thoughts.
+"""
+import os
+import re
+import pickle
+import threading
+from collections import OrderedDict
+
+
+MEMORY_LOG_SEGMENT_BYTES = 64 * 1024 * 1024
+# fields changed in place after a node is added, the others are set once
+MUTABLE_NODE_FIELDS = ['last_accessed', 'next_self_node_id', 'next_partner_node_id',
+                       'event_node_ids', 'relationship_node_ids', 'behavior_node_ids', 'topic_node_ids',
+                       'emotion_node_ids', 'core_self_node_ids', 'motivation_node_ids', 'thought_node_ids']
+MUTABLE_ITEM_FIELDS = {'event': ['access_times', 'forgot'], 'thought': ['access_times', 'forgot']}
+
+
+def get_node_state(node):
+    state = {name: getattr(node, name) for name in MUTABLE_NODE_FIELDS if hasattr(node, name)}
+    for item_name, item_fields in MUTABLE_ITEM_FIELDS.items():
+        if hasattr(node, item_name):
+            item = getattr(node, item_name)
+            state[item_name] = {name: getattr(item, name) for name in item_fields}
+    return state
+
+
+def set_node_state(node, state):
+    for name, value in state.items():
+        if name in MUTABLE_ITEM_FIELDS:
+            item = getattr(node, name)
+            for item_field, item_value in value.items():
+                setattr(item, item_field, item_value)
+        else:
+            setattr(node, name, value)
+
+
+def apply_memory_records(id_to_node, records):
+    for record in records:
+        if record[0] == 'insert':
+            id_to_node[record[1].node_id] = record[1]
+        elif isinstance(id_to_node[record[1]], LazyNode):
+            id_to_node[record[1]].set_state(record[2])
+        else:
+            set_node_state(id_to_node[record[1]], record[2])
+
+
+def list_log_files(log_dir, prefix):
+    # [(lsn, path)] of the snapshots or segments, in lsn order
+    files = []
+    if os.path.isdir(log_dir):
+        for filename in os.listdir(log_dir):
+            match = re.fullmatch(prefix + r'_(\d+)\.(pkl|ckpt)', filename)
+            if match is not None:
+                files.append((int(match.group(1)), os.path.join(log_dir, filename)))
+    return sorted(files)
+
+
+def read_segment(path, load=pickle.load):
+    """
+    The batches of a segment. The last batch may be torn by a crash and is dropped,
+    a corrupt batch before the end of the file raises.
+    """
+    batches = []
+    with open(path, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        while True:
+            start = f.tell()
+            try:
+                batches.append(load(f))
+            except (EOFError, ValueError, pickle.UnpicklingError):
+                if start == size:
+                    break
+                if f.tell() < size:
+                    raise
+                print(f"[Memory Log] Truncated batch in {path}")
+                break
+    return batches
+
+
+def get_snapshot_index_path(path):
+    base, extension = os.path.splitext(path)
+    return base + '.idx' + ('' if extension == '.pkl' else extension)
+
+
+def get_node_entry(node):
+    # (type, plot id, retrieval fields) of a node in the snapshot index, after the node is encoded with its embedding row
+    retrieval = None
+    for item_name in MUTABLE_ITEM_FIELDS:
+        item = getattr(node, item_name, None)
+        if item is not None and getattr(item, 'embedding_row', None) is not None:
+            retrieval = [item.poignancy, item.access_times, item.forgot, item.embedding_row]
+    return (type(node).__name__, getattr(node, 'plot_id', None), retrieval)
+
+
+def get_lazy_retrieval_entry(node, item_name):
+    """
+    (plot id, poignancy, access_times, forgot, embedding row) of the event or thought of a lazy node
+    not read yet, from the snapshot index and the state changes since, or None.
+    """
+    if not isinstance(node, LazyNode):
+        return None
+    payloads = node.payloads
+    with payloads.lock:
+        entry = payloads.index[node.node_id]
+        if node.node_id in payloads.hot_nodes or len(entry) < 5 or entry[4] is None:
+            return None
+        poignancy, access_times, forgot, embedding_row = entry[4]
+        state = payloads.states.get(node.node_id, {}).get(item_name, {})
+        return entry[3], poignancy, state.get('access_times', access_times), state.get('forgot', forgot), embedding_row
+
+
+class NodePayloads:
+    """
+    The nodes of a snapshot read on demand, with an LRU of the hot ones. The state changes of the
+    nodes not in the LRU are kept until they are read again.
+    """
+    def __init__(self, path, index, load, cache_nodes):
+        self.path = path
+        # node_id -> (offset, length, type, plot id, retrieval fields)
+        self.index = index
+        self.load = load
+        self.cache_nodes = cache_nodes
+        self.lock = threading.RLock()
+        self.file = None
+        self.hot_nodes = OrderedDict()
+        self.states = {}
+        self.reads = 0
+
+    def read(self, node_id):
+        if self.file is None:
+            self.file = open(self.path, 'rb')
+        self.file.seek(self.index[node_id][0])
+        node = self.load(self.file)
+        if node_id in self.states:
+            set_node_state(node, self.states[node_id])
+        self.reads += 1
+        return node
+
+    def get(self, node_id, cache=True):
+        with self.lock:
+            node = self.hot_nodes.get(node_id)
+            if node is not None:
+                self.hot_nodes.move_to_end(node_id)
+                return node
+            node = self.read(node_id)
+            if not cache:
+                return node
+            self.states.pop(node_id, None)
+            self.hot_nodes[node_id] = node
+            while len(self.hot_nodes) > self.cache_nodes:
+                # the evicted node is read again with its current state
+                evicted_id, evicted_node = self.hot_nodes.popitem(last=False)
+                self.states[evicted_id] = get_node_state(evicted_node)
+            return node
+
+    def set_state(self, node_id, state):
+        with self.lock:
+            if node_id in self.hot_nodes:
+                set_node_state(self.hot_nodes[node_id], state)
+            else:
+                self.states[node_id] = state
+
+
+class LazyNode:
+    """
+    Stand-in of a node of a snapshot, reading the node on the first access to its attributes.
+    It is pickled as the node itself.
+    """
+    __slots__ = ['payloads', 'node_id']
+
+    def __init__(self, payloads, node_id):
+        object.__setattr__(self, 'payloads', payloads)
+        object.__setattr__(self, 'node_id', node_id)
+
+    def __getattr__(self, name):
+        return getattr(self.payloads.get(self.node_id), name)
+
+    def __setattr__(self, name, value):
+        setattr(self.payloads.get(self.node_id), name, value)
+
+    def set_state(self, state):
+        self.payloads.set_state(self.node_id, state)
+
+    def get_node(self):
+        # the node without keeping it in the LRU
+        return self.payloads.get(self.node_id, cache=False)
+
+    def __reduce_ex__(self, protocol):
+        return (get_loaded_node, (self.get_node(),))
+
+
+def get_loaded_node(node):
+    return node
+
+
+class MemoryLog:
+    def __init__(self, log_dir, snapshot_interval=10, segment_bytes=MEMORY_LOG_SEGMENT_BYTES, dumps=pickle.dumps, load=pickle.load, flush=None,
+                 extension='.pkl'):
+        self.log_dir = log_dir
+        self.snapshot_interval = snapshot_interval
+        self.segment_bytes = segment_bytes
+        self.extension = extension
+        # the encoding of the frames, e.g. with the embeddings in an EmbeddingStore flushed before the frames are written
+        self.dumps = dumps
+        self.flush = flush
+        os.makedirs(log_dir, exist_ok=True)
+        self.lsn = 0
+        self.batches_since_snapshot = 0
+        self.has_snapshot = False
+        self.segment_path = None
+        # continue an existing log of the same run
+        snapshots = list_log_files(log_dir, 'snapshot')
+        if len(snapshots) > 0:
+            self.has_snapshot = True
+            self.lsn = snapshots[-1][0]
+        for segment_lsn, path in list_log_files(log_dir, 'wal'):
+            for batch_lsn, _ in read_segment(path, load=load):
+                if batch_lsn >= self.lsn:
+                    self.lsn = batch_lsn + 1
+                    self.batches_since_snapshot += 1
+            self.segment_path = path
+
+    def needs_snapshot(self):
+        return not self.has_snapshot or self.batches_since_snapshot >= self.snapshot_interval
+
+    def write_snapshot(self, id_to_node):
+        # the snapshot takes the lsn of a batch, with the changes of that batch
+        self.lsn += 1
+        path = os.path.join(self.log_dir, f'snapshot_{self.lsn:08d}{self.extension}')
+        index = {}
+        with open(path + '.tmp', 'wb') as f:
+            for node_id, node in id_to_node.items():
+                node = node.get_node() if isinstance(node, LazyNode) else node
+                data = self.dumps(node)
+                index[node_id] = (f.tell(), len(data)) + get_node_entry(node)
+                f.write(data)
+        if self.flush is not None:
+            self.flush()
+        with open(get_snapshot_index_path(path) + '.tmp', 'wb') as f:
+            f.write(self.dumps(index))
+        # the snapshot is complete once its frames are in place
+        os.replace(get_snapshot_index_path(path) + '.tmp', get_snapshot_index_path(path))
+        os.replace(path + '.tmp', path)
+        self.has_snapshot = True
+        self.batches_since_snapshot = 0
+        # the batches after the snapshot start a new segment
+        self.segment_path = None
+
+    def append(self, records):
+        if self.segment_path is None or os.path.getsize(self.segment_path) >= self.segment_bytes:
+            self.segment_path = os.path.join(self.log_dir, f'wal_{self.lsn:08d}{self.extension}')
+        data = self.dumps((self.lsn, records))
+        if self.flush is not None:
+            self.flush()
+        with open(self.segment_path, 'ab') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        self.lsn += 1
+        self.batches_since_snapshot += 1
+
+
+def read_snapshot(path, load=pickle.load, cache_nodes=0):
+    if not os.path.exists(get_snapshot_index_path(path)):
+        # a snapshot of the whole id_to_node in one frame
+        with open(path, 'rb') as f:
+            return load(f)
+    with open(get_snapshot_index_path(path), 'rb') as f:
+        index = load(f)
+    if cache_nodes > 0:
+        payloads = NodePayloads(path, index, load, cache_nodes)
+        return {node_id: LazyNode(payloads, node_id) for node_id in index.keys()}
+    id_to_node = {}
+    with open(path, 'rb') as f:
+        for node_id in index.keys():
+            id_to_node[node_id] = load(f)
+    return id_to_node
+
+
+def load_memory_log(log_dir, lsn, load=pickle.load, cache_nodes=0):
+    """
+    Rebuild the id_to_node at lsn from the latest snapshot before it and the batches in between.
+    With cache_nodes > 0, the nodes of the snapshot are loaded lazily.
+    """
+    snapshots = [(snapshot_lsn, path) for snapshot_lsn, path in list_log_files(log_dir, 'snapshot') if snapshot_lsn <= lsn]
+    if len(snapshots) == 0:
+        raise FileNotFoundError(f"No memory snapshot before lsn {lsn} in {log_dir}")
+    snapshot_lsn, snapshot_path = snapshots[-1]
+    id_to_node = read_snapshot(snapshot_path, load=load, cache_nodes=cache_nodes)
+    segments = list_log_files(log_dir, 'wal')
+    for i, (segment_lsn, path) in enumerate(segments):
+        # skip the segments ending before the snapshot and starting after lsn
+        if segment_lsn >= lsn or (i + 1 < len(segments) and segments[i+1][0] <= snapshot_lsn):
+            continue
+        for batch_lsn, records in read_segment(path, load=load):
+            if snapshot_lsn <= batch_lsn < lsn:
+                apply_memory_records(id_to_node, records)
+    return id_to_node
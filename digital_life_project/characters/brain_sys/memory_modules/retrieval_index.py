@@ -0,0 +1,147 @@
+"""
+File: retrieval_index.py
+Description: Matrix-backed index for the embedding retrieval of events and thoughts
+
+The float32 embeddings of the indexed nodes are kept in an append-only matrix, and the fields
+of the Ebbinghaus forgetting curve (plot_id, poignancy, access_times, forgot) in parallel
+arrays, so one query is scored with a single matmul and a vectorized forgetting curve.
+The index is the owner of access_times and forgot while the memory is alive, and writes
+them back to the events and thoughts when they change. The changed rows are kept until
+the memory log takes them.
+Two results differ from the per-node scoring loop the index replaced:
+    - ties of equal scores are ranked by list position (a stable sort), where np.argsort
+      ordered them arbitrarily
+    - a thought forgotten by a query scores 0, as an event does, where the score of the
+      thought was None and the retrieval raised a TypeError
+"""
+import numpy as np
+
+
+class RetrievalIndex:
+    def __init__(self, item_name, a, importance_base, k_per_plot, threshold, capacity=64):
+        # item_name is the attribute of the node holding the Event or Thought
+        self.item_name = item_name
+        self.a = a
+        self.importance_base = importance_base
+        self.k_per_plot = k_per_plot
+        self.threshold = threshold
+
+        self.nodes = []
+        self.embeddings = None
+        self.plot_ids = np.zeros(capacity, dtype=np.int64)
+        self.poignancies = np.zeros(capacity, dtype=np.float64)
+        self.access_times = np.zeros(capacity, dtype=np.float64)
+        self.forgot = np.zeros(capacity, dtype=bool)
+        self.manual = np.zeros(capacity, dtype=bool)
+        self.changed_rows = set()
+
+    def __len__(self):
+        return len(self.nodes)
+
+    def grow(self, capacity):
+        for name in ['plot_ids', 'poignancies', 'access_times', 'forgot', 'manual']:
+            array = getattr(self, name)
+            new_array = np.zeros(capacity, dtype=array.dtype)
+            new_array[:len(array)] = array
+            setattr(self, name, new_array)
+        if self.embeddings is not None:
+            new_embeddings = np.zeros((capacity, self.embeddings.shape[1]), dtype=self.embeddings.dtype)
+            new_embeddings[:len(self.embeddings)] = self.embeddings
+            self.embeddings = new_embeddings
+
+    def add(self, node, manual=False):
+        item = getattr(node, self.item_name)
+        return self.add_fields(node, node.plot_id, item.poignancy, item.access_times, item.forgot, item.embedding, manual=manual)
+
+    def add_fields(self, node, plot_id, poignancy, access_times, forgot, embedding, manual=False):
+        # the fields of the event or thought of node, without reading them from the node
+        row = len(self.nodes)
+        if row >= len(self.plot_ids):
+            self.grow(2 * len(self.plot_ids))
+        if self.embeddings is None:
+            self.embeddings = np.zeros((len(self.plot_ids), len(embedding)), dtype=np.float32)
+        self.embeddings[row] = embedding
+        self.plot_ids[row] = plot_id
+        self.poignancies[row] = poignancy
+        self.access_times[row] = access_times
+        self.forgot[row] = forgot
+        self.manual[row] = manual
+        self.nodes.append(node)
+        return row
+
+    def get_candidate_rows(self, manual=True, exclude_plot_id=None):
+        """
+        Rows of the nodes not forgotten yet, in the order of the memory lists:
+        newest first, the manual events after the others.
+        """
+        count = len(self.nodes)
+        mask = ~self.forgot[:count]
+        if not manual:
+            mask &= ~self.manual[:count]
+        if exclude_plot_id is not None:
+            mask &= self.plot_ids[:count] != exclude_plot_id
+        rows = np.nonzero(mask)[0][::-1]
+        return np.concatenate([rows[~self.manual[rows]], rows[self.manual[rows]]])
+
+    def get_forgetting_rates(self, rows, plot_id):
+        # using Ebbinghaus forgetting curve, the same as get_forgetting_rate of Event and Thought
+        rates = self.a + (1-self.a) * np.exp(- self.k_per_plot * (plot_id - self.plot_ids[rows]) / (np.exp2(self.access_times[rows]) * (self.importance_base + self.poignancies[rows])))
+        forgot = rates < self.threshold
+        if forgot.any():
+            for row in rows[forgot]:
+                self.forgot[row] = True
+                getattr(self.nodes[row], self.item_name).forgot = True
+                self.changed_rows.add(int(row))
+        rates[forgot] = 0.0
+        return rates
+
+    def get_topk_rows(self, scores, rows, topk):
+        """
+        The same nodes and order as np.argsort(scores, kind='stable')[-topk:] over the candidate list.
+        """
+        if topk <= 0 or topk >= len(rows):
+            return rows[np.argsort(scores, kind='stable')[-topk:]]
+        # keep every score tied with the k-th largest one, then break the ties by list position
+        kth_score = np.partition(scores, len(scores) - topk)[len(scores) - topk]
+        selected = np.nonzero(scores >= kth_score)[0]
+        order = selected[np.lexsort((selected, scores[selected]))]
+        return rows[order[-topk:]]
+
+    def get_topk_rows_of_queries(self, embeddings, rows, plot_id, topk, mark_accessed=False):
+        """
+        Top-k rows of each query of a (num_query, dim) matrix, with one matmul for all queries.
+        The result is the same as querying one by one: the nodes forgotten by a query are not
+        candidates of the next ones, and the accesses marked by a query change the forgetting
+        rates of the next ones.
+        """
+        # over the contiguous matrix of the nodes, without gathering the embeddings of the rows
+        similarities = np.matmul(np.asarray(embeddings, dtype=np.float32), self.embeddings[:len(self.nodes)].T)[:, rows]
+        columns = np.arange(len(rows))
+        rates = None
+        topk_rows_list = []
+        for similarity in similarities:
+            if rates is not None:
+                keep = ~self.forgot[rows[columns]]
+                columns = columns[keep]
+                rates = None if mark_accessed else rates[keep]
+            if len(columns) == 0:
+                topk_rows_list.append(rows[columns])
+                continue
+            if rates is None:
+                rates = self.get_forgetting_rates(rows[columns], plot_id)
+            topk_rows = self.get_topk_rows(similarity[columns] * rates, rows[columns], topk)
+            if mark_accessed:
+                self.mark_accessed(topk_rows)
+            topk_rows_list.append(topk_rows)
+        return topk_rows_list
+
+    def mark_accessed(self, rows):
+        for row in rows:
+            self.access_times[row] += 1
+            getattr(self.nodes[row], self.item_name).mark_accessed()
+            self.changed_rows.add(int(row))
+
+    def pop_changed_nodes(self):
+        nodes = [self.nodes[row] for row in sorted(self.changed_rows)]
+        self.changed_rows = set()
+        return nodes
@@ -4,7 +4,7 @@ Author: Jianping Jiang (alanjjp98@gmail.com)
 File: core_self.py
 Description: Define the core self class of SocioMind
 """
-from digital_life_project.characters.llm_api.gpt_prompt_brain import get_embedding
+from digital_life_project.characters.llm_api.gpt_prompt_brain import get_embedding, get_embeddings
 import numpy as np
 
 
@@ -17,8 +17,7 @@ class Coreself:
         self.time = time
         self.features = features
         self.feature_embeddings = {}
-        for feature in self.features:
-            self.get_feature_embedding_from_feature(feature)
+        self.set_feature_embeddings(self.features)
         self.get_core_self_embedding()
     
     def get_feature_embedding_from_feature(self, feature):
@@ -26,6 +25,12 @@ class Coreself:
             self.feature_embeddings[feature] = np.array(get_embedding(feature))
         return self.feature_embeddings[feature]
     
+    def set_feature_embeddings(self, features):
+        # embed all new features in one request
+        new_features = [feature for feature in dict.fromkeys(features) if feature not in self.feature_embeddings]
+        for feature, embedding in zip(new_features, get_embeddings(new_features)):
+            self.feature_embeddings[feature] = np.array(embedding)
+    
     def get_full_description(self):
         return f"<self_name>{self.self_name}<central_belief>{self.central_belief}" +  \
             f"<plot_id>{self.plot_id}<round>{self.round}<time>{self.time}"
@@ -76,8 +81,7 @@ class Coreself:
         
     def add_features(self, features):
         self.features.extend(features)
-        for feature in features:
-            self.get_feature_embedding_from_feature(feature)
+        self.set_feature_embeddings(features)
     
     def get_dicts(self):
         return {
@@ -4,21 +4,83 @@ Author: Jianping Jiang (alanjjp98@gmail.com)
 File: persona_instruct.py
 Description: Define the persona instruction database class for the characters
 """
+import os
+import json
+import hashlib
+import threading
 import numpy as np
 from digital_life_project.characters.brain_sys.utils import *
 from digital_life_project.characters.llm_api.gpt_prompt_brain import *
+from digital_life_project.characters.span_tracer import traced
 import pandas as pd
 from concurrent.futures import ThreadPoolExecutor, TimeoutError
 
 
+# the database is read-only after loading, so one instance per database path is shared by all characters
+_persona_instruction_databases = {}
+_persona_instruction_databases_lock = threading.Lock()
+
+# bump when the layout of the compiled persona index changes
+PERSONA_INDEX_VERSION = 2
+
+
+def get_file_hash(path):
+    if not check_if_file_exists(path):
+        return None
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def get_file_stamp(path):
+    # size and modification time, so the large database is not read to check the index
+    if not os.path.isfile(path):
+        return None
+    stat = os.stat(path)
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+def get_source_stamps(config):
+    # the table is hashed, the fallback to the Excel table only depends on its content
+    return {
+        'persona_table': get_file_hash(config['persona_table']),
+        'persona_database': get_file_stamp(config['persona_database']),
+    }
+
+
+def get_persona_index_dir(config):
+    if 'persona_index' in config:
+        return config['persona_index']
+    return os.path.splitext(config['persona_database'])[0] + '_index'
+
+
+def get_persona_instruction_database(config):
+    """
+    Return the process-wide PersonaInstructionDatabase of the database and table paths in the config.
+    """
+    key = (os.path.abspath(config['persona_database']), os.path.abspath(config['persona_table']))
+    with _persona_instruction_databases_lock:
+        if key not in _persona_instruction_databases:
+            _persona_instruction_databases[key] = PersonaInstructionDatabase(config)
+        return _persona_instruction_databases[key]
+
 
 class PersonaInstructionDatabase():
     def __init__(self, config):
         self.config = config
         self.persona_instructions = {}
         self.embeddings = {}
+        # weighted trait + behavior matrices, keyed by (trait_weight, behavior_weight)
+        self.combined_embeddings = {}
         
         self.check_flag = False
+        self.index_dir = get_persona_index_dir(config)
+        self.source_stamps = get_source_stamps(self.config)
+        if self.load_persona_index():
+            print("Persona instruction database loaded from index!")
+            return
         if check_if_file_exists(self.config['persona_database']):
             # load database
             database = np.load(self.config['persona_database'], allow_pickle=True).item()
@@ -28,6 +90,10 @@ class PersonaInstructionDatabase():
         if self.check_flag:
             self.check_embedding()
         self.rearrange_embeddings()
+        try:
+            self.save_persona_index()
+        except Exception as e:
+            print(f"Persona index not saved: {e}")
         print("Persona instruction database loaded!")
             
 
@@ -61,8 +127,65 @@ class PersonaInstructionDatabase():
             trait_embedding_array.append(self.embeddings[self.persona_instructions[i]['trait']])
             behavior_embedding_array.append(self.embeddings[self.persona_instructions[i]['behavior']])
             self.ids_list.append(i)
-        self.trait_embeddings = np.array(trait_embedding_array)
-        self.behavior_embeddings = np.array(behavior_embedding_array)
+        # float32, as in the compiled index, so the first run retrieves the same as the later ones
+        self.trait_embeddings = np.array(trait_embedding_array, dtype=np.float32)
+        self.behavior_embeddings = np.array(behavior_embedding_array, dtype=np.float32)
+        # shared by all characters, so guard the matrices against in-place changes
+        self.trait_embeddings.setflags(write=False)
+        self.behavior_embeddings.setflags(write=False)
+
+
+    def load_persona_index(self):
+        """
+        Map the compiled index, if it is built from the current table and database.
+        """
+        header_path = os.path.join(self.index_dir, 'header.json')
+        if not check_if_file_exists(header_path):
+            return False
+        with open(header_path, 'r') as f:
+            header = json.load(f)
+        if header.get('version') != PERSONA_INDEX_VERSION or header.get('source_stamps') != self.source_stamps:
+            print("Persona index is out of date, rebuild it from the persona table.")
+            return False
+        with open(os.path.join(self.index_dir, 'strings.json'), 'r') as f:
+            items = json.load(f)
+        self.ids_list = [item.pop('id') for item in items]
+        self.persona_instructions = dict(zip(self.ids_list, items))
+        # the per-string embeddings are only needed to save the npy database
+        self.embeddings = None
+        self.trait_embeddings = np.load(os.path.join(self.index_dir, 'trait_embeddings.npy'), mmap_mode='r')
+        self.behavior_embeddings = np.load(os.path.join(self.index_dir, 'behavior_embeddings.npy'), mmap_mode='r')
+        return True
+    
+    
+    def save_persona_index(self):
+        # compile the instructions and embeddings into float32 matrices and a string table,
+        # the header is written last and marks the index as complete
+        os.makedirs(self.index_dir, exist_ok=True)
+        items = []
+        for i in self.ids_list:
+            item = {'id': int(i)}
+            for key, value in self.persona_instructions[i].items():
+                item[key] = value.item() if hasattr(value, 'item') else value
+            items.append(item)
+        with open(os.path.join(self.index_dir, 'strings.json.tmp'), 'w') as f:
+            json.dump(items, f)
+        np.save(os.path.join(self.index_dir, 'trait_embeddings.tmp.npy'), self.trait_embeddings)
+        np.save(os.path.join(self.index_dir, 'behavior_embeddings.tmp.npy'), self.behavior_embeddings)
+        header = {
+            'version': PERSONA_INDEX_VERSION,
+            'source_stamps': self.source_stamps,
+            'count': len(self.ids_list),
+            'dim': int(self.trait_embeddings.shape[1]),
+            'dtype': 'float32',
+        }
+        with open(os.path.join(self.index_dir, 'header.json.tmp'), 'w') as f:
+            json.dump(header, f, indent=2)
+        os.replace(os.path.join(self.index_dir, 'strings.json.tmp'), os.path.join(self.index_dir, 'strings.json'))
+        os.replace(os.path.join(self.index_dir, 'trait_embeddings.tmp.npy'), os.path.join(self.index_dir, 'trait_embeddings.npy'))
+        os.replace(os.path.join(self.index_dir, 'behavior_embeddings.tmp.npy'), os.path.join(self.index_dir, 'behavior_embeddings.npy'))
+        os.replace(os.path.join(self.index_dir, 'header.json.tmp'), os.path.join(self.index_dir, 'header.json'))
+        print(f"Persona index saved to {self.index_dir}")
 
 
     def transfer_item_to_instruction(self, item):
@@ -71,60 +194,104 @@ class PersonaInstructionDatabase():
         return desc
     
     
-    def retrieval_instruction_from_embeddings(self, embeddings, topk_for_each=3, topk_all=10, trait_weight=1.0, behavior_weight=1.0):
-        # retrieve topk_for_each for each trait and behavior, then select topk_all from them
-        select_ids = {}
-        for j, embedding in enumerate(embeddings):
-            trait_scores = np.dot(self.trait_embeddings, embedding)
-            behavior_scores = np.dot(self.behavior_embeddings, embedding)
-            overall_scores = trait_scores * trait_weight + behavior_scores * behavior_weight
-            indices = np.argsort(overall_scores)[::-1][:topk_for_each]
-            for index in indices:
-                if self.ids_list[index] in select_ids:
-                    if overall_scores[index] > select_ids[self.ids_list[index]]:
-                        select_ids[self.ids_list[index]] = overall_scores[index]
-                else:
-                    select_ids.update({self.ids_list[index]: overall_scores[index]})
+    def get_combined_embeddings(self, trait_weight=1.0, behavior_weight=1.0):
+        key = (trait_weight, behavior_weight)
+        if key not in self.combined_embeddings:
+            combined = self.trait_embeddings * trait_weight + self.behavior_embeddings * behavior_weight
+            combined.setflags(write=False)
+            self.combined_embeddings[key] = combined
+        return self.combined_embeddings[key]
+    
+    
+    def get_instruction_candidates(self, embeddings, topk_for_each=3, trait_weight=1.0, behavior_weight=1.0):
+        # indices and scores of the top-k instructions of each query, best first, in the order of the queries
+        if len(embeddings) == 0:
+            return np.zeros(0, dtype=np.int64), np.zeros(0)
+        combined = self.get_combined_embeddings(trait_weight, behavior_weight)
+        overall_scores = np.matmul(np.asarray(embeddings, dtype=combined.dtype), combined.T)
         
-        sorted_ids = [key for key, value in sorted(select_ids.items(), key=lambda item: item[1], reverse=True)]
-        select_ids = sorted_ids[:topk_all]
+        num = overall_scores.shape[1]
+        if topk_for_each < num:
+            indices = np.argpartition(overall_scores, num - topk_for_each, axis=1)[:, num - topk_for_each:]
+        else:
+            indices = np.tile(np.arange(num), (len(overall_scores), 1))
+        topk_scores = np.take_along_axis(overall_scores, indices, axis=1)
+        order = np.lexsort((-indices, -topk_scores), axis=1)
+        indices = np.take_along_axis(indices, order, axis=1).ravel()
+        topk_scores = np.take_along_axis(topk_scores, order, axis=1).ravel()
+        return indices, topk_scores
+    
+    
+    def select_instructions(self, candidates, topk_all=10):
+        # keep the max score of each instruction, ties are ranked by the first query retrieving them
+        indices, topk_scores = candidates
+        if len(indices) == 0:
+            return []
+        unique_indices, first_positions, inverse = np.unique(indices, return_index=True, return_inverse=True)
+        max_scores = np.full(len(unique_indices), -np.inf)
+        np.maximum.at(max_scores, inverse, topk_scores)
+        select_indices = unique_indices[np.lexsort((first_positions, -max_scores))][:topk_all]
         
         instructions = []
-        for id in select_ids:
-            instructions.append(self.transfer_item_to_instruction(self.persona_instructions[id]))
+        for index in select_indices:
+            instructions.append(self.transfer_item_to_instruction(self.persona_instructions[self.ids_list[index]]))
         
         return instructions
     
+    
+    @staticmethod
+    def concat_instruction_candidates(*candidates_list):
+        # the candidates of the queries of each argument, in order
+        return np.concatenate([indices for indices, _ in candidates_list]), np.concatenate([scores for _, scores in candidates_list])
+    
+    
+    @traced('persona_retrieval', 'memory')
+    def retrieval_instruction_from_embeddings(self, embeddings, topk_for_each=3, topk_all=10, trait_weight=1.0, behavior_weight=1.0):
+        # retrieve topk_for_each for each trait and behavior, then select topk_all from them
+        candidates = self.get_instruction_candidates(embeddings, topk_for_each, trait_weight, behavior_weight)
+        return self.select_instructions(candidates, topk_all)
+    
     def check_embedding(self):
+        missing_texts = []
         for i in self.persona_instructions.keys():
-            if self.persona_instructions[i]['trait'] not in self.embeddings:
-                with ThreadPoolExecutor() as executor:
-                    future = executor.submit(get_embedding, self.persona_instructions[i]['trait'])
-                    try:
-                        self.embeddings[self.persona_instructions[i]['trait']] = np.array(future.result(timeout=30))
-                    except TimeoutError:
-                        print("Request timed out!")
-                        self.save_database()
-                        raise Exception("embedding error")
-            if self.persona_instructions[i]['behavior'] not in self.embeddings:
-                with ThreadPoolExecutor() as executor:
-                    future = executor.submit(get_embedding, self.persona_instructions[i]['behavior'])
-                    try:
-                        self.embeddings[self.persona_instructions[i]['behavior']] = np.array(future.result(timeout=30))
-                        print('embedding added for item {}'.format(i)) 
-                    except TimeoutError:
-                        print("Request timed out!")
-                        self.save_database()
-                        raise Exception("embedding error")
+            for key in ['trait', 'behavior']:
+                if self.persona_instructions[i][key] not in self.embeddings:
+                    missing_texts.append(self.persona_instructions[i][key])
+        missing_texts = list(dict.fromkeys(missing_texts))
+        # embed the missing texts in batches, and save the progress when a request times out
+        for start in range(0, len(missing_texts), EMBEDDING_BATCH_SIZE):
+            batch = missing_texts[start:start+EMBEDDING_BATCH_SIZE]
+            with ThreadPoolExecutor() as executor:
+                future = executor.submit(get_embeddings, batch)
+                try:
+                    for text, embedding in zip(batch, future.result(timeout=120)):
+                        self.embeddings[text] = np.array(embedding)
+                    print('embedding added for {} items'.format(start + len(batch)))
+                except TimeoutError:
+                    print("Request timed out!")
+                    self.save_database()
+                    raise Exception("embedding error")
         print("embedding checked")
     
     def save_database(self):
+        if self.embeddings is None:
+            # loaded from the persona index
+            self.embeddings = {}
+            for row, i in enumerate(self.ids_list):
+                self.embeddings[self.persona_instructions[i]['trait']] = np.array(self.trait_embeddings[row])
+                self.embeddings[self.persona_instructions[i]['behavior']] = np.array(self.behavior_embeddings[row])
         np.save(self.config['persona_database'], {'instructions': self.persona_instructions, 'embeddings': self.embeddings})
+        # the index records the stamp of the database, keep it valid
+        self.source_stamps['persona_database'] = get_file_stamp(self.config['persona_database'])
+        if hasattr(self, 'trait_embeddings'):
+            self.save_persona_index()
 
-if __name__ == 'main':
+if __name__ == '__main__':
+    # build the npy database and the compiled persona index
     config = {
     'persona_table': r"digital_life_project\characters\brain_sys\psycho_state\ipip_table.xlsx",
     'persona_database': r"digital_life_project\characters\brain_sys\psycho_state\persona_database.npy",
+    'persona_index': r"digital_life_project\characters\brain_sys\psycho_state\persona_index",
     }
 
     data_base = PersonaInstructionDatabase(config)
@@ -14,7 +14,7 @@ from digital_life_project.characters.brain_sys.psycho_state.behavior import Beha
 from digital_life_project.characters.brain_sys.psycho_state.plot import Plot, Topic
 from digital_life_project.characters.llm_api.gpt_prompt_brain import *
 from digital_life_project.characters.brain_sys.memory_modules.episodic_semantic_memory import Event
-from digital_life_project.characters.brain_sys.psycho_state.persona_instruct import PersonaInstructionDatabase
+from digital_life_project.characters.brain_sys.psycho_state.persona_instruct import get_persona_instruction_database
 
 
 
@@ -24,7 +24,7 @@ class PsychoState():
         self.config = config
         self.character = character
         
-        self.persona_instruction_database = PersonaInstructionDatabase(config)
+        self.persona_instruction_database = get_persona_instruction_database(config)
 
         self.current_plot_id = -1
         self.current_round = -1
@@ -0,0 +1,124 @@
+"""
+File: cassette.py
+Description: Record/replay cassette of the LLM and embedding traffic
+
+A cassette is an append-only JSONL file of (request hash -> response) records.
+It is enabled by LLM_CASSETTE (file path) and LLM_CASSETTE_MODE:
+    - record: every request goes to the LLM service and is appended to the cassette
+    - replay: every request is served from the cassette, a miss raises CassetteMissError
+    - passthrough: requests are served from the cassette, misses go to the LLM service and are recorded
+Identical chat requests are answered in the order they were recorded, so a replayed run
+gets the same sequence of responses as the recorded one. The prompts quote the wall-clock
+times of the memory items and psycho states, which differ between a run and its replay, so
+the timestamps are left out of the request hash of the cassette.
+"""
+import os
+import re
+import json
+import hashlib
+import threading
+
+
+CASSETTE_MODES = ['record', 'replay', 'passthrough']
+# str() of a datetime, as quoted in the prompts
+TIMESTAMP_PATTERN = re.compile(r'\d{4}-\d{2}-\d{2}[ T]\d{2}:\d{2}:\d{2}(\.\d+)?')
+
+_llm_cassettes = {}
+_llm_cassettes_lock = threading.Lock()
+
+
+class CassetteMissError(Exception):
+    pass
+
+
+def get_request_hash(request):
+    return hashlib.sha256(json.dumps(request, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+
+def get_cassette_request_hash(request):
+    request = TIMESTAMP_PATTERN.sub('<time>', json.dumps(request, sort_keys=True, default=str))
+    return hashlib.sha256(request.encode('utf-8')).hexdigest()
+
+
+def get_chat_cassette_key(request_kwargs):
+    return 'chat:' + get_cassette_request_hash(request_kwargs)
+
+
+def get_embedding_cassette_key(text, model):
+    return 'embedding:' + get_cassette_request_hash({'model': model, 'input': text})
+
+
+class LLMCassette:
+    def __init__(self, path, mode='replay'):
+        if mode not in CASSETTE_MODES:
+            raise ValueError(f"Unknown cassette mode: {mode}")
+        self.path = path
+        self.mode = mode
+        self.lock = threading.Lock()
+        self.records = {}
+        self.served = {}
+        self.hits = 0
+        self.misses = 0
+        if mode != 'record' and os.path.exists(path):
+            with open(path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    if line.strip() == '':
+                        continue
+                    try:
+                        record = json.loads(line)
+                    except:
+                        # a run killed while appending leaves a partial last line
+                        continue
+                    self.records.setdefault(record['key'], []).append(record['response'])
+        if mode != 'replay':
+            dir_name = os.path.dirname(os.path.abspath(path))
+            os.makedirs(dir_name, exist_ok=True)
+            self.file = open(path, 'a', encoding='utf-8')
+
+    def get(self, key):
+        """
+        Return (True, response) on a hit, and (False, None) if the request should go to the LLM service.
+        """
+        if self.mode == 'record':
+            return False, None
+        with self.lock:
+            responses = self.records.get(key)
+            if responses is None:
+                self.misses += 1
+                if self.mode == 'replay':
+                    raise CassetteMissError(f"Request {key} is not in the cassette {self.path}")
+                return False, None
+            # repeated requests get the recorded responses in order, then the last one
+            count = self.served.get(key, 0)
+            self.served[key] = count + 1
+            self.hits += 1
+            return True, responses[min(count, len(responses) - 1)]
+
+    def put(self, key, response, unique=False):
+        # unique: deterministic responses like embeddings are recorded once
+        if self.mode == 'replay':
+            return
+        with self.lock:
+            if unique and key in self.records:
+                return
+            self.records.setdefault(key, []).append(response)
+            self.file.write(json.dumps({'key': key, 'response': response}) + '\n')
+            self.file.flush()
+
+    def get_stats(self):
+        return {'path': self.path, 'mode': self.mode, 'hits': self.hits, 'misses': self.misses,
+                'records': sum(len(responses) for responses in self.records.values())}
+
+
+def get_llm_cassette():
+    """
+    Return the shared cassette of LLM_CASSETTE and LLM_CASSETTE_MODE, or None if LLM_CASSETTE is not set.
+    """
+    path = os.environ.get("LLM_CASSETTE", "")
+    if path == "":
+        return None
+    key = (os.path.abspath(path), os.environ.get("LLM_CASSETTE_MODE", "replay"))
+    with _llm_cassettes_lock:
+        if key not in _llm_cassettes:
+            _llm_cassettes[key] = LLMCassette(key[0], mode=key[1])
+        return _llm_cassettes[key]
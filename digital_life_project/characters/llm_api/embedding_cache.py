@@ -0,0 +1,221 @@
+"""
+File: embedding_cache.py
+Description: Persistent content-addressed cache of text embeddings
+
+The cache of each embedding model is a directory of memory-mapped arrays:
+    - meta.npy: [generation, count, clock], the generation changes on every write
+    - keys.npy: 16-byte hash of the normalized text of each row
+    - last_used.npy: LRU clock of each row
+    - embeddings.npy: float64 embedding matrix, so a hit returns the values of the live call
+The arrays start with INITIAL_ROWS rows and double when they are full, up to max_entries rows,
+then rows are evicted in LRU order. All reads and writes are done under a lock file, so several
+simulation processes can share one cache. The float32 caches of older versions are started over.
+"""
+import os
+import re
+import hashlib
+import threading
+import numpy as np
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+    import msvcrt
+
+
+DEFAULT_MAX_ENTRIES = 50000
+INITIAL_ROWS = 1024
+ROW_ARRAYS = ['keys', 'last_used', 'embeddings']
+
+_embedding_caches = {}
+_embedding_caches_lock = threading.Lock()
+
+
+def normalize_embedding_text(text):
+    return " ".join(text.split())
+
+
+def get_text_hash(text):
+    return hashlib.blake2b(normalize_embedding_text(text).encode('utf-8'), digest_size=16).digest()
+
+
+class FileLock:
+    def __init__(self, path):
+        self.path = path
+        self.thread_lock = threading.Lock()
+        self.file = None
+
+    def __enter__(self):
+        self.thread_lock.acquire()
+        self.file = open(self.path, 'a+b')
+        if fcntl is not None:
+            fcntl.flock(self.file.fileno(), fcntl.LOCK_EX)
+        else:
+            self.file.seek(0)
+            msvcrt.locking(self.file.fileno(), msvcrt.LK_LOCK, 1)
+        return self
+
+    def __exit__(self, *args):
+        try:
+            if fcntl is not None:
+                fcntl.flock(self.file.fileno(), fcntl.LOCK_UN)
+            else:
+                self.file.seek(0)
+                msvcrt.locking(self.file.fileno(), msvcrt.LK_UNLCK, 1)
+            self.file.close()
+        finally:
+            self.file = None
+            self.thread_lock.release()
+
+
+class EmbeddingCache:
+    def __init__(self, cache_dir, model, max_entries=DEFAULT_MAX_ENTRIES):
+        self.cache_dir = os.path.join(cache_dir, re.sub(r'[^A-Za-z0-9_.-]', '_', model))
+        self.model = model
+        self.max_entries = max_entries
+        os.makedirs(self.cache_dir, exist_ok=True)
+        self.lock = FileLock(os.path.join(self.cache_dir, 'cache.lock'))
+
+        self.meta = None
+        self.keys = None
+        self.last_used = None
+        self.embeddings = None
+        self.generation = -1
+        self.key_to_row = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get_path(self, name):
+        return os.path.join(self.cache_dir, name + '.npy')
+
+    def open_arrays(self, dim=None):
+        # map the arrays, they are created by the first write with a known embedding dimension
+        if self.meta is None and os.path.exists(self.get_path('meta')):
+            if np.load(self.get_path('embeddings'), mmap_mode='r').dtype != np.float64:
+                os.remove(self.get_path('meta'))
+            else:
+                self.meta = np.load(self.get_path('meta'), mmap_mode='r+')
+        if self.meta is None and dim is not None:
+            rows = min(INITIAL_ROWS, self.max_entries)
+            np.lib.format.open_memmap(self.get_path('keys'), mode='w+', dtype=np.uint8, shape=(rows, 16)).flush()
+            np.lib.format.open_memmap(self.get_path('last_used'), mode='w+', dtype=np.int64, shape=(rows,)).flush()
+            np.lib.format.open_memmap(self.get_path('embeddings'), mode='w+', dtype=np.float64, shape=(rows, dim)).flush()
+            # meta is written last, the other arrays are complete once it exists
+            meta = np.lib.format.open_memmap(self.get_path('meta') + '.tmp', mode='w+', dtype=np.int64, shape=(3,))
+            meta.flush()
+            del meta
+            os.replace(self.get_path('meta') + '.tmp', self.get_path('meta'))
+            self.meta = np.load(self.get_path('meta'), mmap_mode='r+')
+        if self.meta is not None and self.meta[0] != self.generation:
+            # another process has written to the cache, possibly growing the arrays, map them again
+            self.keys, self.last_used, self.embeddings = [np.load(self.get_path(name), mmap_mode='r+') for name in ROW_ARRAYS]
+            count = int(self.meta[1])
+            self.key_to_row = {self.keys[row].tobytes(): row for row in range(count)}
+            self.generation = int(self.meta[0])
+        return self.meta is not None
+
+    def get_rows(self):
+        # rows of the arrays, an interrupted growth leaves some of them longer
+        return min(self.keys.shape[0], self.last_used.shape[0], self.embeddings.shape[0])
+
+    def grow_arrays(self, rows):
+        # copy the arrays into larger files, in place of the old ones
+        count = int(self.meta[1])
+        for name in ROW_ARRAYS:
+            array = getattr(self, name)
+            grown = np.lib.format.open_memmap(self.get_path(name) + '.tmp', mode='w+', dtype=array.dtype, shape=(rows,) + array.shape[1:])
+            grown[:count] = array[:count]
+            grown.flush()
+            del grown
+            setattr(self, name, None)
+            del array
+            os.replace(self.get_path(name) + '.tmp', self.get_path(name))
+            setattr(self, name, np.load(self.get_path(name), mmap_mode='r+'))
+
+    def get_many(self, texts):
+        """
+        Return a dict from text to the cached embedding (float64 array) of the cache hits.
+        """
+        found = {}
+        with self.lock:
+            if self.open_arrays():
+                for text in texts:
+                    row = self.key_to_row.get(get_text_hash(text))
+                    if row is not None:
+                        found[text] = np.array(self.embeddings[row])
+                        self.meta[2] += 1
+                        self.last_used[row] = self.meta[2]
+        self.hits += len(found)
+        self.misses += len(texts) - len(found)
+        return found
+
+    def put_many(self, texts, embeddings):
+        if len(texts) == 0:
+            return
+        embeddings = np.asarray(embeddings, dtype=np.float64)
+        with self.lock:
+            self.open_arrays(dim=embeddings.shape[1])
+            if embeddings.shape[1] != self.embeddings.shape[1]:
+                return
+            new_items = {}
+            for text, embedding in zip(texts, embeddings):
+                key = get_text_hash(text)
+                if key not in self.key_to_row:
+                    new_items[key] = embedding
+            new_items = list(new_items.items())[-self.max_entries:]
+            count = int(self.meta[1])
+            if count + len(new_items) > self.get_rows() and self.get_rows() < self.max_entries:
+                self.grow_arrays(min(self.max_entries, max(count + len(new_items), 2 * self.get_rows())))
+            free_rows = list(range(count, min(count + len(new_items), self.get_rows())))
+            evicted_rows = []
+            if len(new_items) > len(free_rows):
+                # evict the least recently used rows
+                evict_num = len(new_items) - len(free_rows)
+                evicted_rows = np.argpartition(self.last_used[:count], evict_num - 1)[:evict_num].tolist()
+                for row in evicted_rows:
+                    self.key_to_row.pop(self.keys[row].tobytes(), None)
+                self.evictions += evict_num
+            for (key, embedding), row in zip(new_items, free_rows + evicted_rows):
+                self.keys[row] = np.frombuffer(key, dtype=np.uint8)
+                self.embeddings[row] = embedding
+                self.meta[2] += 1
+                self.last_used[row] = self.meta[2]
+                self.key_to_row[key] = row
+            self.meta[1] = count + len(free_rows)
+            for array in [self.keys, self.embeddings, self.last_used]:
+                array.flush()
+            self.meta[0] += 1
+            self.meta.flush()
+            self.generation = int(self.meta[0])
+
+    def get_stats(self):
+        return {
+            'model': self.model,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'entries': len(self.key_to_row),
+            'max_entries': self.max_entries,
+        }
+
+
+def get_embedding_cache(model):
+    """
+    Return the shared embedding cache of the model, or None if EMBEDDING_CACHE_DIR is not set.
+    """
+    cache_dir = os.environ.get("EMBEDDING_CACHE_DIR", "")
+    if cache_dir == "":
+        return None
+    max_entries = int(os.environ.get("EMBEDDING_CACHE_MAX_ENTRIES", DEFAULT_MAX_ENTRIES))
+    key = (os.path.abspath(cache_dir), model, max_entries)
+    with _embedding_caches_lock:
+        if key not in _embedding_caches:
+            _embedding_caches[key] = EmbeddingCache(cache_dir, model, max_entries=max_entries)
+        return _embedding_caches[key]
+
+
+def get_embedding_cache_stats():
+    with _embedding_caches_lock:
+        return [cache.get_stats() for cache in _embedding_caches.values()]
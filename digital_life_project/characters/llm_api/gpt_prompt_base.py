@@ -8,56 +8,439 @@ This file is modified from (Author: Joon Sung Park, joonspk@stanford.edu) https:
 """
 
 import json
-from openai import OpenAI, AzureOpenAI
+from openai import OpenAI, AzureOpenAI, AsyncOpenAI, AsyncAzureOpenAI
 import os
 import ast
+import time
 import copy
+import asyncio
+import threading
+import weakref
+import inspect
+import functools
+import contextlib
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+from digital_life_project.characters.llm_api.cassette import get_llm_cassette, get_chat_cassette_key, get_request_hash
+from digital_life_project.characters.llm_api.rate_limiter import get_llm_rate_limiter, is_retryable_llm_error, get_retry_after, get_retry_delay
+from digital_life_project.characters.llm_api.llm_metrics import get_llm_metrics
+from digital_life_project.characters.llm_api.response_parser import repair_response
+from digital_life_project.characters.llm_api.response_memo import get_llm_response_memo
+from digital_life_project.characters.llm_api.json_schema import get_structured_example, unwrap_structured_response, \
+    get_json_schema, get_json_schema_response_format, validate_json_schema
+from digital_life_project.characters.span_tracer import trace_span
 
 
 Likert_description = "In the Likert scale range (1-9), 9 means extremely, 5 means neutral, 1 means not at all."
 
+# each client owns a keep-alive connection pool and is thread-safe,
+# so one client per service is shared by all characters
+_llm_client_registry = {}
+_llm_client_registry_lock = threading.Lock()
+_llm_client_stats = {'constructed': 0}
+# async clients are bound to the event loop that created their connection pool
+_async_llm_client_registry = weakref.WeakKeyDictionary()
+
+
+# LLM traffic of this process, reported per simulation by the society runner
+_llm_usage = {'chat_calls': 0, 'chat_errors': 0, 'embedding_calls': 0,
+              'prompt_tokens': 0, 'completion_tokens': 0, 'embedding_tokens': 0}
+_llm_usage_lock = threading.Lock()
+# semaphore bounding the LLM requests in flight, shared by the processes of a society run
+_llm_concurrency_semaphore = None
+
+
+# the prompt family, its arguments, and the example output of the running request,
+# used by backends that do not call a real model
+llm_request_context = contextvars.ContextVar('llm_request_context', default={})
+# the event loop of an async driver, the LLM requests of the stages it runs in worker threads
+# (see run_llm_stage) are awaited on it with the async clients
+llm_event_loop = contextvars.ContextVar('llm_event_loop', default=None)
+# worker threads of the stages, apart from the default executor used by allm_concurrency_slot
+_llm_stage_executor = ThreadPoolExecutor(max_workers=32, thread_name_prefix='llm_stage')
+
+
+def llm_prompt_family(func):
+    """
+    Mark a run_gpt_* function as a prompt family, so the requests it makes know where they come from.
+    """
+    signature = inspect.signature(func)
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        bound = signature.bind(*args, **kwargs)
+        bound.apply_defaults()
+        token = llm_request_context.set({'family': func.__name__, 'arguments': dict(bound.arguments)})
+        try:
+            with trace_span(func.__name__, 'llm'):
+                return func(*args, **kwargs)
+        finally:
+            llm_request_context.reset(token)
+    return wrapper
+
+
+@contextlib.contextmanager
+def llm_request_attributes(**attributes):
+    """
+    Add attributes to the request context of the LLM calls in the block.
+    """
+    token = llm_request_context.set(dict(llm_request_context.get(), **attributes))
+    try:
+        yield
+    finally:
+        llm_request_context.reset(token)
+
+
+async def run_llm_stage(func, *args, **kwargs):
+    """
+    Run a synchronous stage in a worker thread, with its LLM and embedding requests awaited on the
+    running event loop by the async LLM layer. A driver gathering the stages of several characters
+    overlaps their requests on one loop, with the same results as the sync path.
+    """
+    loop = asyncio.get_running_loop()
+    token = llm_event_loop.set(loop)
+    try:
+        context = contextvars.copy_context()
+        return await loop.run_in_executor(_llm_stage_executor, functools.partial(context.run, func, *args, **kwargs))
+    finally:
+        llm_event_loop.reset(token)
+
+
+def get_llm_stage_loop():
+    # the event loop of the driver, when called from one of its stage threads
+    loop = llm_event_loop.get()
+    if loop is None or not loop.is_running():
+        return None
+    try:
+        asyncio.get_running_loop()
+        return None
+    except RuntimeError:
+        return loop
+
+
+def await_on_llm_stage_loop(loop, coroutine):
+    return asyncio.run_coroutine_threadsafe(coroutine, loop).result()
+
+
+def get_openai_key():
+    return (os.environ["OPENAI_BASE_URL"], os.environ["OPENAI_API_KEY"])
+
+
+def build_openai_client(key, async_client=False):
+    endpoint, api_key = key
+    client_class = AsyncOpenAI if async_client else OpenAI
+    # retries are done by request_llm under the shared rate limiter
+    return client_class(api_key=api_key, base_url=endpoint, max_retries=0)
+
+
+def get_azure_key():
+    return (os.environ["AZURE_OPENAI_ENDPOINT"], os.environ["AZURE_OPENAI_API_KEY"])
+
+
+def build_azure_client(key, async_client=False):
+    endpoint, api_key = key
+    client_class = AsyncAzureOpenAI if async_client else AzureOpenAI
+    return client_class(api_key=api_key, azure_endpoint=endpoint, api_version="2024-08-01-preview", max_retries=0)
+
+
+def get_local_stub_key():
+    return (int(os.environ.get("LLM_STUB_SEED", 0)), float(os.environ.get("LLM_STUB_LATENCY", 0.0)))
+
+
+def build_local_stub_client(key, async_client=False):
+    from digital_life_project.characters.llm_api.local_stub import LocalStubClient, AsyncLocalStubClient
+    seed, latency = key
+    client_class = AsyncLocalStubClient if async_client else LocalStubClient
+    return client_class(seed=seed, latency=latency)
+
+
+# LLM_SERVICE_TYPE -> (function reading the client settings from the environment, client builder)
+_llm_backends = {
+    'openai': (get_openai_key, build_openai_client),
+    'azure': (get_azure_key, build_azure_client),
+    'local-stub': (get_local_stub_key, build_local_stub_client),
+}
+
+
+def register_llm_backend(llm_service_type, get_key, build_client):
+    _llm_backends[llm_service_type] = (get_key, build_client)
+
+
+def get_llm_backend_names():
+    return list(_llm_backends.keys())
+
+
+def get_llm_client_key():
+    # the registry key is read from the environment on every call,
+    # so a changed service, endpoint, or credential maps to a new client
+    llm_service_type = os.environ["LLM_SERVICE_TYPE"]
+    if llm_service_type not in _llm_backends:
+        raise ValueError("Invalid llm service")
+    return (llm_service_type,) + tuple(_llm_backends[llm_service_type][0]())
+
+
+def build_llm_client(key, async_client=False):
+    client = _llm_backends[key[0]][1](key[1:], async_client=async_client)
+    _llm_client_stats['constructed'] += 1
+    return client
+
+
+def get_llm_client():
+    """
+    Return the process-wide client of the current LLM service.
+    Clients are keyed by (service type, endpoint, credentials) and built lazily,
+    so the keep-alive connection pool is reused across calls and threads.
+    """
+    key = get_llm_client_key()
+    client = _llm_client_registry.get(key)
+    if client is None:
+        with _llm_client_registry_lock:
+            client = _llm_client_registry.get(key)
+            if client is None:
+                client = build_llm_client(key)
+                _llm_client_registry[key] = client
+    return client
+
+
+def get_async_llm_client():
+    """
+    Return the async client of the current LLM service for the running event loop.
+    """
+    key = get_llm_client_key()
+    loop = asyncio.get_running_loop()
+    with _llm_client_registry_lock:
+        loop_clients = _async_llm_client_registry.setdefault(loop, {})
+        if key not in loop_clients:
+            loop_clients[key] = build_llm_client(key, async_client=True)
+        return loop_clients[key]
+
+
+def get_llm_client_stats():
+    return {'constructed': _llm_client_stats['constructed'], 'cached': len(_llm_client_registry)}
+
+
+def record_llm_usage(kind, usage=None):
+    with _llm_usage_lock:
+        _llm_usage[kind + '_calls'] += 1
+        if usage is None:
+            return
+        if kind == 'chat':
+            _llm_usage['prompt_tokens'] += getattr(usage, 'prompt_tokens', 0) or 0
+            _llm_usage['completion_tokens'] += getattr(usage, 'completion_tokens', 0) or 0
+        else:
+            _llm_usage['embedding_tokens'] += getattr(usage, 'total_tokens', 0) or 0
+
+
+def record_llm_error():
+    with _llm_usage_lock:
+        _llm_usage['chat_errors'] += 1
+
+
+def get_llm_usage():
+    with _llm_usage_lock:
+        return dict(_llm_usage)
+
+
+def set_llm_concurrency_semaphore(semaphore):
+    """
+    Share a multiprocessing semaphore as the LLM concurrency budget of this process, None for no budget.
+    """
+    global _llm_concurrency_semaphore
+    _llm_concurrency_semaphore = semaphore
+
+
+@contextlib.contextmanager
+def llm_concurrency_slot():
+    semaphore = _llm_concurrency_semaphore
+    if semaphore is None:
+        yield
+        return
+    semaphore.acquire()
+    try:
+        yield
+    finally:
+        semaphore.release()
+
+
+@contextlib.asynccontextmanager
+async def allm_concurrency_slot():
+    semaphore = _llm_concurrency_semaphore
+    if semaphore is None:
+        yield
+        return
+    # the semaphore blocks, so it is acquired off the event loop
+    await asyncio.to_thread(semaphore.acquire)
+    try:
+        yield
+    finally:
+        semaphore.release()
+
+
+def get_llm_max_retries():
+    return int(os.environ.get("LLM_MAX_RETRIES", 5))
+
+
+def estimate_llm_tokens(texts):
+    # about 4 characters per token, settled with the reported usage after the request
+    return sum(len(text) for text in texts) // 4 + 1
+
+
+def get_usage_tokens(response):
+    return getattr(getattr(response, 'usage', None), 'total_tokens', None)
+
+
+def wait_llm_retry(error, attempt, limiter):
+    delay = get_retry_delay(error, attempt)
+    if limiter is not None and get_retry_after(error) is not None:
+        # the quota is exhausted for every request, not only for this one
+        limiter.pause(delay)
+    print(f"LLM request retry {attempt+1} in {delay:.1f}s: {type(error).__name__}")
+    return delay
+
+
+def get_llm_family(kind='chat'):
+    if kind == 'embedding':
+        return 'embeddings'
+    return llm_request_context.get().get('family', 'unknown')
+
+
+def record_llm_call(kind, start_time, response=None, retries=0, error=False):
+    get_llm_metrics().record_call(get_llm_family(kind), time.perf_counter() - start_time,
+                                  usage=getattr(response, 'usage', None), retries=retries,
+                                  reformat=llm_request_context.get().get('reformat', False), error=error)
+
+
+def request_llm(create, request_kwargs, estimated_tokens, kind='chat'):
+    """
+    Call the LLM service under the shared rate limiter and concurrency budget.
+    Rate limits and transient errors are retried with exponential backoff and jitter,
+    other errors are raised. The call is recorded in the LLM metrics.
+    """
+    limiter = get_llm_rate_limiter()
+    max_retries = get_llm_max_retries()
+    start_time = time.perf_counter()
+    for attempt in range(max_retries + 1):
+        if limiter is not None:
+            limiter.acquire(estimated_tokens)
+        try:
+            with trace_span('llm_wait', 'llm', family=get_llm_family(kind)):
+                with llm_concurrency_slot():
+                    response = create(**request_kwargs)
+        except Exception as e:
+            if attempt == max_retries or not is_retryable_llm_error(e):
+                record_llm_call(kind, start_time, retries=attempt, error=True)
+                raise
+            time.sleep(wait_llm_retry(e, attempt, limiter))
+            continue
+        if limiter is not None:
+            limiter.settle(estimated_tokens, get_usage_tokens(response))
+        record_llm_call(kind, start_time, response=response, retries=attempt)
+        return response
+
+
+async def arequest_llm(create, request_kwargs, estimated_tokens, kind='chat'):
+    limiter = get_llm_rate_limiter()
+    max_retries = get_llm_max_retries()
+    start_time = time.perf_counter()
+    for attempt in range(max_retries + 1):
+        if limiter is not None:
+            await limiter.aacquire(estimated_tokens)
+        try:
+            with trace_span('llm_wait', 'llm', family=get_llm_family(kind)):
+                async with allm_concurrency_slot():
+                    response = await create(**request_kwargs)
+        except Exception as e:
+            if attempt == max_retries or not is_retryable_llm_error(e):
+                record_llm_call(kind, start_time, retries=attempt, error=True)
+                raise
+            await asyncio.sleep(wait_llm_retry(e, attempt, limiter))
+            continue
+        if limiter is not None:
+            limiter.settle(estimated_tokens, get_usage_tokens(response))
+        record_llm_call(kind, start_time, response=response, retries=attempt)
+        return response
+
+
+def get_llm_structured_outputs():
+    # LLM_STRUCTURED_OUTPUTS=0 falls back to the json_object mode for services without json_schema
+    return os.environ.get("LLM_STRUCTURED_OUTPUTS", "1") != "0"
+
+
+def get_chat_request_kwargs(messages, model, temperature, presence_penalty, json_response, response_format=None):
+    if type(messages) is not list:
+        messages = [{"role": "user", "content": messages}]
+    if response_format is None:
+        response_format = {"type": "json_object" if json_response else "text"}
+    return {
+        'model': model,
+        'messages': messages,
+        'response_format': response_format,
+        'presence_penalty': presence_penalty,
+        'temperature': temperature,
+    }
+
+
+def get_chat_memo_key(messages, response_format, model="gpt-4o", temperature=1., presence_penalty=0.0):
+    # the request of ChatGPT_request_messages with its default model and sampling
+    return get_request_hash(get_chat_request_kwargs(messages, model, temperature, presence_penalty, False, response_format))
+
 
 def ChatGPT_request_messages(messages, 
                              model="gpt-4o",
                              temperature=1.,
                              presence_penalty=0.0,
-                             json_response=False): 
+                             json_response=False,
+                             response_format=None): 
+  loop = get_llm_stage_loop()
+  if loop is not None:
+    return await_on_llm_stage_loop(loop, aChatGPT_request_messages(messages, model, temperature, presence_penalty, json_response, response_format))
+  request_kwargs = get_chat_request_kwargs(messages, model, temperature, presence_penalty, json_response, response_format)
+  cassette = get_llm_cassette()
+  if cassette is not None:
+    found, content = cassette.get(get_chat_cassette_key(request_kwargs))
+    if found:
+      get_llm_metrics().record_cassette_hit(get_llm_family())
+      return content
   try: 
-    llm_service_type = os.environ["LLM_SERVICE_TYPE"]
-    if llm_service_type == 'openai':
-        api_key = os.environ["OPENAI_API_KEY"]
-        base_url = os.environ["OPENAI_BASE_URL"]
-        client = OpenAI(api_key=api_key, base_url=base_url)
-    elif llm_service_type == 'azure':
-        api_key = os.environ["AZURE_OPENAI_API_KEY"]
-        azure_endpoint=os.environ["AZURE_OPENAI_ENDPOINT"]
-        client = AzureOpenAI(api_key=api_key, azure_endpoint=azure_endpoint, api_version="2024-05-01-preview")
-    else:
-        raise ValueError("Invalid llm service")
-    
-    response_format = {"type": "json_object" if json_response else "text"}
-    
-    if type(messages) is not list:
-        messages = [{"role": "user", "content": messages}]
-        completion = client.chat.completions.create(
-        model=model, 
-        messages=messages,
-        response_format=response_format,
-        presence_penalty=presence_penalty,
-        temperature=temperature,
-        )
-    else:
-        completion = client.chat.completions.create(
-        model=model, 
-        messages=messages,
-        response_format=response_format,
-        presence_penalty=presence_penalty,
-        temperature=temperature,
-        )
-    return completion.choices[0].message.content
-  except: 
+    client = get_llm_client()
+    completion = request_llm(client.chat.completions.create, request_kwargs,
+                             estimate_llm_tokens([str(message['content']) for message in request_kwargs['messages']]))
+    content = completion.choices[0].message.content
+  except Exception: 
+    print ("ChatGPT RETURN ERROR")
+    record_llm_error()
+    return False
+  record_llm_usage('chat', getattr(completion, 'usage', None))
+  if cassette is not None:
+    cassette.put(get_chat_cassette_key(request_kwargs), content)
+  return content
+
+
+async def aChatGPT_request_messages(messages, 
+                                    model="gpt-4o",
+                                    temperature=1.,
+                                    presence_penalty=0.0,
+                                    json_response=False,
+                                    response_format=None): 
+  request_kwargs = get_chat_request_kwargs(messages, model, temperature, presence_penalty, json_response, response_format)
+  cassette = get_llm_cassette()
+  if cassette is not None:
+    found, content = cassette.get(get_chat_cassette_key(request_kwargs))
+    if found:
+      get_llm_metrics().record_cassette_hit(get_llm_family())
+      return content
+  try: 
+    client = get_async_llm_client()
+    completion = await arequest_llm(client.chat.completions.create, request_kwargs,
+                                    estimate_llm_tokens([str(message['content']) for message in request_kwargs['messages']]))
+    content = completion.choices[0].message.content
+  except Exception: 
     print ("ChatGPT RETURN ERROR")
+    record_llm_error()
     return False
+  record_llm_usage('chat', getattr(completion, 'usage', None))
+  if cassette is not None:
+    cassette.put(get_chat_cassette_key(request_kwargs), content)
+  return content
 
 
 def find_all_positions(s, char):
@@ -91,31 +474,79 @@ def check_string_to_double_quotes(example):
     return ''.join(res)
 
 
-def response_reformat(response, example):
+def parse_response_locally(response, json_response=False):
+    """
+    Parse a dict/list response as before, or else repair it locally,
+    and count the repairs and failures of each prompt family.
+    """
+    try:
+        if json_response:
+            return json.loads(response)
+        return ast.literal_eval(check_string_to_double_quotes(response))
+    except:
+        pass
+    try:
+        value = repair_response(response)
+    except ValueError:
+        get_llm_metrics().record_parse(get_llm_family(), repaired=False)
+        raise
+    get_llm_metrics().record_parse(get_llm_family(), repaired=True)
+    return value
+
+
+def get_response_reformat_prompt(response, example):
     prompt = f"Modify the format of the input string according to the format of the sample. " +\
         f"Note that the input content cannot be changed, but the format of the input must be consistent with that of the sample"
     prompt += f"\nExample:\n" + '' + str(example) + '\n'
     
     prompt += f"\nInput string: \n{response}\n"
     prompt += f"\nOutput the result directly, without any superfluous content.So the output should be \n"
-    future = ChatGPT_request_messages(prompt)
+    return prompt
+
+
+def response_reformat(response, example):
+    future = ChatGPT_request_messages(get_response_reformat_prompt(response, example))
     curr_gpt_response = future
     return curr_gpt_response
 
 
-def ChatGPT_safe_generate_response(prompt, 
-                                   example_output,
-                                   special_instruction,
-                                   repeat=3,
-                                   fail_safe_response="error",
-                                   func_validate=None,
-                                   func_clean_up=None,
-                                   verbose=False,
-                                   json_response=False): 
+def accept_response(output, response, on_accept):
+    if on_accept is not None:
+        on_accept(response)
+    return output
+
+
+def safe_generate_steps(prompt, 
+                        example_output,
+                        special_instruction,
+                        repeat=3,
+                        fail_safe_response="error",
+                        func_validate=None,
+                        func_clean_up=None,
+                        verbose=False,
+                        json_response=False,
+                        on_accept=None):
+    """
+    Retry loop of ChatGPT_safe_generate_response without I/O.
+    It yields (messages, response_format, reformat) for each LLM request and receives the response,
+    so the sync and async versions share the same prompting, parsing, and validation.
+    reformat is True for the request reformatting an unparsable response.
+    With json_response, the response follows the JSON schema of the example output and is checked
+    against it before func_validate, and there is no reformat request.
+    on_accept is called with the response accepted by func_validate.
+    repeat only retries invalid responses. A failed request was already retried by request_llm,
+    so it returns the fail safe response.
+    """
     if json_response:
+        structured_example = get_structured_example(example_output)
+        response_schema = get_json_schema(structured_example)
+        if get_llm_structured_outputs():
+            response_format = get_json_schema_response_format(get_llm_family(), response_schema)
+        else:
+            response_format = {"type": "json_object"}
         ret_prompt_json = f"\n\nOutput the response to the prompt above in json. {special_instruction}\n"
         ret_prompt_json += "Example output json:\n"
-        ret_prompt_json += str(example_output)
+        ret_prompt_json += json.dumps(structured_example, ensure_ascii=False)
         prompt_json = copy.deepcopy(prompt)
         if type(prompt_json) is list:
             prompt_json[-1]['content'] += ret_prompt_json
@@ -145,36 +576,141 @@ def ChatGPT_safe_generate_response(prompt,
     for i in range(repeat): 
         try:
             if json_response:
-                curr_gpt_response_json = ChatGPT_request_messages(prompt_json, json_response=True)
-                curr_gpt_response = json.loads(curr_gpt_response_json)
-            else:
-                curr_gpt_response = ChatGPT_request_messages(prompt)
-                if curr_gpt_response == False:
-                    continue    
-                curr_gpt_response = curr_gpt_response.strip()
+                curr_gpt_response_json = yield prompt_json, response_format, False
+                if curr_gpt_response_json is False:
+                    break
+                curr_gpt_response = parse_response_locally(curr_gpt_response_json, json_response=True)
+                if not validate_json_schema(curr_gpt_response, response_schema):
+                    raise ValueError("Response does not match the schema")
+                curr_gpt_response = unwrap_structured_response(curr_gpt_response, example_output)
+                if func_validate(curr_gpt_response, prompt=prompt): 
+                    return accept_response(func_clean_up(curr_gpt_response, prompt=prompt), curr_gpt_response_json, on_accept)
+                continue
+            curr_gpt_response = yield prompt, {"type": "text"}, False
+            if curr_gpt_response is False:
+                break
+            raw_gpt_response = curr_gpt_response
+            curr_gpt_response = curr_gpt_response.strip()
+            if type(example_output) is str:
                 curr_gpt_response = check_string_to_double_quotes(curr_gpt_response)
             try:
-                if not json_response:
-                    if type(example_output) is not str:
-                        curr_gpt_response = ast.literal_eval(curr_gpt_response)
+                if type(example_output) is not str:
+                    # the local repairs save the reformat request for most malformed responses
+                    curr_gpt_response = parse_response_locally(curr_gpt_response)
                 if func_validate(curr_gpt_response, prompt=prompt): 
-                    return func_clean_up(curr_gpt_response, prompt=prompt)
+                    return accept_response(func_clean_up(curr_gpt_response, prompt=prompt), raw_gpt_response, on_accept)
             except:
-                curr_gpt_response = response_reformat(curr_gpt_response, example_output)
+                curr_gpt_response = yield get_response_reformat_prompt(curr_gpt_response, example_output), {"type": "text"}, True
+                if curr_gpt_response is False:
+                    break
+                raw_gpt_response = curr_gpt_response
                 curr_gpt_response = check_string_to_double_quotes(curr_gpt_response)
                 try:
                     if type(example_output) is not str:
-                        curr_gpt_response = ast.literal_eval(curr_gpt_response)
+                        curr_gpt_response = parse_response_locally(curr_gpt_response)
                 except:
                     pass
                 if func_validate(curr_gpt_response, prompt=prompt): 
-                    return func_clean_up(curr_gpt_response, prompt=prompt)
+                    return accept_response(func_clean_up(curr_gpt_response, prompt=prompt), raw_gpt_response, on_accept)
             
             if verbose: 
                 print ("---- repeat count: \n", i, curr_gpt_response)
                 print (curr_gpt_response)
                 print ("~~~~")
+        except GeneratorExit:
+            # the driver stopped, e.g. on a cassette miss
+            raise
         except:
             pass
 
-    return fail_safe_response()
\ No newline at end of file
+    return fail_safe_response()
+
+
+def ChatGPT_safe_generate_response(prompt, 
+                                   example_output,
+                                   special_instruction,
+                                   repeat=3,
+                                   fail_safe_response="error",
+                                   func_validate=None,
+                                   func_clean_up=None,
+                                   verbose=False,
+                                   json_response=False): 
+    loop = get_llm_stage_loop()
+    if loop is not None:
+        return await_on_llm_stage_loop(loop, aChatGPT_safe_generate_response(prompt, example_output, special_instruction, repeat, fail_safe_response,
+                                                                             func_validate, func_clean_up, verbose, json_response))
+    # the validated responses of the memoized families answer the same prompt later
+    memo = get_llm_response_memo(get_llm_family())
+    accepted = []
+    steps = safe_generate_steps(prompt, example_output, special_instruction, repeat, fail_safe_response,
+                                func_validate, func_clean_up, verbose, json_response, on_accept=accepted.append)
+    if json_response:
+        example_output = get_structured_example(example_output)
+    token = llm_request_context.set(dict(llm_request_context.get(), example_output=example_output))
+    memo_key = None
+    found = False
+    try:
+        with trace_span('prompt_assembly', 'llm'):
+            messages, response_format, reformat = next(steps)
+        if memo is not None:
+            memo_key = get_chat_memo_key(messages, response_format)
+            found, response = memo.get(get_llm_family(), memo_key)
+            if found:
+                get_llm_metrics().record_memo_hit(get_llm_family())
+        while True:
+            if not found:
+                with llm_request_attributes(reformat=reformat):
+                    response = ChatGPT_request_messages(messages, response_format=response_format)
+            with trace_span('response_parsing', 'llm'):
+                messages, response_format, reformat = steps.send(response)
+            found = False
+    except StopIteration as result:
+        # a memo hit is accepted as is, its entry was refreshed by memo.get
+        if memo_key is not None and len(accepted) > 0 and not found:
+            memo.put(get_llm_family(), memo_key, accepted[-1])
+        return result.value
+    finally:
+        llm_request_context.reset(token)
+
+
+async def aChatGPT_safe_generate_response(prompt, 
+                                          example_output,
+                                          special_instruction,
+                                          repeat=3,
+                                          fail_safe_response="error",
+                                          func_validate=None,
+                                          func_clean_up=None,
+                                          verbose=False,
+                                          json_response=False): 
+    # the validated responses of the memoized families answer the same prompt later
+    memo = get_llm_response_memo(get_llm_family())
+    accepted = []
+    steps = safe_generate_steps(prompt, example_output, special_instruction, repeat, fail_safe_response,
+                                func_validate, func_clean_up, verbose, json_response, on_accept=accepted.append)
+    if json_response:
+        example_output = get_structured_example(example_output)
+    token = llm_request_context.set(dict(llm_request_context.get(), example_output=example_output))
+    memo_key = None
+    found = False
+    try:
+        with trace_span('prompt_assembly', 'llm'):
+            messages, response_format, reformat = next(steps)
+        if memo is not None:
+            memo_key = get_chat_memo_key(messages, response_format)
+            found, response = memo.get(get_llm_family(), memo_key)
+            if found:
+                get_llm_metrics().record_memo_hit(get_llm_family())
+        while True:
+            if not found:
+                with llm_request_attributes(reformat=reformat):
+                    response = await aChatGPT_request_messages(messages, response_format=response_format)
+            with trace_span('response_parsing', 'llm'):
+                messages, response_format, reformat = steps.send(response)
+            found = False
+    except StopIteration as result:
+        # a memo hit is accepted as is, its entry was refreshed by memo.get
+        if memo_key is not None and len(accepted) > 0 and not found:
+            memo.put(get_llm_family(), memo_key, accepted[-1])
+        return result.value
+    finally:
+        llm_request_context.reset(token)
@@ -8,7 +8,11 @@ This file is modified from (Author: Joon Sung Park, joonspk@stanford.edu) https:
 """
 import os
 from digital_life_project.characters.llm_api.gpt_prompt_base import *
+from digital_life_project.characters.llm_api.embedding_cache import get_embedding_cache
+from digital_life_project.characters.llm_api.cassette import get_embedding_cassette_key
 
+# maximal number of inputs in one embedding request of the provider
+EMBEDDING_BATCH_SIZE = 2048
 
 def compare_types(obj1, obj2):
     if type(obj1) != type(obj2):
@@ -33,33 +37,110 @@ def compare_types(obj1, obj2):
     return True
 
 
-def get_embedding(text, model="text-embedding-ada-002"):
-    
-    llm_service_type = os.environ["LLM_SERVICE_TYPE"]
-    if llm_service_type == 'openai':
-        api_key = os.environ["OPENAI_API_KEY"]
-        base_url = os.environ["OPENAI_BASE_URL"]
-        client = OpenAI(api_key=api_key, base_url=base_url)
-    elif llm_service_type == 'azure':
-        api_key = os.environ["AZURE_OPENAI_API_KEY"]
-        azure_endpoint=os.environ["AZURE_OPENAI_ENDPOINT"]
-        client = AzureOpenAI(api_key=api_key, azure_endpoint=azure_endpoint, api_version="2024-05-01-preview")
-    else:
-        raise ValueError("Invalid llm service")
-    
+def get_embedding_input(text):
     text = text.replace("\n", " ")
     if not text: 
         text = "this is blank"
-    res = None
-    while type(res) != list:
+    return text
+
+
+def get_embedding(text, model="text-embedding-ada-002"):
+    return get_embeddings([text], model=model)[0]
+
+
+def get_cached_embeddings(inputs, model):
+    # look up the persistent embedding cache and then the cassette before any network call,
+    # so a replay does not miss the embeddings kept in the cache
+    unique_inputs = list(dict.fromkeys(inputs))
+    embeddings = {}
+    cassette = get_llm_cassette()
+    cache = get_embedding_cache(model)
+    if cache is not None:
+        cache_hits = cache.get_many(unique_inputs)
+        for text, embedding in cache_hits.items():
+            embeddings[text] = embedding.tolist()
+            if cassette is not None:
+                # keep the cassette complete for replays without the cache
+                cassette.put(get_embedding_cassette_key(text, model), embeddings[text], unique=True)
+    if cassette is not None:
+        for text in unique_inputs:
+            if text not in embeddings:
+                found, embedding = cassette.get(get_embedding_cassette_key(text, model))
+                if found:
+                    embeddings[text] = embedding
+    return embeddings
+
+
+def put_cached_embeddings(embeddings, model):
+    cache = get_embedding_cache(model)
+    if cache is not None:
+        cache.put_many(list(embeddings.keys()), list(embeddings.values()))
+    cassette = get_llm_cassette()
+    if cassette is not None:
+        for text, embedding in embeddings.items():
+            cassette.put(get_embedding_cassette_key(text, model), embedding, unique=True)
+
+
+def get_embeddings(texts, model="text-embedding-ada-002", batch_size=EMBEDDING_BATCH_SIZE):
+    """
+    Embed a list of texts with as few requests as possible.
+    Identical texts are embedded once, and the embeddings keep the order of the inputs.
+    """
+    if len(texts) == 0:
+        return []
+    loop = get_llm_stage_loop()
+    if loop is not None:
+        return await_on_llm_stage_loop(loop, aget_embeddings(texts, model=model, batch_size=batch_size))
+    inputs = [get_embedding_input(text) for text in texts]
+    unique_embeddings = get_cached_embeddings(inputs, model)
+    missing_inputs = [text for text in dict.fromkeys(inputs) if text not in unique_embeddings]
+    new_embeddings = {}
+    if len(missing_inputs) > 0:
+        client = get_llm_client()
+    for start in range(0, len(missing_inputs), batch_size):
+        batch = missing_inputs[start:start+batch_size]
+        try:
+            # request_llm retries the transient errors, the others and the last retry are raised
+            response = request_llm(client.embeddings.create, {'input': batch, 'model': model}, estimate_llm_tokens(batch), kind='embedding')
+        except:
+            print("get_embedding ERROR")
+            raise
+        record_llm_usage('embedding', getattr(response, 'usage', None))
+        new_embeddings.update(zip(batch, [item.embedding for item in sorted(response.data, key=lambda x: x.index)]))
+    put_cached_embeddings(new_embeddings, model)
+    unique_embeddings.update(new_embeddings)
+    return [unique_embeddings[text] for text in inputs]
+
+
+async def aget_embedding(text, model="text-embedding-ada-002"):
+    return (await aget_embeddings([text], model=model))[0]
+
+
+async def aget_embeddings(texts, model="text-embedding-ada-002", batch_size=EMBEDDING_BATCH_SIZE):
+    if len(texts) == 0:
+        return []
+    inputs = [get_embedding_input(text) for text in texts]
+    unique_embeddings = get_cached_embeddings(inputs, model)
+    missing_inputs = [text for text in dict.fromkeys(inputs) if text not in unique_embeddings]
+    new_embeddings = {}
+    if len(missing_inputs) > 0:
+        client = get_async_llm_client()
+    for start in range(0, len(missing_inputs), batch_size):
+        batch = missing_inputs[start:start+batch_size]
         try:
-            response = client.embeddings.create(input=[text], model=model)
-            res = response.data[0].embedding
+            # arequest_llm retries the transient errors, the others and the last retry are raised
+            response = await arequest_llm(client.embeddings.create, {'input': batch, 'model': model}, estimate_llm_tokens(batch), kind='embedding')
         except:
             print("get_embedding ERROR")
-    return res
+            raise
+        record_llm_usage('embedding', getattr(response, 'usage', None))
+        new_embeddings.update(zip(batch, [item.embedding for item in sorted(response.data, key=lambda x: x.index)]))
+    put_cached_embeddings(new_embeddings, model)
+    unique_embeddings.update(new_embeddings)
+    return [unique_embeddings[text] for text in inputs]
         
 
+@llm_prompt_family
 def run_gpt_get_quantitative_emotion_from_description(desc, verbose=False):
     if verbose:
         print('run_gpt_get_quantitative_emotion_from_description: ', desc)
@@ -119,6 +200,7 @@ def run_gpt_get_quantitative_emotion_from_description(desc, verbose=False):
     return output
 
 
+@llm_prompt_family
 def run_gpt_get_quantitative_personality_from_description(desc, verbose=False):
     if verbose:
         print('run_gpt_get_quantitative_personality_from_description: ', desc)
@@ -176,6 +258,7 @@ def run_gpt_get_quantitative_personality_from_description(desc, verbose=False):
     return output 
 
 
+@llm_prompt_family
 def run_gpt_get_qualitative_personality_from_quantitative(personality, verbose=False):
     if verbose:
         print('run_gpt_get_qualitative_personality_from_quantitative: ', personality)
@@ -201,17 +284,18 @@ def run_gpt_get_qualitative_personality_from_quantitative(personality, verbose=F
             return False 
     
     def __func_clean_up(gpt_response, prompt=""):
-        if gpt_response is str and len(gpt_response.split()) <= 15:
+        if type(gpt_response) is str and len(gpt_response.split()) <= 15:
             return gpt_response
         else:
             raise Exception("Invalid output format")
     
     fail_safe = get_fail_safe
     output = ChatGPT_safe_generate_response(prompt, example_output, special_instruction, 
-                                            5, fail_safe, __chat_func_validate, __func_clean_up, verbose)
+                                            5, fail_safe, __chat_func_validate, __func_clean_up, verbose, json_response=True)
     return output
 
 
+@llm_prompt_family
 def run_gpt_get_qualitative_emotion_from_quantitative(emotion_dicts, verbose=False):
     if verbose:
         print('run_gpt_get_qualitative_emotion_from_quantitative: ', emotion_dicts)
@@ -239,17 +323,18 @@ def run_gpt_get_qualitative_emotion_from_quantitative(emotion_dicts, verbose=Fal
             return False 
     
     def __func_clean_up(gpt_response, prompt=""):
-        if gpt_response is str and len(gpt_response.split()) <= 15:
+        if type(gpt_response) is str and len(gpt_response.split()) <= 15:
             return gpt_response
         else:
             raise Exception("Invalid output format")
     
     fail_safe = get_fail_safe
     output = ChatGPT_safe_generate_response(prompt, example_output, special_instruction, 
-                                            5, fail_safe, __chat_func_validate, __func_clean_up, verbose)
+                                            5, fail_safe, __chat_func_validate, __func_clean_up, verbose, json_response=True)
     return output
 
 
+@llm_prompt_family
 def run_gpt_get_emotion_from_prompt(prompt_, verbose=False):
     if verbose:
         print('run_gpt_get_emotion_from_prompt: ', prompt_)
@@ -294,6 +379,7 @@ def run_gpt_get_emotion_from_prompt(prompt_, verbose=False):
     return output
 
 
+@llm_prompt_family
 def run_gpt_get_keywords_poignancy_from_description(desc, background, verbose=False):
 
     def __func_clean_up(gpt_response, prompt=""):
@@ -339,6 +425,7 @@ def run_gpt_get_keywords_poignancy_from_description(desc, background, verbose=Fa
     return output
 
 
+@llm_prompt_family
 def run_gpt_get_quantitative_relationship_from_description(desc, attitude='', verbose=False):
     if verbose:
         print('run_gpt_get_quantitative_relationship_from_description: ', desc)
@@ -392,6 +479,7 @@ def run_gpt_get_quantitative_relationship_from_description(desc, attitude='', ve
     return output
 
 
+@llm_prompt_family
 def run_gpt_get_topics_from_events_personal_info(personal_info, relevant_info, verbose=False):
     if verbose:
         print('run_gpt_get_topics_from_events_personal_info.')
@@ -455,6 +543,7 @@ def run_gpt_get_topics_from_events_personal_info(personal_info, relevant_info, v
     return output
 
 
+@llm_prompt_family
 def run_gpt_get_indices_from_deduplicating_topics(prompt, topic_acc=0, verbose=False):
     if verbose:
         print('run_gpt_get_indices_from_deduplicating_topics.')
@@ -508,6 +597,7 @@ def check_format_length(inputs, max_lengths):
     return results
 
 
+@llm_prompt_family
 def run_gpt_refinement(behavior, verbose=False):
     speech_max_length = 30
     expression_max_length = 4
@@ -548,10 +638,11 @@ def run_gpt_refinement(behavior, verbose=False):
                     break
                 else:
                     res_ = ChatGPT_safe_generate_response(prompt, example_output, special_instruction, 5, fail_safe,
-                                                __chat_func_validate, __func_clean_up, verbose=verbose)
+                                                __chat_func_validate, __func_clean_up, verbose=verbose, json_response=True)
     return behavior
 
 
+@llm_prompt_family
 def run_gpt_summarize_sentence(sentence, lens=5, verbose=False):
     if verbose:
         print('run_gpt_summarize_sentence: ', sentence)
@@ -580,10 +671,11 @@ def run_gpt_summarize_sentence(sentence, lens=5, verbose=False):
     
     fail_safe = get_fail_safe
     output = ChatGPT_safe_generate_response(prompt, example_output, special_instruction, 
-                                            5, fail_safe, __chat_func_validate, __func_clean_up, verbose)
+                                            5, fail_safe, __chat_func_validate, __func_clean_up, verbose, json_response=True)
     return output
 
 
+@llm_prompt_family
 def run_gpt_prompt_decision_dialog(messages, names=['Xiaotao', 'Zhixu'], verbose=False):
     def get_fail_safe(): 
         return {'self_name': names[0], 'speech': '', 'expression': '', 'motion': '', 'place': '', 'partner_name': names[1],}
@@ -597,28 +689,16 @@ def run_gpt_prompt_decision_dialog(messages, names=['Xiaotao', 'Zhixu'], verbose
 
     
     def __func_clean_up(gpt_response, prompt=""):
-        example = {'self_name': 'Xiaotao','speech': 'How are you?', 'expression': 'smile', 'motion': 'wave hands', 'place': 'bookshelf', 'partner_name': 'Zhixu',}
-        behavior_dict = {}
-        if gpt_response in ['END', 'end', '"END"', '"end"']:
-            return gpt_response
-        for item in gpt_response.split('<'):
-            if item == '':
-                continue
-            if '>' in item and len(item) >= 2:
-                key, value = item.split('>')
-                if key in example.keys():
-                    behavior_dict[key] = value
-        
-        if compare_types(behavior_dict, example):
-            behavior_dict['place'] = behavior_dict['place'].strip().lower()
-            if behavior_dict['place'] not in ["sofa", "desk", "dining table", "bookshelf"]:
-                raise Exception("Invalid output format")
-            else:
-                return behavior_dict
-        else:
+        if gpt_response['end']:
+            return 'END'
+        behavior_dict = {key: value for key, value in gpt_response.items() if key != 'end'}
+        behavior_dict['place'] = behavior_dict['place'].strip().lower()
+        if behavior_dict['place'] not in ["sofa", "desk", "dining table", "bookshelf"]:
             raise Exception("Invalid output format")
+        return behavior_dict
     
-    example_output = "<self_name>Xiaotao<speech>How are you?<expression>smile<motion>wave hands<place>bookshelf<partner_name>Zhixu"
+    # 'end' is true to end the conversation, the other keys are the reaction otherwise
+    example_output = {'end': False, 'self_name': 'Xiaotao', 'speech': 'How are you?', 'expression': 'smile', 'motion': 'wave hands', 'place': 'bookshelf', 'partner_name': 'Zhixu',}
     
     fail_safe = get_fail_safe
     special_instruction = f"The output must follow the format of the example output mentioned above. Remember in this interactive conversation body language weigh 30% of the signal expression." +\
@@ -627,9 +707,9 @@ def run_gpt_prompt_decision_dialog(messages, names=['Xiaotao', 'Zhixu'], verbose
             f"Remember the motions are based on the moment when the people stand instead of sitting."
     special_instruction += f"{Likert_description}"
     
-    output = ChatGPT_safe_generate_response(messages, example_output, special_instruction, 6, fail_safe, __chat_func_validate, __func_clean_up, verbose=verbose)
+    output = ChatGPT_safe_generate_response(messages, example_output, special_instruction, 6, fail_safe, __chat_func_validate, __func_clean_up, verbose=verbose, json_response=True)
 
-    if output in ['END', 'end', '"END"', '"end"']:
+    if output == 'END':
         return output
 
     if output != False: 
@@ -637,6 +717,7 @@ def run_gpt_prompt_decision_dialog(messages, names=['Xiaotao', 'Zhixu'], verbose
         return output
 
 
+@llm_prompt_family
 def run_gpt_prompt_summarize_events_from_dialog(innate_trait_prompt, memory_prompt, verbose=False):
     def get_fail_safe(): 
         return []
@@ -695,6 +776,7 @@ def run_gpt_prompt_summarize_events_from_dialog(innate_trait_prompt, memory_prom
         return output
 
 
+@llm_prompt_family
 def run_gpt_prompt_summarize_thoughts_from_events(innate_trait_prompt, memory_prompt, verbose=False):
     def get_fail_safe(): 
         return []
@@ -753,6 +835,7 @@ def run_gpt_prompt_summarize_thoughts_from_events(innate_trait_prompt, memory_pr
         return output
     
     
+@llm_prompt_family
 def run_gpt_prompt_core_self_update(innate_trait_prompt, reflection_prompt, verbose=False):
     def get_fail_safe(): 
         return {"conflict": "N", "belief": "I am a realistic human that can feel and enjoy the life."}
@@ -798,6 +881,7 @@ def run_gpt_prompt_core_self_update(innate_trait_prompt, reflection_prompt, verb
         return output
     
 
+@llm_prompt_family
 def run_gpt_prompt_relationship_update(innate_trait_prompt, reflection_prompt, verbose=False):
     def get_fail_safe(): 
         return {"intimacy": -1, 'trust':-1, "supportiveness":-1, 'description': "", "attitude": ""}
@@ -843,6 +927,7 @@ def run_gpt_prompt_relationship_update(innate_trait_prompt, reflection_prompt, v
         return output
     
 
+@llm_prompt_family
 def run_gpt_prompt_motivation_update(innate_trait_prompt, reflection_prompt, verbose=False):
     def get_fail_safe(): 
         return {"long_term": {"changed": "N", "value": "Explore the meaning of human life."}, "short_term": {"changed": "Y", "value": "Know Zhixu's heart"}}
@@ -890,6 +975,7 @@ def run_gpt_prompt_motivation_update(innate_trait_prompt, reflection_prompt, ver
         return output
     
     
+@llm_prompt_family
 def run_gpt_get_plot_proposals_from_topics_and_personal_info(prompt_personal_info, topic_prompt, plot_prompt, lens=100, verbose=False):
     def get_fail_safe(): 
         return []
@@ -949,6 +1035,7 @@ def run_gpt_get_plot_proposals_from_topics_and_personal_info(prompt_personal_inf
         return output
 
 
+@llm_prompt_family
 def run_gpt_get_plot_setup_from_personal_info_and_background(prompt_personal_info, prompt_new_plot_info, names=['Zhixu', 'Xiaotao'], verbose=False):
     def get_fail_safe(): 
         return {names[0]: {'emotion': '', 'behavior': {'place':'chair', 'motion': ''}},
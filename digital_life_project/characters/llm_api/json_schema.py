@@ -0,0 +1,69 @@
+"""
+File: json_schema.py
+Description: JSON schemas of the example outputs of the prompt families, for structured outputs
+
+The schema of a prompt family is derived from its example output: a dict is an object whose keys
+are all required and no other keys are allowed, a list is an array of the type of its first item,
+and the scalars keep their types. The structured-output response format needs an object at the root,
+so the other example outputs are wrapped in {"response": ...} and unwrapped after parsing.
+The same schema validates the parsed response before the validation of the prompt family.
+"""
+import re
+
+
+STRUCTURED_OUTPUT_KEY = 'response'
+SCALAR_SCHEMA_TYPES = {bool: 'boolean', int: 'integer', float: 'number', str: 'string'}
+
+
+def get_structured_example(example_output):
+    if type(example_output) is dict:
+        return example_output
+    return {STRUCTURED_OUTPUT_KEY: example_output}
+
+
+def unwrap_structured_response(response, example_output):
+    if type(example_output) is dict:
+        return response
+    return response[STRUCTURED_OUTPUT_KEY]
+
+
+def get_json_schema(example):
+    if type(example) is dict:
+        return {
+            'type': 'object',
+            'properties': {str(key): get_json_schema(value) for key, value in example.items()},
+            'required': [str(key) for key in example.keys()],
+            'additionalProperties': False,
+        }
+    if type(example) in [list, tuple]:
+        return {'type': 'array', 'items': get_json_schema(example[0] if len(example) > 0 else "")}
+    return {'type': SCALAR_SCHEMA_TYPES.get(type(example), 'string')}
+
+
+def get_json_schema_response_format(name, schema):
+    name = re.sub(r'[^A-Za-z0-9_-]', '_', name)[:64] or STRUCTURED_OUTPUT_KEY
+    return {'type': 'json_schema', 'json_schema': {'name': name, 'schema': schema, 'strict': True}}
+
+
+def validate_json_schema(value, schema):
+    """
+    Check a parsed response against a schema of get_json_schema.
+    """
+    schema_type = schema['type']
+    if schema_type == 'object':
+        if type(value) is not dict or len(value) != len(schema['required']):
+            return False
+        properties = schema['properties']
+        for key, item in value.items():
+            if key not in properties or not validate_json_schema(item, properties[key]):
+                return False
+        return True
+    if schema_type == 'array':
+        return type(value) is list and all(validate_json_schema(item, schema['items']) for item in value)
+    if schema_type == 'integer':
+        return type(value) is int
+    if schema_type == 'number':
+        return type(value) in [int, float]
+    if schema_type == 'boolean':
+        return type(value) is bool
+    return type(value) is str
@@ -0,0 +1,114 @@
+"""
+File: llm_metrics.py
+Description: Latency and token metrics of the LLM calls, per prompt family
+
+Every LLM request records its prompt family (the run_gpt_* function, or 'embeddings'),
+latency, prompt/completion tokens, transport retries, and whether it is the reformat
+fallback of ChatGPT_safe_generate_response. The local repairs of unparsable responses
+and the cassette and memo hits are counted too. The metrics are kept in memory as counters and a latency histogram per
+family, and dumped to the save_dir of every plot, with the totals of the process and
+the part of the current plot.
+"""
+import json
+import bisect
+import threading
+
+
+# upper edges (seconds) of the latency histogram, the last bin is unbounded
+LATENCY_BUCKETS = [0.05, 0.1, 0.25, 0.5, 1.0, 2.0, 4.0, 8.0, 16.0, 32.0, 64.0]
+COUNTER_NAMES = ['calls', 'errors', 'retries', 'reformat_calls', 'cassette_hits', 'memo_hits',
+                 'parse_repairs', 'parse_failures', 'prompt_tokens', 'completion_tokens', 'latency_sum']
+
+
+def get_empty_family_metrics():
+    metrics = {name: 0 for name in COUNTER_NAMES}
+    metrics['latency_histogram'] = [0] * (len(LATENCY_BUCKETS) + 1)
+    return metrics
+
+
+def subtract_family_metrics(metrics, baseline):
+    result = {name: metrics[name] - baseline[name] for name in COUNTER_NAMES}
+    result['latency_histogram'] = [count - base for count, base in zip(metrics['latency_histogram'], baseline['latency_histogram'])]
+    return result
+
+
+def add_latency_mean(families):
+    for metrics in families.values():
+        requests = metrics['calls'] + metrics['errors']
+        metrics['latency_mean'] = metrics['latency_sum'] / requests if requests > 0 else 0.0
+    return families
+
+
+class LLMMetrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.families = {}
+        self.dump_plot_id = None
+        self.last_dump = {}
+        self.plot_baseline = {}
+
+    def record_call(self, family, latency, usage=None, retries=0, reformat=False, error=False):
+        with self.lock:
+            metrics = self.families.setdefault(family, get_empty_family_metrics())
+            metrics['errors' if error else 'calls'] += 1
+            metrics['retries'] += retries
+            metrics['reformat_calls'] += int(reformat)
+            if usage is not None:
+                metrics['prompt_tokens'] += getattr(usage, 'prompt_tokens', 0) or 0
+                metrics['completion_tokens'] += getattr(usage, 'completion_tokens', 0) or 0
+            metrics['latency_sum'] += latency
+            metrics['latency_histogram'][bisect.bisect_left(LATENCY_BUCKETS, latency)] += 1
+
+    def record_parse(self, family, repaired=True):
+        # repaired by the local parser, or failed and left to the reformat request
+        with self.lock:
+            self.families.setdefault(family, get_empty_family_metrics())['parse_repairs' if repaired else 'parse_failures'] += 1
+
+    def record_cassette_hit(self, family):
+        with self.lock:
+            self.families.setdefault(family, get_empty_family_metrics())['cassette_hits'] += 1
+
+    def record_memo_hit(self, family):
+        with self.lock:
+            self.families.setdefault(family, get_empty_family_metrics())['memo_hits'] += 1
+
+    def get_families(self):
+        with self.lock:
+            return json.loads(json.dumps(self.families))
+
+    def reset(self):
+        with self.lock:
+            self.families = {}
+            self.dump_plot_id = None
+            self.last_dump = {}
+            self.plot_baseline = {}
+
+    def dump(self, path, plot_id):
+        """
+        Write the metrics to path. The part of the plot is counted from the last dump of the previous plot,
+        so the characters sharing a plot can dump it one after another.
+        """
+        with self.lock:
+            totals = json.loads(json.dumps(self.families))
+            if plot_id != self.dump_plot_id:
+                self.plot_baseline = self.last_dump
+                self.dump_plot_id = plot_id
+            self.last_dump = totals
+            plot = {family: subtract_family_metrics(metrics, self.plot_baseline.get(family, get_empty_family_metrics()))
+                    for family, metrics in totals.items()}
+        plot = {family: metrics for family, metrics in plot.items() if metrics['calls'] + metrics['errors'] + metrics['cassette_hits'] + metrics['memo_hits'] > 0}
+        content = {
+            'plot_id': plot_id,
+            'latency_buckets': LATENCY_BUCKETS,
+            'plot': add_latency_mean(plot),
+            'total': add_latency_mean(totals),
+        }
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(content, f, indent=2)
+
+
+_llm_metrics = LLMMetrics()
+
+
+def get_llm_metrics():
+    return _llm_metrics
@@ -0,0 +1,161 @@
+"""
+File: local_stub.py
+Description: Offline deterministic stand-in of the LLM service (LLM_SERVICE_TYPE=local-stub)
+
+The stub answers chat completions with responses shaped like the example output of the
+running prompt family, and embeddings with unit vectors derived from the text hash.
+Responses only depend on LLM_STUB_SEED and the request, so runs are reproducible.
+LLM_STUB_LATENCY (seconds) simulates the latency of each request.
+"""
+import json
+import time
+import random
+import asyncio
+import hashlib
+from types import SimpleNamespace
+import numpy as np
+from digital_life_project.characters.llm_api.gpt_prompt_base import llm_request_context
+
+
+STUB_EMBEDDING_DIM = 1536
+STUB_WORDS = ["talk", "book", "friend", "story", "quiet", "curious", "laugh", "home", "secret", "walk",
+              "dream", "music", "coffee", "rain", "window", "memory", "gift", "promise", "smile", "letter"]
+STUB_PLACES = ["sofa", "desk", "dining table", "bookshelf"]
+
+
+def get_seeded_random(seed, *parts):
+    sha = hashlib.sha256(str(seed).encode('utf-8'))
+    for part in parts:
+        sha.update(b'\0' + str(part).encode('utf-8'))
+    return random.Random(int.from_bytes(sha.digest()[:8], 'little'))
+
+
+def generate_text(rng, example):
+    # same number of words as the example
+    num_words = max(1, len(str(example).split()))
+    text = " ".join(rng.choice(STUB_WORDS) for _ in range(num_words))
+    return text[0].upper() + text[1:] + "."
+
+
+def generate_like(rng, example, key=''):
+    """
+    Generate a value with the same structure and types as the example output.
+    """
+    if type(example) is dict:
+        return {item_key: generate_like(rng, value, item_key) for item_key, value in example.items()}
+    if type(example) is list:
+        if len(example) == 0:
+            return []
+        if all(type(item) is int for item in example):
+            # indices into the prompt lists, index 0 is always valid
+            return [0]
+        if all(type(item) is str for item in example):
+            return [rng.choice(STUB_WORDS) for _ in range(rng.randint(1, 3))]
+        return [generate_like(rng, example[i % len(example)], key) for i in range(rng.randint(1, len(example)))]
+    if type(example) is bool:
+        return rng.choice([True, False])
+    if type(example) is int:
+        # Likert scale
+        return rng.randint(1, 9)
+    if type(example) is float:
+        return round(rng.uniform(1, 9), 2)
+    if type(example) is str:
+        if example in ['Y', 'N']:
+            return rng.choice(['Y', 'N'])
+        if key == 'place':
+            return rng.choice(STUB_PLACES)
+        return generate_text(rng, example)
+    return example
+
+
+def generate_decision_dialog(rng, context):
+    # the stub never ends a conversation, the plot ends after max_round_per_plot rounds
+    names = context['arguments']['names']
+    return {'end': False, 'self_name': names[0], 'speech': generate_text(rng, 'How are you?'), 'expression': rng.choice(STUB_WORDS),
+            'motion': f"{rng.choice(STUB_WORDS)} {rng.choice(STUB_WORDS)}", 'place': rng.choice(STUB_PLACES), 'partner_name': names[1]}
+
+
+# prompt families whose responses depend on the arguments, not only on the example output
+STUB_FAMILY_GENERATORS = {
+    'run_gpt_prompt_decision_dialog': generate_decision_dialog,
+}
+
+
+def get_stub_content(seed, messages, json_response):
+    context = llm_request_context.get()
+    family = context.get('family', '')
+    rng = get_seeded_random(seed, family, json.dumps(messages, sort_keys=True, default=str))
+    if family in STUB_FAMILY_GENERATORS:
+        return json.dumps(STUB_FAMILY_GENERATORS[family](rng, context))
+    example = context.get('example_output', "Ok.")
+    response = generate_like(rng, example)
+    if type(response) is str and not json_response:
+        return response
+    return json.dumps(response)
+
+
+def get_stub_embedding(seed, text):
+    sha = hashlib.sha256(f"{seed}\0{text}".encode('utf-8'))
+    embedding = np.random.default_rng(int.from_bytes(sha.digest()[:8], 'little')).standard_normal(STUB_EMBEDDING_DIM)
+    return (embedding / np.linalg.norm(embedding)).tolist()
+
+
+def count_stub_tokens(text):
+    # rough count of the tokenizer, about 3 tokens for 4 words
+    return (4 * len(str(text).split()) + 2) // 3
+
+
+def get_chat_completion(seed, kwargs):
+    content = get_stub_content(seed, kwargs['messages'], kwargs['response_format']['type'] != 'text')
+    message = SimpleNamespace(role='assistant', content=content)
+    prompt_tokens = sum(count_stub_tokens(item['content']) for item in kwargs['messages'])
+    completion_tokens = count_stub_tokens(content)
+    usage = SimpleNamespace(prompt_tokens=prompt_tokens, completion_tokens=completion_tokens, total_tokens=prompt_tokens + completion_tokens)
+    return SimpleNamespace(model=kwargs['model'], choices=[SimpleNamespace(index=0, finish_reason='stop', message=message)], usage=usage)
+
+
+def get_embedding_response(seed, input, model):
+    if type(input) is str:
+        input = [input]
+    data = [SimpleNamespace(index=i, embedding=get_stub_embedding(seed, text)) for i, text in enumerate(input)]
+    tokens = sum(count_stub_tokens(text) for text in input)
+    return SimpleNamespace(model=model, data=data, usage=SimpleNamespace(prompt_tokens=tokens, total_tokens=tokens))
+
+
+class LocalStubClient:
+    """
+    Stand-in of the OpenAI client, with the chat.completions.create and embeddings.create calls.
+    """
+    def __init__(self, seed=0, latency=0.0):
+        self.seed = seed
+        self.latency = latency
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self.create_chat_completion))
+        self.embeddings = SimpleNamespace(create=self.create_embeddings)
+
+    def create_chat_completion(self, **kwargs):
+        if self.latency > 0:
+            time.sleep(self.latency)
+        return get_chat_completion(self.seed, kwargs)
+
+    def create_embeddings(self, input, model, **kwargs):
+        if self.latency > 0:
+            time.sleep(self.latency)
+        return get_embedding_response(self.seed, input, model)
+
+
+class AsyncLocalStubClient:
+    def __init__(self, seed=0, latency=0.0):
+        self.seed = seed
+        self.latency = latency
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self.create_chat_completion))
+        self.embeddings = SimpleNamespace(create=self.create_embeddings)
+
+    async def create_chat_completion(self, **kwargs):
+        if self.latency > 0:
+            await asyncio.sleep(self.latency)
+        return get_chat_completion(self.seed, kwargs)
+
+    async def create_embeddings(self, input, model, **kwargs):
+        if self.latency > 0:
+            await asyncio.sleep(self.latency)
+        return get_embedding_response(self.seed, input, model)
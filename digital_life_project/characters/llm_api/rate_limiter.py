@@ -0,0 +1,190 @@
+"""
+File: rate_limiter.py
+Description: Token-bucket rate limiter of the LLM requests, shared by threads, asyncio tasks, and processes
+
+The limiter holds two buckets, one of requests and one of tokens, refilled continuously up to
+the per-minute quota (LLM_RPM, LLM_TPM; 0 means no limit). A request takes one request and its
+estimated tokens, and the estimate is settled with the reported usage afterwards.
+When LLM_RATE_LIMIT_DIR is set, the buckets live in a memory-mapped file under a lock file,
+so every process of a society run draws from the same quota. A rate-limited response pauses
+the shared buckets for its Retry-After, and the retries back off exponentially with full jitter.
+"""
+import os
+import time
+import random
+import asyncio
+import threading
+import email.utils
+import numpy as np
+from digital_life_project.characters.llm_api.embedding_cache import FileLock
+
+
+BACKOFF_BASE = 1.0
+BACKOFF_MAX = 60.0
+RETRYABLE_STATUS_CODES = [408, 409, 429, 500, 502, 503, 504]
+
+# fields of the shared state
+REQUESTS, REQUESTS_TIME, TOKENS, TOKENS_TIME, PAUSED_UNTIL = range(5)
+
+_llm_rate_limiters = {}
+_llm_rate_limiters_lock = threading.Lock()
+
+
+class LLMRateLimiter:
+    def __init__(self, rpm=0, tpm=0, state_dir=None):
+        self.rpm = rpm
+        self.tpm = tpm
+        self.state_dir = state_dir
+        self.waits = 0
+        self.wait_time = 0.0
+        self.pauses = 0
+        if state_dir is None:
+            self.lock = threading.Lock()
+            self.state = self.get_initial_state()
+        else:
+            os.makedirs(state_dir, exist_ok=True)
+            self.lock = FileLock(os.path.join(state_dir, 'rate_limit.lock'))
+            state_path = os.path.join(state_dir, f'rate_limit_{rpm}_{tpm}.npy')
+            with self.lock:
+                if not os.path.exists(state_path):
+                    state = np.lib.format.open_memmap(state_path + '.tmp', mode='w+', dtype=np.float64, shape=(5,))
+                    state[:] = self.get_initial_state()
+                    state.flush()
+                    del state
+                    os.replace(state_path + '.tmp', state_path)
+            self.state = np.load(state_path, mmap_mode='r+')
+
+    def get_initial_state(self):
+        now = time.time()
+        return np.array([self.rpm, now, self.tpm, now, 0.0], dtype=np.float64)
+
+    def refill(self, now):
+        # full buckets hold the quota of one minute
+        for level, last_time, quota in [(REQUESTS, REQUESTS_TIME, self.rpm), (TOKENS, TOKENS_TIME, self.tpm)]:
+            if quota > 0:
+                self.state[level] = min(quota, self.state[level] + (now - self.state[last_time]) * quota / 60.0)
+                self.state[last_time] = now
+
+    def try_acquire(self, tokens):
+        """
+        Take one request and the tokens if the buckets allow it and return 0, or return the seconds to wait.
+        """
+        # a request larger than the bucket waits for a full bucket instead of forever
+        tokens = min(tokens, self.tpm) if self.tpm > 0 else 0
+        with self.lock:
+            now = time.time()
+            if now < self.state[PAUSED_UNTIL]:
+                return self.state[PAUSED_UNTIL] - now
+            self.refill(now)
+            wait = 0.0
+            if self.rpm > 0 and self.state[REQUESTS] < 1:
+                wait = max(wait, (1 - self.state[REQUESTS]) * 60.0 / self.rpm)
+            if self.tpm > 0 and self.state[TOKENS] < tokens:
+                wait = max(wait, (tokens - self.state[TOKENS]) * 60.0 / self.tpm)
+            if wait > 0:
+                return wait
+            if self.rpm > 0:
+                self.state[REQUESTS] -= 1
+            self.state[TOKENS] -= tokens
+            return 0.0
+
+    def acquire(self, tokens=0):
+        while True:
+            wait = self.try_acquire(tokens)
+            if wait <= 0:
+                return
+            self.waits += 1
+            self.wait_time += wait
+            time.sleep(wait)
+
+    async def aacquire(self, tokens=0):
+        while True:
+            wait = self.try_acquire(tokens)
+            if wait <= 0:
+                return
+            self.waits += 1
+            self.wait_time += wait
+            await asyncio.sleep(wait)
+
+    def settle(self, estimated_tokens, used_tokens):
+        # the bucket can go below zero, the next requests wait for the debt
+        if self.tpm <= 0 or used_tokens is None:
+            return
+        with self.lock:
+            self.state[TOKENS] -= used_tokens - min(estimated_tokens, self.tpm)
+
+    def pause(self, seconds):
+        # every user of the buckets waits, not only the request that was rate-limited
+        with self.lock:
+            self.state[PAUSED_UNTIL] = max(self.state[PAUSED_UNTIL], time.time() + seconds)
+        self.pauses += 1
+
+    def get_stats(self):
+        return {'rpm': self.rpm, 'tpm': self.tpm, 'state_dir': self.state_dir,
+                'waits': self.waits, 'wait_time': self.wait_time, 'pauses': self.pauses}
+
+
+def get_llm_rate_limiter():
+    """
+    Return the shared limiter of LLM_RPM and LLM_TPM, or None if there is no limit.
+    """
+    rpm = int(os.environ.get("LLM_RPM", 0))
+    tpm = int(os.environ.get("LLM_TPM", 0))
+    if rpm <= 0 and tpm <= 0:
+        return None
+    state_dir = os.environ.get("LLM_RATE_LIMIT_DIR", "")
+    state_dir = os.path.abspath(state_dir) if state_dir != "" else None
+    key = (rpm, tpm, state_dir)
+    with _llm_rate_limiters_lock:
+        if key not in _llm_rate_limiters:
+            _llm_rate_limiters[key] = LLMRateLimiter(rpm=max(rpm, 0), tpm=max(tpm, 0), state_dir=state_dir)
+        return _llm_rate_limiters[key]
+
+
+def get_error_status_code(error):
+    status_code = getattr(error, 'status_code', None)
+    if status_code is None:
+        status_code = getattr(getattr(error, 'response', None), 'status_code', None)
+    return status_code
+
+
+def is_retryable_llm_error(error):
+    # connection errors and timeouts of the client have no status code
+    if type(error).__name__ in ['APIConnectionError', 'APITimeoutError']:
+        return True
+    return get_error_status_code(error) in RETRYABLE_STATUS_CODES
+
+
+def get_retry_after(error):
+    """
+    Seconds to wait given by the Retry-After headers of the error response, or None.
+    """
+    headers = getattr(getattr(error, 'response', None), 'headers', None)
+    if headers is None:
+        return None
+    try:
+        if headers.get('retry-after-ms') is not None:
+            return float(headers.get('retry-after-ms')) / 1000.0
+        retry_after = headers.get('retry-after')
+        if retry_after is None:
+            return None
+        try:
+            return float(retry_after)
+        except ValueError:
+            # HTTP date
+            return max(0.0, email.utils.parsedate_to_datetime(retry_after).timestamp() - time.time())
+    except:
+        return None
+
+
+def get_backoff_delay(attempt):
+    # exponential backoff with full jitter
+    return random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt))
+
+
+def get_retry_delay(error, attempt):
+    retry_after = get_retry_after(error)
+    if retry_after is not None:
+        # a little jitter, so the waiting requests do not come back at once
+        return retry_after + random.uniform(0, BACKOFF_BASE)
+    return get_backoff_delay(attempt)
@@ -0,0 +1,159 @@
+"""
+File: response_memo.py
+Description: Opt-in memoization of the validated LLM responses of deterministic prompt families
+
+Some prompt families are pure functions of their inputs and get the same prompt again across
+characters and replays, e.g. the summary of the plot background for each character. Their responses
+are memoized by request hash (model, temperature, messages, response format), so a repeated prompt
+skips the LLM call. The memo is enabled by LLM_MEMO_FAMILIES, a comma-separated list of families,
+or 'default' for DEFAULT_MEMO_FAMILIES:
+    - LLM_MEMO_TTL: seconds an entry is valid, 0 for no expiry (default 86400)
+    - LLM_MEMO_MAX_ENTRIES: entries kept per family, the least recently used are evicted (default 10000)
+    - LLM_MEMO_DIR: optional directory of a sqlite memo shared by processes and runs
+Only the responses accepted by the validation of the family are memoized, when they come from the
+LLM service. A hit refreshes the last use of the entry, not its creation time, so the TTL still applies.
+"""
+import os
+import time
+import sqlite3
+import threading
+import contextlib
+from collections import OrderedDict
+
+
+DEFAULT_MEMO_FAMILIES = [
+    'run_gpt_summarize_sentence',
+    'run_gpt_get_qualitative_personality_from_quantitative',
+    'run_gpt_get_quantitative_relationship_from_description',
+    'run_gpt_get_keywords_poignancy_from_description',
+]
+DEFAULT_MEMO_TTL = 86400.0
+DEFAULT_MEMO_MAX_ENTRIES = 10000
+
+_llm_response_memos = {}
+_llm_response_memos_lock = threading.Lock()
+
+
+class LLMResponseMemo:
+    def __init__(self, families, ttl=DEFAULT_MEMO_TTL, max_entries=DEFAULT_MEMO_MAX_ENTRIES, memo_dir=''):
+        self.families = set(families)
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        # family -> OrderedDict of key -> (created time, response), in LRU order
+        self.entries = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.db_path = None
+        if memo_dir != '':
+            os.makedirs(memo_dir, exist_ok=True)
+            self.db_path = os.path.join(memo_dir, 'llm_memo.sqlite')
+            with self.connect() as connection:
+                connection.execute("CREATE TABLE IF NOT EXISTS memo (family TEXT, key TEXT, created REAL, "
+                                   "last_used REAL, response TEXT, PRIMARY KEY (family, key))")
+
+    @contextlib.contextmanager
+    def connect(self):
+        # a connection per operation, so the memo is safe across threads and forked processes
+        connection = sqlite3.connect(self.db_path, timeout=60)
+        try:
+            with connection:
+                yield connection
+        finally:
+            connection.close()
+
+    def is_expired(self, created):
+        return self.ttl > 0 and time.time() - created > self.ttl
+
+    def get(self, family, key):
+        """
+        Return (found, response) of the memoized request.
+        """
+        with self.lock:
+            family_entries = self.entries.setdefault(family, OrderedDict())
+            entry = family_entries.get(key)
+            if entry is not None and self.is_expired(entry[0]):
+                del family_entries[key]
+                entry = None
+            if entry is not None:
+                family_entries.move_to_end(key)
+                self.hits += 1
+        if entry is not None:
+            if self.db_path is not None:
+                # the hits of this process keep the entry in the LRU of the shared memo
+                with self.connect() as connection:
+                    connection.execute("UPDATE memo SET last_used = ? WHERE family = ? AND key = ?", (time.time(), family, key))
+            return True, entry[1]
+        if self.db_path is not None:
+            with self.connect() as connection:
+                row = connection.execute("SELECT created, response FROM memo WHERE family = ? AND key = ?", (family, key)).fetchone()
+                if row is not None and not self.is_expired(row[0]):
+                    connection.execute("UPDATE memo SET last_used = ? WHERE family = ? AND key = ?", (time.time(), family, key))
+                    self.put_in_memory(family, key, row[0], row[1])
+                    with self.lock:
+                        self.hits += 1
+                    return True, row[1]
+        with self.lock:
+            self.misses += 1
+        return False, None
+
+    def put_in_memory(self, family, key, created, response):
+        with self.lock:
+            family_entries = self.entries.setdefault(family, OrderedDict())
+            family_entries[key] = (created, response)
+            family_entries.move_to_end(key)
+            while len(family_entries) > self.max_entries:
+                family_entries.popitem(last=False)
+                self.evictions += 1
+
+    def put(self, family, key, response):
+        created = time.time()
+        self.put_in_memory(family, key, created, response)
+        if self.db_path is not None:
+            with self.connect() as connection:
+                connection.execute("INSERT OR REPLACE INTO memo VALUES (?, ?, ?, ?, ?)", (family, key, created, created, response))
+                if self.ttl > 0:
+                    connection.execute("DELETE FROM memo WHERE created < ?", (created - self.ttl,))
+                connection.execute("DELETE FROM memo WHERE family = ? AND key NOT IN "
+                                   "(SELECT key FROM memo WHERE family = ? ORDER BY last_used DESC LIMIT ?)",
+                                   (family, family, self.max_entries))
+
+    def get_stats(self):
+        with self.lock:
+            return {
+                'families': sorted(self.families),
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'entries': sum(len(family_entries) for family_entries in self.entries.values()),
+            }
+
+
+def get_memo_families():
+    families = [family.strip() for family in os.environ.get("LLM_MEMO_FAMILIES", "").split(',') if family.strip() != '']
+    if 'default' in families:
+        families = [family for family in families if family != 'default'] + DEFAULT_MEMO_FAMILIES
+    return tuple(sorted(set(families)))
+
+
+def get_llm_response_memo(family):
+    """
+    Return the shared response memo if the prompt family is memoized, or else None.
+    """
+    families = get_memo_families()
+    if family not in families:
+        return None
+    ttl = float(os.environ.get("LLM_MEMO_TTL", DEFAULT_MEMO_TTL))
+    max_entries = int(os.environ.get("LLM_MEMO_MAX_ENTRIES", DEFAULT_MEMO_MAX_ENTRIES))
+    memo_dir = os.environ.get("LLM_MEMO_DIR", "")
+    key = (families, ttl, max_entries, os.path.abspath(memo_dir) if memo_dir != '' else '')
+    with _llm_response_memos_lock:
+        if key not in _llm_response_memos:
+            _llm_response_memos[key] = LLMResponseMemo(families, ttl=ttl, max_entries=max_entries, memo_dir=memo_dir)
+        return _llm_response_memos[key]
+
+
+def get_llm_response_memo_stats():
+    with _llm_response_memos_lock:
+        return [memo.get_stats() for memo in _llm_response_memos.values()]
@@ -0,0 +1,104 @@
+"""
+File: response_parser.py
+Description: Tolerant local parser of the python dict/list responses of the LLM
+
+ChatGPT_safe_generate_response asks the LLM to reformat a response that does not parse,
+which costs a whole extra round-trip. The parser here repairs the common malformations
+locally first: code fences, text around the literal, single-quoted strings, unescaped
+quotes and apostrophes inside strings, trailing commas, and JSON true/false/null.
+"""
+import re
+import ast
+import json
+
+
+FENCE_PATTERN = re.compile(r"```[A-Za-z]*\s*\n?(.*?)```", re.S)
+JSON_LITERALS = {'true': 'True', 'false': 'False', 'null': 'None'}
+STRING_END_CHARS = ',:}])'
+WHITESPACE_PATTERN = re.compile(r'\s*')
+WORD_PATTERN = re.compile(r'[A-Za-z_]+')
+
+
+def strip_code_fences(text):
+    match = FENCE_PATTERN.search(text)
+    if match is not None:
+        return match.group(1).strip()
+    return text.strip()
+
+
+def extract_outer_literal(text):
+    # from the first opening bracket to the last closing one
+    starts = [index for index in [text.find('{'), text.find('[')] if index != -1]
+    if len(starts) == 0:
+        return text
+    start = min(starts)
+    end = text.rfind('}' if text[start] == '{' else ']')
+    if end <= start:
+        return text[start:]
+    return text[start:end+1]
+
+
+def find_string_end(text, start, quote):
+    """
+    Index of the quote closing the string opened at start. A quote closes the string only if it is
+    followed by a delimiter, so apostrophes and quoted words inside the string are kept.
+    The text is scanned forward once, without copying its rest at each quote.
+    """
+    index = start + 1
+    while index < len(text):
+        char = text[index]
+        if char == '\\':
+            index += 2
+            continue
+        if char == quote:
+            next_index = WHITESPACE_PATTERN.match(text, index + 1).end()
+            if next_index == len(text) or text[next_index] in STRING_END_CHARS:
+                return index
+        index += 1
+    return -1
+
+
+def repair_literal(text):
+    """
+    Rewrite a malformed dict/list response as a python literal, every string double-quoted.
+    """
+    res = []
+    index = 0
+    while index < len(text):
+        char = text[index]
+        if char in ['"', "'"]:
+            end = find_string_end(text, index, char)
+            if end == -1:
+                raise ValueError("Unterminated string in the response")
+            content = text[index+1:end]
+            try:
+                content = ast.literal_eval(char + content + char)
+            except:
+                pass
+            res.append(json.dumps(content, ensure_ascii=False))
+            index = end + 1
+        elif char.isalpha():
+            word = WORD_PATTERN.match(text, index).group(0)
+            res.append(JSON_LITERALS.get(word, word))
+            index += len(word)
+        else:
+            res.append(char)
+            index += 1
+    return ''.join(res)
+
+
+def repair_response(text):
+    """
+    Parse a malformed dict/list response, and raise ValueError if it cannot be repaired.
+    """
+    try:
+        return ast.literal_eval(text)
+    except:
+        pass
+    candidate = extract_outer_literal(strip_code_fences(text))
+    for parse in [json.loads, lambda candidate: ast.literal_eval(repair_literal(candidate))]:
+        try:
+            return parse(candidate)
+        except:
+            pass
+    raise ValueError("Unparsable response")
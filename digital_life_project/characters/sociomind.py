@@ -11,6 +11,8 @@ from digital_life_project.characters.brain_sys.memory import Memory
 from digital_life_project.characters.brain_sys.psychostate import PsychoState
 from digital_life_project.characters.brain_sys.psycho_state.behavior import Behavior
 from digital_life_project.characters.llm_api.gpt_prompt_brain import *
+from digital_life_project.characters.llm_api.llm_metrics import get_llm_metrics
+from digital_life_project.characters.span_tracer import traced, trace_span
 from digital_life_project.characters.brain_sys.memory_modules.episodic_semantic_memory import Event, Thought
 from digital_life_project.characters.brain_sys.memory_modules.social_memory import Relationship
 from digital_life_project.characters.brain_sys.psycho_state.motivation import Motivation
@@ -19,8 +21,15 @@ import ast
 import csv
 import numpy as np
 from digital_life_project.characters.brain_sys.utils import *
-import pickle
 import yaml
+import threading
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+
+
+config_write_lock = threading.Lock()
+# background threads of the speculative reflection prefetch, shared by the characters
+reflection_prefetch_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix='reflection_prefetch')
 
 
 class SocioMind():
@@ -31,10 +40,17 @@ class SocioMind():
         self.memory = Memory(name, config)
         self.working_memory = {}
         self.character = character
+        self.reflection_prefetch = None
         if self.config['replay_dir'] != '':
             self.load_replay()
 
     
+    async def areaction(self):
+        # the reaction step of the character, with the requests of the stages going through the async LLM layer
+        return await run_llm_stage(self.character.reaction)
+
+
+    @traced()
     def perception(self):
         # only use one partner for one message here
         partner_name = self.character.partners[0].name
@@ -53,6 +69,7 @@ class SocioMind():
                 self.psycho_state.perceived_behavior[0:0] = [p_behavior]
             
             
+    @traced()
     def memory_query(self):
         query_memories = {}
         for behavior in self.psycho_state.perceived_behavior[:1]:
@@ -82,10 +99,10 @@ class SocioMind():
                 self.memory.add_plot(new_plot)
                 self.memory.add_behavior(behavior)
                 if 'events' in plot_config[self.name]:
-                    for event_desc in plot_config[self.name]['events']:
-                        if event_desc != '':
-                            event = self.get_events_from_description(event_desc)
-                            self.memory.add_event(event)
+                    event_descs = [event_desc for event_desc in plot_config[self.name]['events'] if event_desc != '']
+                    for event_desc, event_embedding in zip(event_descs, get_embeddings(event_descs)):
+                        event = self.get_events_from_description(event_desc, embedding=np.array(event_embedding))
+                        self.memory.add_event(event)
                 # generate new topics for the plot from previous events
                 self.generate_new_topics_from_events()
                 # choose the topics for the current plot
@@ -141,18 +158,12 @@ class SocioMind():
         events_from_current_plot = self.memory.get_events_from_plot(self.psycho_state.current_plot_id, manual=False)
         manual_events_current = self.memory.get_manual_events_from_plot(self.psycho_state.current_plot_id)
         # retrieve the relevant events of summarized events
-        events = set()
-        for event in events_from_current_plot:
-            event_list = self.memory.retrieve_events_by_embedding(event.event.embedding, 
-                                                                  plot_id=self.psycho_state.current_plot_id, 
-                                                                  topk=self.config['max_retrieve_events'])
-            events = events.union(set(event_list))
-        
-        thoughts = set()
-        for event in events:
-            thought_list = self.memory.retrieve_thoughts_by_embedding(event.event.embedding, 
-                                                                      topk=self.config['max_retrieve_thoughts'])
-            thoughts = thoughts.union(set(thought_list))
+        _, events = self.memory.retrieve_events_by_embeddings([event.event.embedding for event in events_from_current_plot], 
+                                                              plot_id=self.psycho_state.current_plot_id, 
+                                                              topk=self.config['max_retrieve_events'])
+        
+        _, thoughts = self.memory.retrieve_thoughts_by_embeddings([event.event.embedding for event in events], 
+                                                                  topk=self.config['max_retrieve_thoughts'])
 
         # get motivation & personality & self & key thoughts
         core_self_info, core_self_embeddings = self.psycho_state.core_self_list[0].get_prompt_core_self_and_features_from_embedding()
@@ -205,8 +216,8 @@ class SocioMind():
         return
     
     
-    def get_events_from_description(self, description):
-        event = Event(self.name, description, time=datetime.datetime.now(), plot_id=self.psycho_state.current_plot_id, round=self.psycho_state.current_round)
+    def get_events_from_description(self, description, embedding=None):
+        event = Event(self.name, description, embedding=embedding, time=datetime.datetime.now(), plot_id=self.psycho_state.current_plot_id, round=self.psycho_state.current_round)
         personality_info, motivation_info, core_self_info, relationship_info = self.get_current_personal_prompt(event.embedding)
         
         background_prompt = f"\n---\nRelevant background are as follows:\n"
@@ -415,6 +426,7 @@ class SocioMind():
         return is_self, selected_plot
         
     
+    @traced()
     def plan_plot_proposals(self):
         # topic and plot planning system
         if self.config['mode'] == 'preconfigured':
@@ -431,12 +443,12 @@ class SocioMind():
                     if new_plot_id >= len(self.config['events']):
                         pass
                     else:
-                        for event in self.config['events'][new_plot_id]:
-                            if self.name in self.config['events'][new_plot_id][event]:
-                                event = self.get_events_from_description(event)
-                                event.poignancy = min(9, event.poignancy+5)
-                                event.emergency = min(9, event.emergency+5)
-                                self.memory.add_manual_event(event)
+                        event_descs = [event for event in self.config['events'][new_plot_id] if self.name in self.config['events'][new_plot_id][event]]
+                        for event_desc, event_embedding in zip(event_descs, get_embeddings(event_descs)):
+                            event = self.get_events_from_description(event_desc, embedding=np.array(event_embedding))
+                            event.poignancy = min(9, event.poignancy+5)
+                            event.emergency = min(9, event.emergency+5)
+                            self.memory.add_manual_event(event)
                 # check the poignancy and emergency of the events
                 self.generate_new_topics_from_events()
                 # remove duplicated topics
@@ -446,6 +458,7 @@ class SocioMind():
         pass
     
     
+    @traced()
     def plan_start_new_plot(self):
         # start new plot
         if self.config['mode'] == 'preconfigured':
@@ -476,6 +489,7 @@ class SocioMind():
         pass
     
 
+    @traced()
     def decision(self):
         # core decision making system (interactive behavior)
         
@@ -555,7 +569,7 @@ class SocioMind():
         current_info += "Now you have two options for reaction: end the conversation or respond based on the information above." + \
             f"When the above conversation becomes pointless, repetitive or doesn't fit your motivation, personality, or topics, you should end the interactive conversation." +\
                 f"Your speech should not be too polite. Don't easily express your gratitude and friendliness. It's best that your conversations continue to bring up new topics, not cater to each other." +\
-        "If you end the conversation, your output should be: 'END', and if you react, it should be structured the similar way as the example provided."
+        "If you end the conversation, set 'end' to true in your output, and if you react, set 'end' to false and give your reaction in the other keys the similar way as the example provided."
         current_info += "So your reaction is "
         
         messages.append({"role": "user", "content": current_info})
@@ -565,6 +579,7 @@ class SocioMind():
         if reaction_behavior_dict in ['END', 'end', '"END"', '"end"']:
             self.psycho_state.plot_state = 'plot_finished'
             print(f"[Working]<{self.name}>: {self.name} end the conversation with {self.character.partners[0].name}.")
+            self.prefetch_reflection()
             return
         
         # check if start new topic or ended the talk
@@ -620,27 +635,76 @@ class SocioMind():
         
         if self.psycho_state.current_round >= self.config['max_round_per_plot']:
             self.psycho_state.plot_state = 'plot_finished'
+        # the plot ends within a few rounds, prepare the reflection while the partner reacts
+        if self.psycho_state.current_round + self.config.get('speculative_reflection_rounds', 1) >= self.config['max_round_per_plot']:
+            self.prefetch_reflection()
         
     
-    def summarize_events_from_dialogs(self):
+    def get_reflection_state(self):
+        # the plot and psychological states the innate-trait prompt of the reflection is built from, but the emotion
+        return [self.psycho_state.current_plot_id, self.psycho_state.personality_list[0], self.psycho_state.motivation_list[0],
+                self.psycho_state.core_self_list[0], self.memory.get_relationships_by_partner_name(self.character.partners[0].name)]
+    
+    
+    @traced(category='reflection')
+    def prepare_reflection_innate_trait_prompt(self):
+        # the innate-trait prompt and the persona instruction candidates of the personal embeddings,
+        # the emotion may still be updated in the last round and is added by finish_reflection_innate_trait_prompt
+        state = self.get_reflection_state()
         personality_info, motivation_info, core_self_info, relationship_info = self.get_current_personal_prompt()
-        behaviors = self.memory.get_context_behaviors(self.psycho_state.current_plot_id, context_retention=100)
         innate_trait_prompt = f"Assume you are a person named [{self.name}].\n"
         innate_trait_prompt += self.get_personality_prompt(personality_info, view=1)
         innate_trait_prompt += self.get_motivation_prompt(motivation_info, view=1)
         innate_trait_prompt += self.get_core_self_prompt(core_self_info, view=1)
         innate_trait_prompt += self.get_relationship_prompt(relationship_info, view=1)
 
-        embedding_lists = []
-        embedding_lists.extend(self.get_current_personal_embeddings())
-        embedding_lists.append(self.psycho_state.emotion_list[0].embedding)
-        persona_instructions = self.psycho_state.persona_instruction_database.retrieval_instruction_from_embeddings(embedding_lists, 
-                                                                                                                    topk_for_each=self.config['max_per_persona_retrieval'], 
-                                                                                                                    topk_all=self.config['max_persona_retrieval'])
+        candidates = self.psycho_state.persona_instruction_database.get_instruction_candidates(self.get_current_personal_embeddings(), 
+                                                                                               topk_for_each=self.config['max_per_persona_retrieval'])
+        return state, innate_trait_prompt, candidates
+    
+    
+    def finish_reflection_innate_trait_prompt(self, innate_trait_prompt, candidates):
+        persona_instruction_database = self.psycho_state.persona_instruction_database
+        emotion_candidates = persona_instruction_database.get_instruction_candidates([self.psycho_state.emotion_list[0].embedding], 
+                                                                                     topk_for_each=self.config['max_per_persona_retrieval'])
+        persona_instructions = persona_instruction_database.select_instructions(persona_instruction_database.concat_instruction_candidates(candidates, emotion_candidates), 
+                                                                                topk_all=self.config['max_persona_retrieval'])
         innate_trait_prompt += f"\n--\nPsychological research has found the following pattern in human trait and behaviors:\n"
         for persona_instruction in persona_instructions:
             innate_trait_prompt += persona_instruction
         innate_trait_prompt += f"\n-----\n"
+        return innate_trait_prompt
+    
+    
+    def prefetch_reflection(self):
+        # speculative, the prefetched prompt is dropped if the state changes before the reflection
+        if not self.config.get('speculative_reflection', False) or self.reflection_prefetch is not None:
+            return
+        self.reflection_prefetch = reflection_prefetch_executor.submit(self.prepare_reflection_innate_trait_prompt)
+    
+    
+    def take_reflection_prefetch(self):
+        prefetch, self.reflection_prefetch = self.reflection_prefetch, None
+        if prefetch is None:
+            return None
+        try:
+            state, innate_trait_prompt, candidates = prefetch.result()
+        except:
+            return None
+        current_state = self.get_reflection_state()
+        if state[0] != current_state[0] or any(item is not current_item for item, current_item in zip(state[1:], current_state[1:])):
+            print(f"[Working]<{self.name}>: {self.name} discards the prefetched reflection prompt.")
+            return None
+        return innate_trait_prompt, candidates
+    
+    
+    @traced(category='reflection')
+    def summarize_events_from_dialogs(self):
+        behaviors = self.memory.get_context_behaviors(self.psycho_state.current_plot_id, context_retention=100)
+        prefetched = self.take_reflection_prefetch()
+        if prefetched is None:
+            _, *prefetched = self.prepare_reflection_innate_trait_prompt()
+        innate_trait_prompt = self.finish_reflection_innate_trait_prompt(*prefetched)
         
         memory_prompt = f"Now you have a conversation with {self.character.partners[0].name}.\n"
         memory_prompt += f"The background of the conversation is [{self.memory.plot_id_to_node[self.psycho_state.current_plot_id].plot.plot_background}].\n"
@@ -654,8 +718,9 @@ class SocioMind():
         
         event_list = run_gpt_prompt_summarize_events_from_dialog(innate_trait_prompt, memory_prompt)
         
-        for event_dict in event_list:
-            event = Event(**event_dict)
+        event_embeddings = get_embeddings([event_dict['description'] for event_dict in event_list])
+        for event_dict, event_embedding in zip(event_list, event_embeddings):
+            event = Event(**event_dict, embedding=np.array(event_embedding))
             event.plot_id = self.psycho_state.current_plot_id
             event.round = self.psycho_state.current_round
             event.time = datetime.datetime.now()
@@ -664,22 +729,13 @@ class SocioMind():
         
         print(f"[Working]<{self.name}>: {self.name} summarize events {event_list}.")
         
+    @traced(category='reflection')
     def summarize_thoughts_from_events(self):
         current_events = self.memory.get_events_from_plot(self.psycho_state.current_plot_id)       
         
-        relevant_events = []
-        
-        relevant_thoughts = []
-        
-        for event in current_events:
-            relevant_events.extend(self.memory.retrieve_events_by_embedding(event.event.embedding, plot_id=self.psycho_state.current_plot_id, topk=5))  
-            relevant_thoughts.extend(self.memory.retrieve_thoughts_by_embedding(event.event.embedding, topk=3))
-        
-        relevant_thoughts_set = set(relevant_thoughts)
-        relevant_thoughts = list(relevant_thoughts_set)
-        
-        relevant_events_set = set(relevant_events)
-        relevant_events = list(relevant_events_set)
+        current_event_embeddings = [event.event.embedding for event in current_events]
+        _, relevant_events = self.memory.retrieve_events_by_embeddings(current_event_embeddings, plot_id=self.psycho_state.current_plot_id, topk=5)
+        _, relevant_thoughts = self.memory.retrieve_thoughts_by_embeddings(current_event_embeddings, topk=3)
         
         personality_info, motivation_info, core_self_info, relationship_info = self.get_current_personal_prompt()
         
@@ -715,17 +771,41 @@ class SocioMind():
         
         thoughts_list = run_gpt_prompt_summarize_thoughts_from_events(innate_trait_prompt, memory_prompt, verbose=self.config['verbose'])
         
-        for thought_dict in thoughts_list:
-            thought = Thought(**thought_dict)
+        thought_embeddings = get_embeddings([thought_dict['description'] for thought_dict in thoughts_list])
+        for thought_dict, thought_embedding in zip(thoughts_list, thought_embeddings):
+            thought = Thought(**thought_dict, embedding=np.array(thought_embedding))
             thought.plot_id = self.psycho_state.current_plot_id
             thought.time = datetime.datetime.now()
             thought.self_name = self.name
-            thought.set_embedding_from_description()
             self.memory.add_thought(thought, event_ids=[event.node_id for event in current_events])
         print(f"[Working]<{self.name}>: {self.name} summarize thoughts {thoughts_list}.")
     
     
+    def get_reflection_persona_prompt(self):
+        # persona instructions retrieved by the current personal embeddings and the events and thoughts of the plot
+        current_events = self.memory.get_events_from_plot(self.psycho_state.current_plot_id)
+        current_thoughts = self.memory.get_thoughts_from_plot(self.psycho_state.current_plot_id)
+        embedding_lists = []
+        embedding_lists.extend(self.get_current_personal_embeddings())
+        embedding_lists.extend([event.event.embedding for event in current_events])
+        embedding_lists.extend([thought.thought.embedding for thought in current_thoughts])
+        persona_instructions = self.psycho_state.persona_instruction_database.retrieval_instruction_from_embeddings(embedding_lists, 
+                                                                                                                    topk_for_each=self.config['max_per_persona_retrieval'], 
+                                                                                                                    topk_all=self.config['max_persona_retrieval'])
+        persona_prompt = f"\n--\nPsychological research has found the following pattern in human trait and behaviors:\n"
+        for persona_instruction in persona_instructions:
+            persona_prompt += persona_instruction
+        persona_prompt += f"\n-----\n"
+        return persona_prompt
+    
+    
     def core_self_update_process(self):
+        self.commit_new_core_self(self.get_new_core_self())
+    
+    
+    @traced(category='reflection')
+    def get_new_core_self(self):
+        # read-only part of the core self update, return the new core self or None
         personality_info, motivation_info, core_self_info, relationship_info = self.get_current_personal_prompt()
         innate_trait_prompt = f"Assume you are a very professional psychologist. Here is a person named [{self.name}].\n"
         innate_trait_prompt += self.get_personality_prompt(personality_info, view=3)
@@ -735,17 +815,7 @@ class SocioMind():
         current_events = self.memory.get_events_from_plot(self.psycho_state.current_plot_id)  
         current_thoughts = self.memory.get_thoughts_from_plot(self.psycho_state.current_plot_id)
         
-        embedding_lists = []
-        embedding_lists.extend(self.get_current_personal_embeddings())
-        embedding_lists.extend([event.event.embedding for event in current_events])
-        embedding_lists.extend([thought.thought.embedding for thought in current_thoughts])
-        persona_instructions = self.psycho_state.persona_instruction_database.retrieval_instruction_from_embeddings(embedding_lists, 
-                                                                                                                    topk_for_each=self.config['max_per_persona_retrieval'], 
-                                                                                                                    topk_all=self.config['max_persona_retrieval'])
-        innate_trait_prompt += f"\n--\nPsychological research has found the following pattern in human trait and behaviors:\n"
-        for persona_instruction in persona_instructions:
-            innate_trait_prompt += persona_instruction
-        innate_trait_prompt += f"\n-----\n"
+        innate_trait_prompt += self.get_reflection_persona_prompt()
         
         reflection_prompt = f"Recently she/he have come across these events and the following thoughts have arisen." + \
             f"\n---\nNew thoughts: [{[current_thought.thought.get_desc_and_poignancy() for current_thought in current_thoughts]}].\n" + \
@@ -768,6 +838,12 @@ class SocioMind():
             new_core_self.time = datetime.datetime.now()
             new_core_self.plot_id = self.psycho_state.current_plot_id
             new_core_self.round = self.psycho_state.current_round
+            return new_core_self
+        return None
+    
+    
+    def commit_new_core_self(self, new_core_self):
+        if new_core_self is not None:
             self.psycho_state.core_self_list[0:0] = [new_core_self]
             self.memory.add_core_self(new_core_self)
             
@@ -775,6 +851,12 @@ class SocioMind():
    
     
     def update_relationship_from_events(self):
+        self.commit_new_relationship(*self.get_new_relationship())
+    
+    
+    @traced(category='reflection')
+    def get_new_relationship(self, persona_prompt=None):
+        # read-only part of the relationship update, return the new relationship and its source node ids
         current_events = self.memory.get_events_from_plot(self.psycho_state.current_plot_id)
         current_thoughts = self.memory.get_thoughts_from_plot(self.psycho_state.current_plot_id)
         personality_info, motivation_info, core_self_info, relationship_info = self.get_current_personal_prompt()
@@ -783,17 +865,7 @@ class SocioMind():
         innate_trait_prompt += self.get_motivation_prompt(motivation_info, view=3)
         innate_trait_prompt += self.get_core_self_prompt(core_self_info, view=3)
         innate_trait_prompt += f"\n---\n"
-        embedding_lists = []
-        embedding_lists.extend(self.get_current_personal_embeddings())
-        embedding_lists.extend([event.event.embedding for event in current_events])
-        embedding_lists.extend([thought.thought.embedding for thought in current_thoughts])
-        persona_instructions = self.psycho_state.persona_instruction_database.retrieval_instruction_from_embeddings(embedding_lists, 
-                                                                                                                    topk_for_each=self.config['max_per_persona_retrieval'], 
-                                                                                                                    topk_all=self.config['max_persona_retrieval'])
-        innate_trait_prompt += f"\n--\nPsychological research has found the following pattern in human trait and behaviors:\n"
-        for persona_instruction in persona_instructions:
-            innate_trait_prompt += persona_instruction
-        innate_trait_prompt += f"\n-----\n"
+        innate_trait_prompt += persona_prompt if persona_prompt is not None else self.get_reflection_persona_prompt()
         
         behaviors = self.memory.get_context_behaviors(self.psycho_state.current_plot_id, context_retention=100)
         
@@ -839,12 +911,21 @@ class SocioMind():
         for event in current_events:
             behavior_node_ids.extend(event.behavior_node_ids)
         behavior_node_ids = list(set(behavior_node_ids))
-        
+        return new_relationship, behavior_node_ids, event_node_ids, thought_node_ids
+    
+    
+    def commit_new_relationship(self, new_relationship, behavior_node_ids, event_node_ids, thought_node_ids):
         self.memory.add_relationship(new_relationship, behavior_node_ids=behavior_node_ids, event_node_ids=event_node_ids, thought_node_ids=thought_node_ids)
         print(f"[Working]<{self.name}>: {self.name} update relationship with {new_relationship.get_key_description()}")
            
     
     def update_motivation_from_events(self):
+        self.commit_new_motivation(self.get_new_motivation())
+    
+    
+    @traced(category='reflection')
+    def get_new_motivation(self):
+        # read-only part of the motivation update, return the new motivation or None
         current_events = self.memory.get_events_from_plot(self.psycho_state.current_plot_id)
         current_thoughts = self.memory.get_thoughts_from_plot(self.psycho_state.current_plot_id)
         personality_info, motivation_info, core_self_info, relationship_info = self.get_current_personal_prompt()
@@ -855,17 +936,7 @@ class SocioMind():
         innate_trait_prompt += f"Her/His previous relationship with {self.character.partners[0].name}: [{relationship_info}].\n"
         innate_trait_prompt += f"\n---\n"     
         
-        embedding_lists = []
-        embedding_lists.extend(self.get_current_personal_embeddings())
-        embedding_lists.extend([event.event.embedding for event in current_events])
-        embedding_lists.extend([thought.thought.embedding for thought in current_thoughts])
-        persona_instructions = self.psycho_state.persona_instruction_database.retrieval_instruction_from_embeddings(embedding_lists, 
-                                                                                                                    topk_for_each=self.config['max_per_persona_retrieval'], 
-                                                                                                                    topk_all=self.config['max_persona_retrieval'])
-        innate_trait_prompt += f"\n--\nPsychological research has found the following pattern in human trait and behaviors:\n"
-        for persona_instruction in persona_instructions:
-            innate_trait_prompt += persona_instruction
-        innate_trait_prompt += f"\n-----\n"
+        innate_trait_prompt += self.get_reflection_persona_prompt()
                     
         reflection_prompt = f"Recently she/he have come across these events and the following thoughts have arisen." + \
             f"\n---\nNew thoughts: [{[current_thought.thought.get_desc_and_poignancy() for current_thought in current_thoughts]}].\n" + \
@@ -891,6 +962,12 @@ class SocioMind():
             new_motivation.plot_id = self.psycho_state.current_plot_id
             new_motivation.round = self.psycho_state.current_round
             new_motivation.self_name = self.name
+            return new_motivation
+        return None
+    
+    
+    def commit_new_motivation(self, new_motivation):
+        if new_motivation is not None:
             self.psycho_state.motivation_list[0:0] = [new_motivation]
             self.memory.add_motivation(new_motivation)
         
@@ -903,16 +980,14 @@ class SocioMind():
         current_manual_events = self.memory.get_manual_events_from_plot(self.psycho_state.current_plot_id)
         
         # modified the events into score: event
-        events = set()
-        for event in current_manual_events:
-            event_list = self.memory.retrieve_events_by_embedding(event.event.embedding, plot_id=self.psycho_state.current_plot_id+1, topk=3)
-            event_list = [retrieved_event for retrieved_event in event_list if retrieved_event.node_id != event.node_id]
-            events = events.union(set(event_list))
-        
-        thoughts = set()
-        for event in current_manual_events:
-            thought_list = self.memory.retrieve_thoughts_by_embedding(event.event.embedding, topk=3)
-            thoughts = thoughts.union(set(thought_list))
+        current_manual_event_embeddings = [event.event.embedding for event in current_manual_events]
+        event_lists, _ = self.memory.retrieve_events_by_embeddings(current_manual_event_embeddings, plot_id=self.psycho_state.current_plot_id+1, topk=3)
+        events = []
+        for event, event_list in zip(current_manual_events, event_lists):
+            events.extend([retrieved_event for retrieved_event in event_list if retrieved_event.node_id != event.node_id])
+        events = list(dict.fromkeys(events))
+        
+        _, thoughts = self.memory.retrieve_thoughts_by_embeddings(current_manual_event_embeddings, topk=3)
         # get motivation & personality & self & key thoughts
         personality_info, motivation_info, core_self_info, relationship_info = self.get_current_personal_prompt()
 
@@ -977,6 +1052,7 @@ class SocioMind():
         pass
     
     
+    @traced()
     def reflection(self):
         if self.psycho_state.plot_state == 'plot_finished':
             # summarize events from dialogs
@@ -985,20 +1061,23 @@ class SocioMind():
             # update thoughts from events
             self.summarize_thoughts_from_events()
             
-            # deal with conflicts between core self and events and thoughts
-            self.core_self_update_process()
-            
-            # update relationships from emotion, events, and thoughts
-            
-            self.update_relationship_from_events()
-            
-            # update current motivation from events and thoughts
-            self.update_motivation_from_events()         
+            # deal with conflicts between core self and events and thoughts,
+            # update relationships from emotion, events, and thoughts,
+            # and update current motivation from events and thoughts.
+            # Each stage reads the commits of the previous one, except the persona instructions of the relationship,
+            # which only need the embeddings the core self update keeps.
+            with ThreadPoolExecutor(max_workers=1) as executor:
+                relationship_persona_prompt = executor.submit(contextvars.copy_context().run, self.get_reflection_persona_prompt)
+                self.core_self_update_process()
+                self.commit_new_relationship(*self.get_new_relationship(persona_prompt=relationship_persona_prompt.result()))
+            self.update_motivation_from_events()
 
 
+    @traced()
     def end_plot(self):
         # save current plot state and reset psycho state
         self.working_memory = {}
+        self.reflection_prefetch = None
         for topic in self.psycho_state.topics_for_current_plot:
             topic.used = True
             topic.used_plot_id = self.psycho_state.current_plot_id
@@ -1012,11 +1091,15 @@ class SocioMind():
         self.psycho_state.current_plot_config = {}
     
     
+    @traced()
     def save_current_plot_state(self):
         config_path = os.path.join(self.config['save_dir'], 'plot_' + str(self.psycho_state.current_plot_id), 'config.yaml')
         os.makedirs(os.path.join(self.config['save_dir'], 'plot_' + str(self.psycho_state.current_plot_id)), exist_ok=True)
-        with open(config_path, 'w') as fid:
-            yaml.dump(self.config, fid)
+        # the characters share the config file and the LLM metrics of the plot
+        with config_write_lock:
+            with open(config_path, 'w') as fid:
+                yaml.dump(self.config, fid)
+            get_llm_metrics().dump(os.path.join(os.path.dirname(config_path), 'llm_metrics.json'), self.psycho_state.current_plot_id)
         save_dir = os.path.join(self.config['save_dir'], 'plot_' + str(self.psycho_state.current_plot_id), self.name)
         os.makedirs(save_dir, exist_ok=True)
         # save memory
@@ -1028,8 +1111,11 @@ class SocioMind():
             'psycho_state_attributes': psycho_state_attributes,
         }
         
-        with open(os.path.join(save_dir, 'attributes.pkl'), 'wb') as f:
-            pickle.dump(attributes, f)
+        with trace_span('checkpoint', 'io'):
+            # a checkpoint with the embeddings as rows of the embedding store of the memory
+            data = self.memory.dumps(attributes)
+            with open(os.path.join(save_dir, 'attributes.ckpt'), 'wb') as f:
+                f.write(data)
         
         self.memory.save_teaser(save_dir=save_dir)
         print(f'save to {save_dir} successfully!')
@@ -1037,8 +1123,13 @@ class SocioMind():
 
     def load_replay(self):
         load_dir = os.path.join(self.config['replay_dir'], self.name)
-        with open(os.path.join(load_dir, 'attributes.pkl'), 'rb') as f:
-            attributes = pickle.load(f)
+        load = self.memory.get_embedding_loader(self.memory.get_memory_log_dir(load_dir))
+        attributes_path = os.path.join(load_dir, 'attributes.ckpt')
+        if not os.path.exists(attributes_path):
+            # plots saved before the checkpoints
+            attributes_path = os.path.join(load_dir, 'attributes.pkl')
+        with open(attributes_path, 'rb') as f:
+            attributes = load(f)
         
         self.psycho_state.load_current_plot_state(attributes['psycho_state_attributes'])
         self.memory.load_current_plot_state(attributes['memory_attributes'], load_dir=load_dir)
@@ -0,0 +1,98 @@
+"""
+File: span_tracer.py
+Description: Always-on span tracer of the simulation phases, dumped as a Chrome trace
+
+A span is one complete event of the Chrome trace-event format ("ph": "X"), recorded when it ends.
+Spans of the same thread nest by time, so the reaction phases contain their memory retrieval,
+persona retrieval, prompt assembly, LLM wait, checkpoint, and plotting spans. Open the dumped
+trace.json in chrome://tracing or https://ui.perfetto.dev.
+"""
+import os
+import json
+import time
+import threading
+import functools
+import contextlib
+
+
+# spans kept in memory per run, the later ones are counted but dropped
+MAX_TRACE_EVENTS = 500000
+
+
+class SpanTracer:
+    def __init__(self, max_events=MAX_TRACE_EVENTS):
+        self.max_events = max_events
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.events = []
+            self.dropped = 0
+            self.thread_names = {}
+            self.start_ns = time.perf_counter_ns()
+
+    @contextlib.contextmanager
+    def span(self, name, category='phase', **args):
+        start_ns = time.perf_counter_ns()
+        try:
+            yield
+        finally:
+            end_ns = time.perf_counter_ns()
+            thread = threading.current_thread()
+            event = {
+                'name': name,
+                'cat': category,
+                'ph': 'X',
+                'ts': (start_ns - self.start_ns) / 1000.0,
+                'dur': (end_ns - start_ns) / 1000.0,
+                'pid': os.getpid(),
+                'tid': thread.ident,
+            }
+            if args:
+                event['args'] = args
+            with self.lock:
+                if len(self.events) < self.max_events:
+                    self.events.append(event)
+                else:
+                    self.dropped += 1
+                self.thread_names.setdefault(thread.ident, thread.name)
+
+    def dump(self, path):
+        with self.lock:
+            events = list(self.events)
+            metadata = [{'name': 'thread_name', 'ph': 'M', 'pid': os.getpid(), 'tid': tid, 'args': {'name': thread_name}}
+                        for tid, thread_name in self.thread_names.items()]
+            dropped = self.dropped
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump({'traceEvents': metadata + events, 'displayTimeUnit': 'ms',
+                       'otherData': {'dropped_events': dropped}}, f)
+
+
+_span_tracer = SpanTracer()
+
+
+def get_span_tracer():
+    return _span_tracer
+
+
+def trace_span(name, category='phase', **args):
+    return _span_tracer.span(name, category, **args)
+
+
+def traced(name=None, category='phase'):
+    """
+    Trace every call of the function as a span, with the character name of its object if it has one.
+    """
+    def decorator(func):
+        span_name = name if name is not None else func.__name__
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            owner_name = getattr(args[0], 'name', None) if len(args) > 0 else None
+            if type(owner_name) is str:
+                with _span_tracer.span(span_name, category, character=owner_name):
+                    return func(*args, **kwargs)
+            with _span_tracer.span(span_name, category):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
@@ -0,0 +1,157 @@
+"""
+File: society_runner.py
+Description: Runner of many independent AI societies on a process pool
+
+Every job is one pair of characters from a config. The pairs of a config are listed in its
+'pairs' key, or else taken two by two from characters_info. The jobs run in separate processes,
+each with its own save_dir, and share the LLM rate limit and a budget of LLM requests in flight.
+The runner writes a manifest.json with the wall time, steps, LLM calls, and token usage of every job.
+"""
+import os
+import re
+import time
+import json
+import yaml
+import datetime
+import traceback
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from digital_life_project.autonomous_character import AutonomousCharacter
+from digital_life_project.society_scheduler import SocietyScheduler
+from digital_life_project.characters.llm_api.gpt_prompt_base import get_llm_usage, set_llm_concurrency_semaphore
+from digital_life_project.characters.llm_api.llm_metrics import get_llm_metrics
+from digital_life_project.characters.span_tracer import get_span_tracer, trace_span
+
+
+def load_yaml(file_path):
+    with open(file_path, 'r', encoding='utf-8') as yaml_file:
+        return yaml.safe_load(yaml_file)
+
+
+def get_character_pairs(config):
+    if config.get('pairs'):
+        return [list(pair) for pair in config['pairs']]
+    names = list(config['characters_info'].keys())
+    return [names[i:i+2] for i in range(0, len(names) - 1, 2)]
+
+
+def run_society_pair(config, pair, max_steps=50):
+    # the phase spans of this run are dumped to trace.json in its save_dir
+    get_span_tracer().reset()
+    try:
+        characters = []
+        # initialize characters
+        for name in pair:
+            with trace_span('initialize_character', character=name):
+                characters.append(AutonomousCharacter(
+                    name, config, scene=None, place='bookshelf', has_body=False))
+
+        characters[0].set_interact_partner(characters[1])
+        characters[1].set_interact_partner(characters[0])
+
+        # start simulation, the characters react concurrently where they do not observe each other
+        scheduler = SocietyScheduler(characters, max_steps=max_steps)
+        scheduler.run()
+        return scheduler
+    finally:
+        get_span_tracer().dump(os.path.join(config['save_dir'], 'trace.json'))
+
+
+def build_society_jobs(config_paths, save_dir):
+    jobs = []
+    job_names = set()
+    for config_path in config_paths:
+        config = load_yaml(config_path)
+        config_name = os.path.splitext(os.path.basename(config_path))[0]
+        for pair in get_character_pairs(config):
+            job_name = re.sub(r'[^A-Za-z0-9_.-]', '_', '_'.join([config_name] + pair))
+            if job_name in job_names:
+                job_name += f'_{len(jobs)}'
+            job_names.add(job_name)
+            jobs.append({
+                'name': job_name,
+                'config_path': config_path,
+                'pair': pair,
+                'save_dir': os.path.join(save_dir, job_name),
+            })
+    return jobs
+
+
+def run_society_job(job, max_steps=50):
+    """
+    Run one pair in the worker process and return its manifest entry.
+    """
+    start_time = time.time()
+    start_usage = get_llm_usage()
+    # the per-plot LLM metrics of the job start from zero in a reused worker process
+    get_llm_metrics().reset()
+    result = {
+        'name': job['name'],
+        'config': job['config_path'],
+        'characters': job['pair'],
+        'save_dir': job['save_dir'],
+        'pid': os.getpid(),
+    }
+    try:
+        config = load_yaml(job['config_path'])
+        config['replay_dir'] = ''
+        config['save_dir'] = job['save_dir']
+        os.makedirs(job['save_dir'], exist_ok=True)
+        with open(os.path.join(job['save_dir'], 'config.yaml'), 'w') as fid:
+            yaml.dump(config, fid)
+        scheduler = run_society_pair(config, job['pair'], max_steps=max_steps)
+        result['status'] = 'finished' if scheduler.is_finished() else 'stopped'
+        result['steps'] = scheduler.steps
+    except:
+        result['status'] = 'failed'
+        result['error'] = traceback.format_exc()
+        print(f"[Society Runner] {job['name']} failed:\n{result['error']}")
+    end_usage = get_llm_usage()
+    result['wall_time'] = time.time() - start_time
+    result['llm_usage'] = {key: end_usage[key] - start_usage[key] for key in end_usage.keys()}
+    return result
+
+
+def run_society_jobs(jobs, save_dir, max_workers=4, llm_concurrency=8, max_steps=50):
+    """
+    Fan the jobs out across a process pool, llm_concurrency <= 0 means no shared LLM budget.
+    """
+    os.makedirs(save_dir, exist_ok=True)
+    if os.environ.get("LLM_RATE_LIMIT_DIR", "") == "":
+        # the worker processes inherit the environment and draw from one rate limit quota
+        os.environ["LLM_RATE_LIMIT_DIR"] = save_dir
+    start_time = time.time()
+    context = multiprocessing.get_context()
+    semaphore = context.BoundedSemaphore(llm_concurrency) if llm_concurrency > 0 else None
+    results = {}
+    with ProcessPoolExecutor(max_workers=max_workers, mp_context=context,
+                             initializer=set_llm_concurrency_semaphore, initargs=(semaphore,)) as executor:
+        futures = {executor.submit(run_society_job, job, max_steps): job for job in jobs}
+        for future in as_completed(futures):
+            job = futures[future]
+            try:
+                results[job['name']] = future.result()
+            except:
+                # the worker process died
+                results[job['name']] = {'name': job['name'], 'config': job['config_path'], 'characters': job['pair'],
+                                        'save_dir': job['save_dir'], 'status': 'failed', 'error': traceback.format_exc()}
+            print(f"[Society Runner] {job['name']} {results[job['name']]['status']} ({len(results)}/{len(jobs)})")
+
+    results = [results[job['name']] for job in jobs]
+    total_usage = {}
+    for result in results:
+        for key, value in result.get('llm_usage', {}).items():
+            total_usage[key] = total_usage.get(key, 0) + value
+    manifest = {
+        'created': datetime.datetime.now().isoformat(),
+        'wall_time': time.time() - start_time,
+        'max_workers': max_workers,
+        'llm_concurrency': llm_concurrency,
+        'llm_service_type': os.environ.get("LLM_SERVICE_TYPE", ""),
+        'llm_usage': total_usage,
+        'jobs': results,
+    }
+    with open(os.path.join(save_dir, 'manifest.json'), 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, indent=2)
+    print(f"[Society Runner] {len(jobs)} societies in {manifest['wall_time']:.1f}s, manifest saved to {save_dir}")
+    return manifest
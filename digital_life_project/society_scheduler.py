@@ -0,0 +1,69 @@
+"""
+File: society_scheduler.py
+Description: Concurrent scheduler of the reaction steps of the characters in a society
+
+In every step the characters react in the order of the characters list, as in the round-robin loop,
+but the characters that do not observe each other run concurrently:
+    - a character in 'working' or 'plan_plot_proposals' reads get_observed_info() of its partners,
+      so it waits for the partners before it in the list, and the partners after it wait for it
+    - a character in 'plot_finished' only ends its plot and plans its proposals, so it runs with its
+      partners in 'plot_finished' too
+    - the reflection of a character runs in the background until the end of the step
+The simulation stops once every character reaches 'end'.
+"""
+from concurrent.futures import ThreadPoolExecutor
+from digital_life_project.characters.span_tracer import traced
+
+
+# plot states whose interaction neither observes the partners nor changes what a partner in the same state observes
+INDEPENDENT_PLOT_STATES = ['plot_finished']
+
+
+def get_plot_state(character):
+    return character.brain.psycho_state.plot_state
+
+
+class SocietyScheduler:
+    def __init__(self, characters, max_steps=50, max_workers=None):
+        self.characters = characters
+        self.max_steps = max_steps
+        self.max_workers = max_workers if max_workers is not None else 2 * len(characters)
+        self.executor = None
+        self.steps = 0
+
+    def is_finished(self):
+        return all(get_plot_state(character) == 'end' for character in self.characters)
+
+    def is_conflicted(self, character, other):
+        if other not in character.partners and character not in other.partners:
+            return False
+        return get_plot_state(character) not in INDEPENDENT_PLOT_STATES or get_plot_state(other) not in INDEPENDENT_PLOT_STATES
+
+    def run_batch(self, batch, introspections):
+        futures = [self.executor.submit(character.interaction) for character in batch]
+        for future in futures:
+            future.result()
+        introspections += [self.executor.submit(character.introspection) for character in batch]
+
+    @traced(category='scheduler')
+    def step(self):
+        batch = []
+        introspections = []
+        for character in self.characters:
+            if get_plot_state(character) == 'end':
+                continue
+            if any(self.is_conflicted(character, other) for other in batch):
+                self.run_batch(batch, introspections)
+                batch = []
+            batch.append(character)
+        self.run_batch(batch, introspections)
+        for future in introspections:
+            future.result()
+        self.steps += 1
+
+    def run(self):
+        with ThreadPoolExecutor(max_workers=self.max_workers) as self.executor:
+            while self.steps < self.max_steps and not self.is_finished():
+                self.step()
+        self.executor = None
+        print(f"[Scheduler] Simulation stops after {self.steps} steps.")
@@ -9,28 +9,13 @@ from datetime import datetime
 import os
 import yaml
 import argparse
-from digital_life_project.autonomous_character import AutonomousCharacter
-
-
-def load_yaml(file_path):
-    with open(file_path, 'r', encoding='utf-8') as yaml_file:
-        return yaml.safe_load(yaml_file)
+from digital_life_project.society_runner import load_yaml, get_character_pairs, run_society_pair, build_society_jobs, run_society_jobs
+from digital_life_project.characters.llm_api.gpt_prompt_base import get_llm_backend_names
 
 
 def main_ai_society(config):
-    characters = []
-    # initialize characters
-    for key in config['characters_info'].keys():
-        characters.append(AutonomousCharacter(
-            key, config, scene=None, place='bookshelf', has_body=False))
-    
-    characters[0].set_interact_partner(characters[1])
-    characters[1].set_interact_partner(characters[0])
-    
-    # start simulation
-    for _ in range(50):
-        for character in characters:
-            character.reaction()
+    # the first pair of characters in the config
+    run_society_pair(config, get_character_pairs(config)[0], max_steps=50)
 
 
 if __name__ == '__main__':
@@ -38,23 +23,56 @@ if __name__ == '__main__':
     argparser = argparse.ArgumentParser()
     argparser.add_argument('--config', type=str, default='test_marginal.yaml')
     argparser.add_argument('--replay_dir', type=str, default='')
-    argparser.add_argument('--llm_service_type', type=str, default='openai', help='openai, azure')
+    argparser.add_argument('--lazy_replay', action='store_true', help='read the replayed memory nodes on first access')
+    argparser.add_argument('--llm_service_type', type=str, default='openai', help=', '.join(get_llm_backend_names()))
+    argparser.add_argument('--embedding_cache_dir', type=str, default='', help='persistent embedding cache shared by runs')
+    argparser.add_argument('--llm_cassette', type=str, default='', help='cassette file of the LLM and embedding traffic')
+    argparser.add_argument('--llm_cassette_mode', type=str, default='replay', help='record, replay, passthrough')
+    argparser.add_argument('--llm_rpm', type=int, default=0, help='requests per minute of the LLM quota, 0 for no limit')
+    argparser.add_argument('--llm_tpm', type=int, default=0, help='tokens per minute of the LLM quota, 0 for no limit')
+    argparser.add_argument('--llm_memo_families', type=str, default='', help="comma-separated prompt families whose responses are memoized, 'default' for the deterministic ones")
+    argparser.add_argument('--llm_memo_dir', type=str, default='', help='persistent memo of the LLM responses shared by runs')
+    argparser.add_argument('--configs', type=str, nargs='*', default=[], help='run every character pair of these configs on a process pool')
+    argparser.add_argument('--max_workers', type=int, default=4, help='processes of the society runner')
+    argparser.add_argument('--llm_concurrency', type=int, default=8, help='LLM requests in flight shared by the processes, 0 for no limit')
     args = argparser.parse_args()
     
     now = datetime.now()
     formatted_time = now.strftime('%y%m%d-%H%M%S')
     save_dir = os.path.join('output', str(formatted_time))
 
-    if args.llm_service_type in ['openai', 'azure']:
+    if args.llm_service_type in get_llm_backend_names():
         os.environ["LLM_SERVICE_TYPE"] = args.llm_service_type
     else:
         raise ValueError(f'Unknown service type: {args.llm_service_type}')
+    if args.embedding_cache_dir != '':
+        os.environ["EMBEDDING_CACHE_DIR"] = args.embedding_cache_dir
+    if args.llm_cassette != '':
+        os.environ["LLM_CASSETTE"] = args.llm_cassette
+        os.environ["LLM_CASSETTE_MODE"] = args.llm_cassette_mode
+    if args.llm_rpm > 0 or args.llm_tpm > 0:
+        os.environ["LLM_RPM"] = str(args.llm_rpm)
+        os.environ["LLM_TPM"] = str(args.llm_tpm)
+    if args.llm_memo_families != '':
+        os.environ["LLM_MEMO_FAMILIES"] = args.llm_memo_families
+    if args.llm_memo_dir != '':
+        os.environ["LLM_MEMO_DIR"] = args.llm_memo_dir
+    
+    # run many societies at once
+    if len(args.configs) > 0:
+        config_dir = r'.\digital_life_project\characters\configs'
+        save_dir = os.path.join('output', f'society_{formatted_time}')
+        jobs = build_society_jobs([os.path.join(config_dir, filename) for filename in args.configs], save_dir)
+        run_society_jobs(jobs, save_dir, max_workers=args.max_workers, llm_concurrency=args.llm_concurrency)
+        exit()
     
     # load replay data or start new simulation
     if args.replay_dir != '':
         config_path = os.path.join(args.replay_dir, 'config.yaml')
         config = load_yaml(config_path)
         config['replay_dir'] = args.replay_dir
+        if args.lazy_replay:
+            config['lazy_replay'] = True
         file_name = args.replay_dir.split('/')[-1]
         save_dir = os.path.join('output', f'{file_name}_{formatted_time}')
     else: